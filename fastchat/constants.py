@@ -34,6 +34,8 @@ class ErrorCode(IntEnum):
     INVALID_MODEL = 40301
     PARAM_OUT_OF_RANGE = 40302
     CONTEXT_OVERFLOW = 40303
+    INVALID_COLLECTION = 40304
+    INVALID_BATCH = 40305
 
     RATE_LIMIT = 42901
     QUOTA_EXCEEDED = 42902
@@ -3,8 +3,10 @@ Conversation prompt templates.
 """
 
 import dataclasses
+from collections import Counter
 from enum import auto, Enum
-from typing import List, Any, Dict
+import math
+from typing import List, Any, Dict, Callable, Optional, Tuple
 
 
 class SeparatorStyle(Enum):
@@ -42,6 +44,16 @@ class Conversation:
     stop_str: str = None
     # Stops generation if meeting any token in this list
     stop_token_ids: List[int] = None
+    # A pool of (user message, assistant message) examples. The most similar
+    # ones are inserted per request by select_examples.
+    example_pool: List[Tuple[str, str]] = None
+    # The max number of selected examples
+    example_k: int = 8
+    # The max number of tokens of the selected examples
+    example_token_budget: int = None
+    # Texts (e.g. field labels) whose tokens, together with the tokens of the
+    # user message, are the only ones allowed in the output. None allows all.
+    allowed_output: List[str] = None
 
     def get_prompt(self) -> str:
         """Get the prompt for generation."""
@@ -147,6 +159,52 @@ class Conversation:
                     ret.append({"role": "assistant", "content": msg})
         return ret
 
+    def select_examples(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        embed: Optional[Callable[[List[str]], Any]] = None,
+    ):
+        """Insert the examples of the pool most similar to the query.
+
+        Similarity is the cosine of character trigram counts, or of the vectors
+        returned by embed(texts) if given. Examples are added from the most
+        similar one while both k and the token budget allow. They are placed
+        right before the conversation, the most similar one last, and hidden
+        from the chat history by moving the offset.
+        """
+        if not self.example_pool:
+            return
+        k = self.example_k if k is None else k
+        if token_budget is None:
+            token_budget = self.example_token_budget
+        if count_tokens is None:
+            # A rough estimate without a tokenizer.
+            count_tokens = lambda text: len(text) // 3 + 1
+
+        scores = example_similarities(self.example_pool, query, embed)
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])
+        selected = []
+        used_tokens = 0
+        for i in order:
+            if len(selected) >= k:
+                break
+            user, assistant = self.example_pool[i]
+            num_tokens = count_tokens(user) + count_tokens(assistant)
+            if token_budget is not None and used_tokens + num_tokens > token_budget:
+                continue
+            selected.append(i)
+            used_tokens += num_tokens
+
+        examples = []
+        for i in reversed(selected):
+            user, assistant = self.example_pool[i]
+            examples += [[self.roles[0], user], [self.roles[1], assistant]]
+        self.messages[self.offset : self.offset] = examples
+        self.offset += len(examples)
+
     def copy(self):
         return Conversation(
             name=self.name,
@@ -159,6 +217,10 @@ class Conversation:
             sep2=self.sep2,
             stop_str=self.stop_str,
             stop_token_ids=self.stop_token_ids,
+            example_pool=self.example_pool,
+            example_k=self.example_k,
+            example_token_budget=self.example_token_budget,
+            allowed_output=self.allowed_output,
         )
 
     def dict(self):
@@ -171,6 +233,49 @@ class Conversation:
         }
 
 
+# Cached features of the example pools, keyed by (id(pool), embed)
+example_features = {}
+
+
+def char_ngrams(text: str, n: int = 3) -> Counter:
+    text = " ".join(text.lower().split())
+    if len(text) <= n:
+        return Counter([text])
+    return Counter(text[i : i + n] for i in range(len(text) - n + 1))
+
+
+def ngram_cosine(a: Counter, b: Counter) -> float:
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    norm = math.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def example_similarities(
+    pool: List[Tuple[str, str]], query: str, embed=None
+) -> List[float]:
+    key = (id(pool), embed)
+    if key not in example_features:
+        users = [user for user, _ in pool]
+        if embed is None:
+            example_features[key] = [char_ngrams(user) for user in users]
+        else:
+            example_features[key] = embed(users)
+    features = example_features[key]
+
+    if embed is None:
+        query_ngrams = char_ngrams(query)
+        return [ngram_cosine(query_ngrams, f) for f in features]
+    # Embeddings are expected to be L2-normalized rows.
+    return [float(x) for x in features @ embed([query])[0]]
+
+
+def examples_from_messages(messages) -> List[Tuple[str, str]]:
+    """Pair up the (user, assistant) turns of a static few-shot template."""
+    return [
+        (messages[i][1], messages[i + 1][1]) for i in range(0, len(messages) - 1, 2)
+    ]
+
+
 # A global registry for all conversation templates
 conv_templates: Dict[str, Conversation] = {}
 
@@ -820,6 +925,57 @@ register_conv_template(
 )
 
 
+# Short templates of LoRA adapters distilled from the few-shot templates above
+# with fastchat/train/distill_template.py. The examples live in the weights.
+register_conv_template(
+    Conversation(
+        name="planshet_big_distilled",
+        system="Extract the Brand and Device.",
+        roles=("USER", "ASSISTANT"),
+        messages=(),
+        offset=0,
+        sep_style=SeparatorStyle.ADD_COLON_TWO,
+        sep=" ",
+        sep2="</s>",
+    )
+)
+
+register_conv_template(
+    Conversation(
+        name="obuv_distilled",
+        system="Extract the Brand and Product.",
+        roles=("USER", "ASSISTANT"),
+        messages=(),
+        offset=0,
+        sep_style=SeparatorStyle.ADD_COLON_TWO,
+        sep=" ",
+        sep2="</s>",
+    )
+)
+
+
+# Variants of the few-shot templates above that pick the examples most similar
+# to each request from the same examples instead of sending all of them.
+for name in ["planshet_big", "obuv"]:
+    template = conv_templates[name]
+    register_conv_template(
+        Conversation(
+            name=f"{name}_retrieval",
+            system=template.system,
+            roles=template.roles,
+            messages=(),
+            offset=0,
+            sep_style=template.sep_style,
+            sep=template.sep,
+            sep2=template.sep2,
+            stop_str=template.stop_str,
+            example_pool=examples_from_messages(template.messages),
+            example_k=8,
+            example_token_budget=1024,
+        )
+    )
+
+
 # Vicuna v1.1 template
 register_conv_template(
     Conversation(
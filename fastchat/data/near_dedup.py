@@ -0,0 +1,238 @@
+"""
+Near-duplicate clustering of short texts such as offer names.
+
+Texts are normalized (case, punctuation, whitespace and leading SKU codes like
+"934 CS1219PL"), then compared with MinHash signatures of character n-grams.
+A code is a token that mixes letters and digits, other than a measurement like
+"128gb", or a number of at least five digits. Shorter numbers are only
+stripped in front of a code.
+Clusters are built greedily in input order: a text joins the most similar
+earlier representative if their estimated Jaccard similarity reaches the
+threshold, otherwise it becomes a new representative. Banded LSH keeps the
+lookup sublinear in the number of representatives. Texts with the same
+normalized form match directly, with the n-gram Jaccard similarity of the
+texts before stripping the codes as confidence. Texts whose tokens with digits
+differ, e.g. "iPhone 13" and "iPhone 14", never match: they name different
+products however similar the rest is.
+
+Usage:
+python3 -m fastchat.data.near_dedup --in-file offers.csv --sep ";" --column name --out-file clusters.csv
+"""
+import argparse
+import hashlib
+import re
+import unicodedata
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+punct_pattern = re.compile(r"[^\w\s]|_")
+# A number with a unit, e.g. "128gb" or "500ml".
+measurement_pattern = re.compile(r"\d+[^\W\d_]{1,3}")
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def is_code(token: str) -> bool:
+    """Whether a token looks like an article number or a SKU."""
+    if token.isdigit():
+        return len(token) >= 5
+    if not any(c.isdigit() for c in token) or not any(c.isalpha() for c in token):
+        return False
+    return measurement_pattern.fullmatch(token) is None
+
+
+def strip_code_prefix(text: str) -> str:
+    tokens = text.split()
+    end = 0
+    for i, token in enumerate(tokens):
+        if is_code(token):
+            end = i + 1
+        elif not token.isdigit():
+            break
+    return " ".join(tokens[end:])
+
+
+def normalize_text(text: str, strip_codes: bool = True) -> str:
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = " ".join(punct_pattern.sub(" ", text).split())
+    if strip_codes:
+        stripped = strip_code_prefix(text)
+        if stripped:
+            text = stripped
+    return text
+
+
+def shingles(text: str, ngram: int) -> List[str]:
+    if len(text) <= ngram:
+        return [text]
+    return [text[i : i + ngram] for i in range(len(text) - ngram + 1)]
+
+
+def number_tokens(normalized: str) -> Tuple[str, ...]:
+    """The tokens of a normalized text that contain a digit, sorted."""
+    return tuple(sorted(t for t in normalized.split() if any(c.isdigit() for c in t)))
+
+
+def jaccard(a: str, b: str, ngram: int) -> float:
+    a, b = set(shingles(a, ngram)), set(shingles(b, ngram))
+    return len(a & b) / len(a | b)
+
+
+class NearDuplicateIndex:
+    """An index of cluster representatives that finds the best match of a text."""
+
+    def __init__(
+        self,
+        threshold: float = 0.85,
+        num_perm: int = 128,
+        num_bands: int = 16,
+        ngram: int = 4,
+        strip_codes: bool = True,
+        match_numbers: bool = True,
+        seed: int = 1,
+    ):
+        if num_perm % num_bands != 0:
+            raise ValueError("num_perm must be a multiple of num_bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.ngram = ngram
+        self.strip_codes = strip_codes
+        self.match_numbers = match_numbers
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self.signatures: Dict[Hashable, np.ndarray] = {}
+        self.exact: Dict[str, Hashable] = {}
+        # The texts of the representatives, normalized without stripping codes.
+        self.full_texts: Dict[Hashable, str] = {}
+        self.numbers: Dict[Hashable, Tuple[str, ...]] = {}
+        self.bands: List[Dict[bytes, List[Hashable]]] = [
+            {} for _ in range(num_bands)
+        ]
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def signature(self, normalized: str) -> np.ndarray:
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(),
+                    "little",
+                )
+                for s in shingles(normalized, self.ngram)
+            ],
+            dtype=np.uint64,
+        )
+        # uint64 overflow wraps around, which is fine for hashing.
+        values = (hashes[:, None] * self.a + self.b) % MERSENNE_PRIME & MAX_HASH
+        return values.min(axis=0)
+
+    def band_keys(self, sig: np.ndarray) -> List[bytes]:
+        r = self.rows_per_band
+        return [sig[i * r : (i + 1) * r].tobytes() for i in range(self.num_bands)]
+
+    def query(self, text: str) -> Tuple[Optional[Hashable], float, str, np.ndarray]:
+        """Return (representative key or None, similarity, normalized, signature)."""
+        normalized = normalize_text(text, self.strip_codes)
+        if normalized in self.exact:
+            rep_key = self.exact[normalized]
+            sim = jaccard(
+                normalize_text(text, False), self.full_texts[rep_key], self.ngram
+            )
+            return rep_key, sim, normalized, None
+        sig = self.signature(normalized)
+        candidates = set()
+        for table, key in zip(self.bands, self.band_keys(sig)):
+            candidates.update(table.get(key, ()))
+        numbers = number_tokens(normalized)
+        best_key, best_sim = None, 0.0
+        for candidate in candidates:
+            if self.match_numbers and self.numbers[candidate] != numbers:
+                continue
+            sim = float(np.mean(self.signatures[candidate] == sig))
+            if sim > best_sim or (sim == best_sim and best_key is None):
+                best_key, best_sim = candidate, sim
+        if best_sim < self.threshold:
+            return None, best_sim, normalized, sig
+        return best_key, best_sim, normalized, sig
+
+    def add(self, key: Hashable, text: str, normalized=None, sig=None):
+        """Add a cluster representative."""
+        if normalized is None:
+            normalized = normalize_text(text, self.strip_codes)
+        if sig is None:
+            sig = self.signature(normalized)
+        self.signatures[key] = sig
+        self.full_texts[key] = normalize_text(text, False)
+        self.numbers[key] = number_tokens(normalized)
+        self.exact.setdefault(normalized, key)
+        for table, band_key in zip(self.bands, self.band_keys(sig)):
+            table.setdefault(band_key, []).append(key)
+
+    def assign(self, key: Hashable, text: str) -> Tuple[Optional[Hashable], float]:
+        """
+        Match a text against the representatives, and make it a new
+        representative if nothing matches. Return (representative key, similarity),
+        or (None, 1.0) if the text became a representative itself.
+        """
+        rep_key, sim, normalized, sig = self.query(text)
+        if rep_key is not None:
+            return rep_key, sim
+        self.add(key, text, normalized, sig)
+        return None, 1.0
+
+
+def cluster_texts(texts: List[str], **kwargs) -> Tuple[List[Optional[int]], List[float]]:
+    """Return the representative index (None for representatives) and the
+    similarity to it for every text."""
+    index = NearDuplicateIndex(**kwargs)
+    rep_ids, confidences = [], []
+    for i, text in enumerate(texts):
+        rep_id, sim = index.assign(i, text)
+        rep_ids.append(rep_id)
+        confidences.append(sim)
+    return rep_ids, confidences
+
+
+def drop_near_duplicates(df: pd.DataFrame, column: str, **kwargs) -> pd.DataFrame:
+    """A near-duplicate aware version of df.drop_duplicates(subset=[column])."""
+    rep_ids, _ = cluster_texts(df[column].fillna("").astype(str).tolist(), **kwargs)
+    return df[[rep_id is None for rep_id in rep_ids]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in-file", type=str, required=True)
+    parser.add_argument("--out-file", type=str, default="clusters.csv")
+    parser.add_argument("--sep", type=str, default=",")
+    parser.add_argument("--column", type=str, default="name")
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--no-strip-codes", action="store_true")
+    parser.add_argument(
+        "--no-match-numbers",
+        action="store_true",
+        help="Also merge texts whose tokens with digits differ",
+    )
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.in_file, sep=args.sep)
+    rep_ids, confidences = cluster_texts(
+        df[args.column].fillna("").astype(str).tolist(),
+        threshold=args.threshold,
+        strip_codes=not args.no_strip_codes,
+        match_numbers=not args.no_match_numbers,
+    )
+    df["dedup_of"] = pd.array(rep_ids, dtype="Int64")
+    df["dedup_confidence"] = confidences
+    df.to_csv(args.out_file, sep=args.sep, index=False)
+
+    num_reps = sum(rep_id is None for rep_id in rep_ids)
+    print(f"#in: {len(df)}, #clusters: {num_reps}, saved {1 - num_reps / len(df):.2%}")
@@ -0,0 +1,129 @@
+"""
+Compare the speed and accuracy of the CPU load modes on an extraction set.
+
+The model is loaded once per --cpu-dtypes mode and answers the texts greedily.
+The first mode, float32 by default, is the reference. For each mode, the
+report lists the resident memory after loading, the generation throughput and
+the agreement with the reference (whole answers and "Field: value" lines, and
+the mean absolute difference of the mean token log-probs).
+
+Usage:
+python3 -m fastchat.eval.eval_cpu_dtype --model-path /path/to/vicuna-13b \
+    --input offers.csv --sep ";" --column name --conv-template planshet_big \
+    --num-samples 100 --output cpu_dtype_report.json
+"""
+import argparse
+import gc
+import json
+import os
+import time
+
+import psutil
+import torch
+
+from fastchat.eval.eval_kv_cache import compare, read_texts
+from fastchat.model.model_adapter import CPU_DTYPES, add_model_args, load_model
+from fastchat.serve.batch_infer import BatchGenerator
+
+
+def run(args, cpu_dtype, texts):
+    gc.collect()
+    rss_before = psutil.Process().memory_info().rss
+    tic = time.time()
+    model, tokenizer = load_model(
+        args.model_path,
+        "cpu",
+        args.num_gpus,
+        load_8bit=args.load_8bit,
+        sdpa_attn=args.sdpa_attn,
+        cpu_dtype=cpu_dtype,
+    )
+    load_seconds = time.time() - tic
+    model_gb = (psutil.Process().memory_info().rss - rss_before) / 2**30
+
+    generator = BatchGenerator(model, tokenizer, "cpu", args)
+    tic = time.time()
+    outputs = generator.generate(texts)
+    seconds = time.time() - tic
+    num_tokens = sum(out["usage"]["completion_tokens"] for out in outputs)
+
+    del generator, model, tokenizer
+    gc.collect()
+    stats = {
+        "cpu_dtype": cpu_dtype,
+        "load_seconds": load_seconds,
+        "model_gb": model_gb,
+        "tokens_per_s": num_tokens / seconds,
+    }
+    return outputs, stats
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    texts = read_texts(args)
+    print(f"#texts: {len(texts)}, #threads: {torch.get_num_threads()}")
+
+    report = {"num_texts": len(texts), "results": []}
+    reference = None
+    for cpu_dtype in args.cpu_dtypes:
+        outputs, result = run(args, cpu_dtype, texts)
+        if reference is None:
+            reference = outputs
+        result.update(compare(reference, outputs))
+        report["results"].append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as fout:
+            json.dump(report, fout, indent=2)
+
+    print(
+        f"\n{'cpu dtype':<10}{'model GB':>10}{'tokens/s':>10}{'speedup':>9}"
+        f"{'exact':>8}{'fields':>8}"
+    )
+    base_speed = report["results"][0]["tokens_per_s"]
+    for result in report["results"]:
+        field_match = result["field_match"]
+        field_match = "-" if field_match is None else f"{field_match:.3f}"
+        print(
+            f"{result['cpu_dtype']:<10}{result['model_gb']:>10.1f}"
+            f"{result['tokens_per_s']:>10.2f}"
+            f"{result['tokens_per_s'] / base_speed:>9.2f}"
+            f"{result['exact_match']:>8.3f}{field_match:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument(
+        "--input", type=str, required=True, help="A CSV or Parquet file"
+    )
+    parser.add_argument("--output", type=str, default=None, help="A JSON report")
+    parser.add_argument("--sep", type=str, default=",", help="The CSV separator")
+    parser.add_argument(
+        "--column", type=str, default="name", help="The input text column"
+    )
+    parser.add_argument("--conv-template", type=str, default=None)
+    parser.add_argument("--num-samples", type=int, default=100)
+    parser.add_argument(
+        "--cpu-dtypes",
+        type=str,
+        nargs="+",
+        choices=CPU_DTYPES,
+        default=CPU_DTYPES,
+        help="The modes to compare, the first one is the reference",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="The intra-op thread count"
+    )
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,163 @@
+"""
+Compare the accuracy and memory of KV cache storage types on an extraction set.
+
+The texts are answered greedily with the contiguous Hugging Face cache as the
+reference, then with the paged KV cache in every --kv-cache-dtypes storage
+type. For each type, the report lists the agreement with the reference (whole
+answers and "Field: value" lines), the mean absolute difference of the mean
+token log-probs, the memory per token and how many average sequences fit in
+--kv-cache-gb.
+
+Usage:
+python3 -m fastchat.eval.eval_kv_cache --model-path /path/to/vicuna-13b \
+    --input offers.csv --sep ";" --column name --conv-template planshet_big \
+    --num-samples 500 --output kv_cache_report.json
+"""
+import argparse
+import json
+import os
+
+from fastchat.model.kv_cache import (
+    GB,
+    KV_DTYPES,
+    disable_paged_kv_cache,
+    enable_paged_kv_cache,
+    kv_bytes_per_token,
+)
+from fastchat.model.model_adapter import add_model_args, load_model
+from fastchat.serve.batch_infer import BatchGenerator, read_chunks
+
+
+def read_texts(args):
+    texts = []
+    for df in read_chunks(args.input, args.chunk_size, args.sep):
+        for text in df[args.column].dropna().astype(str):
+            text = text.strip()
+            if text:
+                texts.append(text)
+            if len(texts) >= args.num_samples:
+                return texts
+    return texts
+
+
+def parse_fields(text: str):
+    fields = {}
+    for line in text.strip().splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            fields[key.strip().lower()] = value.strip().lower()
+    return fields
+
+
+def compare(reference, outputs):
+    num_exact = num_fields = num_field_matches = 0
+    logprob_diff = 0.0
+    for ref, out in zip(reference, outputs):
+        num_exact += int(ref["text"].strip() == out["text"].strip())
+        ref_fields = parse_fields(ref["text"])
+        out_fields = parse_fields(out["text"])
+        num_fields += len(ref_fields)
+        num_field_matches += sum(
+            out_fields.get(key) == value for key, value in ref_fields.items()
+        )
+        logprob_diff += abs(ref["mean_logprob"] - out["mean_logprob"])
+    return {
+        "exact_match": num_exact / len(reference),
+        "field_match": num_field_matches / num_fields if num_fields else None,
+        "mean_logprob_abs_diff": logprob_diff / len(reference),
+    }
+
+
+def main(args):
+    model, tokenizer = load_model(
+        args.model_path,
+        args.device,
+        args.num_gpus,
+        args.max_gpu_memory,
+        args.load_8bit,
+        args.cpu_offloading,
+        sdpa_attn=args.sdpa_attn,
+        cpu_dtype=args.cpu_dtype,
+    )
+    generator = BatchGenerator(model, tokenizer, args.device, args)
+    texts = read_texts(args)
+    print(f"#texts: {len(texts)}")
+
+    reference = generator.generate(texts)
+    mean_tokens = sum(out["usage"]["total_tokens"] for out in reference) / len(
+        reference
+    )
+    config = model.config
+    num_heads = config.num_attention_heads
+    head_dim = config.hidden_size // num_heads
+    dtype = model.base_model.embed_tokens.weight.dtype
+
+    report = {"num_texts": len(texts), "mean_tokens": mean_tokens, "results": []}
+    for kv_dtype in args.kv_cache_dtypes:
+        enable_paged_kv_cache(
+            model, args.kv_cache_gb, block_size=args.kv_block_size, kv_dtype=kv_dtype
+        )
+        outputs = generator.generate(texts)
+        disable_paged_kv_cache(model)
+
+        bytes_per_token = kv_bytes_per_token(
+            config.num_hidden_layers, num_heads, head_dim, dtype, kv_dtype
+        )
+        result = {
+            "kv_dtype": kv_dtype,
+            "bytes_per_token": bytes_per_token,
+            "max_sequences": int(args.kv_cache_gb * GB / bytes_per_token / mean_tokens),
+            **compare(reference, outputs),
+        }
+        report["results"].append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as fout:
+            json.dump(report, fout, indent=2)
+
+    print(
+        f"\n{'kv dtype':<10}{'bytes/token':>12}{'max seqs':>10}"
+        f"{'exact':>8}{'fields':>8}"
+    )
+    for result in report["results"]:
+        field_match = result["field_match"]
+        field_match = "-" if field_match is None else f"{field_match:.3f}"
+        print(
+            f"{result['kv_dtype']:<10}{result['bytes_per_token']:>12}"
+            f"{result['max_sequences']:>10}{result['exact_match']:>8.3f}"
+            f"{field_match:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument(
+        "--input", type=str, required=True, help="A CSV or Parquet file"
+    )
+    parser.add_argument("--output", type=str, default=None, help="A JSON report")
+    parser.add_argument("--sep", type=str, default=",", help="The CSV separator")
+    parser.add_argument(
+        "--column", type=str, default="name", help="The input text column"
+    )
+    parser.add_argument("--conv-template", type=str, default=None)
+    parser.add_argument("--num-samples", type=int, default=500)
+    parser.add_argument(
+        "--kv-cache-dtypes", type=str, nargs="+", choices=KV_DTYPES, default=KV_DTYPES
+    )
+    parser.add_argument("--kv-cache-gb", type=float, default=4)
+    parser.add_argument("--kv-block-size", type=int, default=16)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    if args.gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    main(args)
@@ -0,0 +1,307 @@
+"""
+A torch.compile'd single-token decode step of LLaMA models.
+
+At batch size one, a decode step spends most of its time in Python and kernel
+launches. The compiled step runs the whole decoder on one token over a static
+KV buffer of max_len tokens, so all shapes stay constant between steps and the
+step compiles once. On CUDA, it is captured as a CUDA graph per slot and every
+step is a single replay.
+
+The buffers are split into a fixed number of slots, one per concurrent
+sequence. A request prefills with the regular Hugging Face cache, copies it
+into a free slot and decodes with StaticSequence in place of past_key_values.
+Without a free slot, or if the sequence may outgrow max_len, the request keeps
+the regular cache.
+
+The compiled kernels, and the compiled graphs where PyTorch supports it, are
+cached in cache_dir, so a restarted worker does not compile them again.
+"""
+import os
+import threading
+import time
+from typing import Optional
+
+import torch
+from transformers.models.llama.modeling_llama import (
+    LlamaAttention,
+    apply_rotary_pos_emb,
+)
+
+
+def set_compile_cache_dir(cache_dir: str):
+    """Keep the compiled artifacts of torch.compile in cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    import torch._inductor.config
+
+    if hasattr(torch._inductor.config, "fx_graph_cache"):
+        torch._inductor.config.fx_graph_cache = True
+
+
+class StaticKVSlot:
+    """The key and value buffers of one sequence, [1, nh, max_len, hd] per
+    layer, and the static inputs and output of its step."""
+
+    def __init__(self, num_layers, num_heads, head_dim, max_len, dtype, device):
+        shape = (1, num_heads, max_len, head_dim)
+        self.keys = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+        self.values = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+        self.input_ids = torch.zeros((1, 1), dtype=torch.int64, device=device)
+        self.position_ids = torch.zeros((1, 1), dtype=torch.int64, device=device)
+        self.graph = None
+        self.output = None
+
+
+def static_attention(attn, hidden_states, position_ids, key_buffer, value_buffer, mask):
+    bsz, q_len, _ = hidden_states.size()
+    query_states = (
+        attn.q_proj(hidden_states)
+        .view(bsz, q_len, attn.num_heads, attn.head_dim)
+        .transpose(1, 2)
+    )
+    key_states = (
+        attn.k_proj(hidden_states)
+        .view(bsz, q_len, attn.num_heads, attn.head_dim)
+        .transpose(1, 2)
+    )
+    value_states = (
+        attn.v_proj(hidden_states)
+        .view(bsz, q_len, attn.num_heads, attn.head_dim)
+        .transpose(1, 2)
+    )
+    # The whole cached table, indexed by position_ids, keeps the shapes static.
+    cos = attn.rotary_emb.cos_cached.to(query_states.dtype)
+    sin = attn.rotary_emb.sin_cached.to(query_states.dtype)
+    query_states, key_states = apply_rotary_pos_emb(
+        query_states, key_states, cos, sin, position_ids
+    )
+    position = position_ids.view(1)
+    key_buffer.index_copy_(2, position, key_states)
+    value_buffer.index_copy_(2, position, value_states)
+
+    attn_output = torch.nn.functional.scaled_dot_product_attention(
+        query_states, key_buffer, value_buffer, attn_mask=mask
+    )
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, attn.hidden_size)
+    return attn.o_proj(attn_output)
+
+
+def decode_hidden_states(base_model, keys, values, input_ids, position_ids):
+    """Run a LLaMA base model on one token at position_ids, writing its keys and
+    values into the buffers. Return the hidden states after the final norm."""
+    max_len = keys[0].shape[2]
+    mask = torch.arange(max_len, device=input_ids.device) <= position_ids.view(1)
+    mask = mask.view(1, 1, 1, max_len)
+
+    hidden_states = base_model.embed_tokens(input_ids)
+    for layer, key_buffer, value_buffer in zip(base_model.layers, keys, values):
+        residual = hidden_states
+        hidden_states = layer.input_layernorm(hidden_states)
+        hidden_states = static_attention(
+            layer.self_attn, hidden_states, position_ids, key_buffer, value_buffer, mask
+        )
+        hidden_states = residual + hidden_states
+
+        residual = hidden_states
+        hidden_states = layer.post_attention_layernorm(hidden_states)
+        hidden_states = residual + layer.mlp(hidden_states)
+    return base_model.norm(hidden_states)
+
+
+class StaticDecoder:
+    def __init__(self, model, max_len: int, num_slots: int = 1):
+        base_model = model.base_model
+        layers = getattr(base_model, "layers", [])
+        if not layers or not all(
+            isinstance(layer.self_attn, LlamaAttention) for layer in layers
+        ):
+            raise ValueError("The compiled decode step only supports LLaMA models")
+        devices = {layer.input_layernorm.weight.device for layer in layers}
+        if len(devices) != 1:
+            raise ValueError("The compiled decode step needs a model on one device")
+        self.device = devices.pop()
+
+        config = model.config
+        num_heads = config.num_attention_heads
+        head_dim = config.hidden_size // num_heads
+        dtype = base_model.embed_tokens.weight.dtype
+        max_len = min(max_len, layers[0].self_attn.rotary_emb.cos_cached.shape[2])
+        self.max_len = max_len
+        self.base_model = base_model
+        self.slots = [
+            StaticKVSlot(len(layers), num_heads, head_dim, max_len, dtype, self.device)
+            for _ in range(num_slots)
+        ]
+        self.free_slots = list(range(num_slots))
+        self.lock = threading.Lock()
+        # The slots share one graph, their buffers are inputs of the same shape.
+        self.step_fn = torch.compile(decode_hidden_states, dynamic=False)
+        self.stats = {
+            "compile_seconds": 0.0,
+            "sequences": 0,
+            "fallbacks": 0,
+            "decode_tokens": 0,
+            "decode_seconds": 0.0,
+        }
+
+    def run_slot(self, slot: StaticKVSlot):
+        return self.step_fn(
+            self.base_model, slot.keys, slot.values, slot.input_ids, slot.position_ids
+        )
+
+    @torch.inference_mode()
+    def warmup(self):
+        """Compile the step and, on CUDA, capture it as a CUDA graph per slot.
+        Return the time it took in seconds."""
+        tic = time.time()
+        if self.device.type != "cuda":
+            self.run_slot(self.slots[0])
+        else:
+            # Captured by hand rather than with mode="reduce-overhead", so any
+            # thread of the worker can replay the graphs.
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.run_slot(self.slots[0])
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for slot in self.slots:
+                slot.graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(slot.graph):
+                    slot.output = self.run_slot(slot)
+            torch.cuda.synchronize(self.device)
+        self.stats["compile_seconds"] = time.time() - tic
+        return self.stats["compile_seconds"]
+
+    def acquire(
+        self, past_key_values: tuple, max_new_tokens: int
+    ) -> Optional["StaticSequence"]:
+        """Copy a prefilled Hugging Face cache into a free slot, or return None
+        if there is none or the sequence may not fit."""
+        length = past_key_values[0][0].shape[2]
+        with self.lock:
+            if length + max_new_tokens > self.max_len or not self.free_slots:
+                self.stats["fallbacks"] += 1
+                return None
+            index = self.free_slots.pop()
+            self.stats["sequences"] += 1
+        slot = self.slots[index]
+        for (key, value), key_buffer, value_buffer in zip(
+            past_key_values, slot.keys, slot.values
+        ):
+            key_buffer[:, :, :length].copy_(key)
+            value_buffer[:, :, :length].copy_(value)
+        slot.position_ids.fill_(length)
+        return StaticSequence(self, index, length)
+
+    def release(self, index: int, num_tokens: int, seconds: float):
+        with self.lock:
+            self.free_slots.append(index)
+            self.stats["decode_tokens"] += num_tokens
+            self.stats["decode_seconds"] += seconds
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["slots"] = len(self.slots)
+            stats["free_slots"] = len(self.free_slots)
+        stats["decode_tokens_per_s"] = (
+            stats["decode_tokens"] / stats["decode_seconds"]
+            if stats["decode_seconds"]
+            else None
+        )
+        return stats
+
+
+class StaticSequence:
+    """A sequence in a slot of a StaticDecoder, used in place of the
+    past_key_values of the Hugging Face cache.
+
+    The slot is released when the object is garbage collected, e.g. when a
+    streaming request is abandoned halfway. The time from the second step to
+    the release counts as steady-state decode time.
+    """
+
+    def __init__(self, decoder: StaticDecoder, index: int, length: int):
+        self.decoder = decoder
+        self.index = index
+        self.length = length
+        self.num_steps = 0
+        self.start_time = None
+
+    def forward(self, model, head, input_ids):
+        """Run the compiled step on the next token and return
+        (self, logits of shape [1, 1, vocab])."""
+        if input_ids.shape != (1, 1):
+            raise ValueError("The compiled decode step takes a single token")
+        if self.length >= self.decoder.max_len:
+            raise ValueError("The sequence is longer than the static KV buffer")
+        if self.num_steps == 1:
+            self.start_time = time.time()
+        slot = self.decoder.slots[self.index]
+        slot.input_ids.copy_(input_ids)
+        if slot.graph is not None:
+            slot.graph.replay()
+            # The output is overwritten by the next replay.
+            hidden_states = slot.output.clone()
+        else:
+            hidden_states = self.decoder.run_slot(slot)
+        slot.position_ids.add_(1)
+        self.length += 1
+        self.num_steps += 1
+        return self, head(hidden_states)
+
+    def to_tuple(self) -> tuple:
+        """A copy of the cache in the Hugging Face format."""
+        slot = self.decoder.slots[self.index]
+        return tuple(
+            (key[:, :, : self.length].clone(), value[:, :, : self.length].clone())
+            for key, value in zip(slot.keys, slot.values)
+        )
+
+    def free(self):
+        if self.index is not None:
+            if self.start_time is None:
+                num_tokens, seconds = 0, 0.0
+            else:
+                num_tokens = self.num_steps - 1
+                seconds = time.time() - self.start_time
+            self.decoder.release(self.index, num_tokens, seconds)
+            self.index = None
+
+    def __del__(self):
+        self.free()
+
+
+def enable_compiled_decode(
+    model,
+    max_len: int,
+    num_slots: int = 1,
+    cache_dir: Optional[str] = None,
+) -> StaticDecoder:
+    """Compile the decode step of a LLaMA model for sequences of up to max_len
+    tokens and attach it as model.static_decoder."""
+    if not hasattr(torch, "compile"):
+        raise ValueError("The compiled decode step requires torch>=2.0")
+    if cache_dir is not None:
+        set_compile_cache_dir(cache_dir)
+    decoder = StaticDecoder(model, max_len, num_slots)
+    decoder.warmup()
+    model.static_decoder = decoder
+    return decoder
+
+
+def acquire_static_sequence(
+    model, past_key_values, max_new_tokens: int
+) -> Optional[StaticSequence]:
+    """Move a prefilled cache into the static decoder of the model, or return
+    None if it has none or no slot fits."""
+    decoder = getattr(model, "static_decoder", None)
+    if decoder is None or not isinstance(past_key_values, tuple):
+        return None
+    return decoder.acquire(past_key_values, max_new_tokens)
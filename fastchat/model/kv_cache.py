@@ -0,0 +1,689 @@
+"""
+A paged KV cache for LLaMA models.
+
+Keys and values are stored in fixed-size blocks of a preallocated pool instead
+of one contiguous tensor per request, so requests of different lengths do not
+fragment memory and a sequence only holds the blocks it has filled. Every
+sequence has a block table. Forked sequences share their blocks, which are
+reference counted and copied on the first write into a shared block. When the
+device pool runs out, the least recently used sequences that are not part of
+the current forward pass are swapped out to a pool in host memory, and swapped
+back in on their next step.
+
+With kv_dtype="int8", keys and values are stored as int8 with one scale per
+token and head, and dequantized when the attention gathers them. This halves
+the memory per token of a float16 cache, up to the small overhead of the scales.
+
+The patched attention writes the new keys and values into their slots and
+gathers the blocks of the batch, so no custom kernels are needed. With
+dense_views=True, every batch of sequences also keeps the gathered keys and
+values between steps and only appends the new tokens to them, which saves the
+gather of every layer on every step at the cost of a contiguous copy of the
+cache of the running sequences.
+
+The step in progress is per thread, so forward passes of the same model that
+do not use the paged cache, e.g. for embeddings, may run in other threads. The
+lock of the cache is only held while a step changes the block tables, not
+during the forward pass; the sequences of a running step are never swapped out.
+
+Usage:
+    cache = enable_paged_kv_cache(model, memory_gb=8, host_memory_gb=16)
+    cache = enable_paged_kv_cache(model, memory_gb=8, kv_dtype="int8")
+    past_key_values = cache.new_sequences(batch_size)
+    # Pass past_key_values to prefill/forward_last_logits in fastchat.serve.inference
+"""
+import contextlib
+import math
+import threading
+import types
+from typing import Dict, List, Optional
+
+import torch
+from transformers.models.llama.modeling_llama import (
+    LlamaAttention,
+    apply_rotary_pos_emb,
+    rotate_half,
+)
+
+GB = 1 << 30
+KV_DTYPES = ["auto", "int8"]
+# Dense views grow by this many tokens at a time.
+DENSE_VIEW_CHUNK = 256
+
+
+def quantize_int8(x):
+    """Symmetric int8 quantization with one scale per vector of the last dimension.
+    Return (int8 values, scales of the dtype of x)."""
+    scale = (x.float().abs().amax(dim=-1) / 127).to(x.dtype)
+    values = x.float() / scale.float().clamp(min=1e-8).unsqueeze(-1)
+    return values.round().clamp(-127, 127).to(torch.int8), scale
+
+
+def dequantize_int8(values, scale):
+    return values.to(scale.dtype) * scale.unsqueeze(-1)
+
+
+class BlockAllocator:
+    """A free list of block ids with reference counts."""
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.ref_counts = [0] * num_blocks
+
+    @property
+    def num_free(self) -> int:
+        return len(self.free_blocks)
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise RuntimeError("Out of KV cache blocks")
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def incref(self, block: int):
+        self.ref_counts[block] += 1
+
+    def decref(self, block: int):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+
+class DenseView:
+    """The keys and values of a batch of sequences gathered from the pool, per
+    layer [batch, capacity, heads, head_dim], and the length of every row."""
+
+    def __init__(self, num_layers: int):
+        self.keys = [None] * num_layers
+        self.values = [None] * num_layers
+        self.lens = None
+
+    def append(self, layer, key_states, value_states, position_ids, kv_len):
+        """Write the new tokens, [batch, tokens, heads, head_dim], at their
+        positions and return the keys and values up to kv_len."""
+        outputs = []
+        for buffers, states in ((self.keys, key_states), (self.values, value_states)):
+            buffer = buffers[layer]
+            if buffer.shape[1] < kv_len:
+                capacity = math.ceil(kv_len / DENSE_VIEW_CHUNK) * DENSE_VIEW_CHUNK
+                grown = buffer.new_zeros((buffer.shape[0], capacity, *buffer.shape[2:]))
+                grown[:, : buffer.shape[1]] = buffer
+                buffer = buffers[layer] = grown
+            rows = torch.arange(buffer.shape[0], device=buffer.device)[:, None]
+            buffer[rows, position_ids] = states.to(buffer.dtype)
+            outputs.append(buffer[:, :kv_len])
+        return outputs
+
+    def fill(self, layer, keys, values, kv_len):
+        """Start the view from fully gathered keys and values."""
+        for buffers, states in ((self.keys, keys), (self.values, values)):
+            capacity = math.ceil(kv_len / DENSE_VIEW_CHUNK) * DENSE_VIEW_CHUNK
+            buffer = states.new_zeros((states.shape[0], capacity, *states.shape[2:]))
+            buffer[:, :kv_len] = states[:, :kv_len]
+            buffers[layer] = buffer
+
+
+class StepState:
+    """The write slots, block tables and attention mask of one forward pass
+    that appends num_tokens tokens to every sequence of a batch."""
+
+    def __init__(self, cache, seq_ids: List[int], past_lens: List[int], num_tokens):
+        block_size = cache.block_size
+        tables = [cache.block_tables[seq_id] for seq_id in seq_ids]
+        max_blocks = max(len(table) for table in tables)
+        self.tables = torch.as_tensor(
+            [table + [0] * (max_blocks - len(table)) for table in tables]
+        )
+        # [batch, num_tokens]
+        self.position_ids = torch.as_tensor(past_lens)[:, None] + torch.arange(
+            num_tokens
+        )
+        blocks = self.tables.gather(1, self.position_ids // block_size)
+        self.slots = (blocks * block_size + self.position_ids % block_size).flatten()
+        self.kv_len = max(past_lens) + num_tokens
+        # A query sees the keys up to its own position; this also hides the
+        # slots past the end of shorter sequences.
+        visible = torch.arange(self.kv_len)[None, None, :] <= self.position_ids[
+            :, :, None
+        ]
+        self.mask = torch.zeros(visible.shape, dtype=cache.dtype).masked_fill(
+            ~visible, torch.finfo(cache.dtype).min
+        )[:, None]
+        self.on_device = {}
+        # The dense view to append to, and whether it must be gathered first.
+        self.view = None
+        self.fill_view = False
+
+    def to(self, device):
+        if device not in self.on_device:
+            self.on_device[device] = (
+                self.slots.to(device),
+                self.tables.to(device),
+                self.mask.to(device),
+                self.position_ids.to(device),
+            )
+        return self.on_device[device]
+
+
+class PagedKVCache:
+    def __init__(
+        self,
+        num_layers: int,
+        num_heads: int,
+        head_dim: int,
+        num_blocks: int,
+        num_host_blocks: int = 0,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float16,
+        devices: Optional[List[torch.device]] = None,
+        kv_dtype: str = "auto",
+        dense_views: bool = False,
+    ):
+        if kv_dtype not in KV_DTYPES:
+            raise ValueError(f"Invalid KV cache dtype: {kv_dtype}")
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.block_size = block_size
+        self.dtype = dtype
+        self.kv_dtype = kv_dtype
+        self.quantized = kv_dtype == "int8"
+        self.dense_views = dense_views
+        # One device per layer, to follow models split across GPUs.
+        self.devices = devices or [torch.device("cuda")] * num_layers
+
+        pin_memory = torch.cuda.is_available()
+
+        def make_pools(n, shape, pool_dtype, host=False):
+            return [
+                torch.zeros(
+                    (n, block_size, *shape),
+                    dtype=pool_dtype,
+                    device="cpu" if host else device,
+                    pin_memory=host and pin_memory,
+                )
+                for device in self.devices
+            ]
+
+        # Every pool is indexed by block id first, so the scales of a block
+        # move along with its values.
+        self.pools, self.host_pools = [], []
+        for host, pools in ((False, self.pools), (True, self.host_pools)):
+            n = num_host_blocks if host else num_blocks
+            value_dtype = torch.int8 if self.quantized else dtype
+            # Keys, then values.
+            pools.append(make_pools(n, (num_heads, head_dim), value_dtype, host))
+            pools.append(make_pools(n, (num_heads, head_dim), value_dtype, host))
+            if self.quantized:
+                pools.append(make_pools(n, (num_heads,), dtype, host))
+                pools.append(make_pools(n, (num_heads,), dtype, host))
+        self.allocator = BlockAllocator(num_blocks)
+        self.host_allocator = BlockAllocator(num_host_blocks)
+
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+        self.swapped = set()
+        # The sequences of the steps whose forward pass is running.
+        self.running = set()
+        self.last_used: Dict[int, int] = {}
+        self.clock = 0
+        self.next_seq_id = 0
+        self.stats = {"swap_outs": 0, "swap_ins": 0, "copy_on_writes": 0}
+        # Guards the block tables and the allocators.
+        self.lock = threading.RLock()
+        # The StepState of the forward pass running in each thread.
+        self.local = threading.local()
+
+    @property
+    def active(self) -> Optional[StepState]:
+        return getattr(self.local, "state", None)
+
+    def new_sequences(self, batch_size: int) -> "PagedSequences":
+        return PagedSequences(self, [self.add_sequence() for _ in range(batch_size)])
+
+    def add_sequence(self) -> int:
+        with self.lock:
+            seq_id = self.next_seq_id
+            self.next_seq_id += 1
+            self.block_tables[seq_id] = []
+            self.seq_lens[seq_id] = 0
+            self.touch(seq_id)
+            return seq_id
+
+    def fork(self, seq_id: int) -> int:
+        """Create a sequence that shares all the tokens of seq_id."""
+        with self.lock:
+            child = self.add_sequence()
+            allocator = self.allocator_of(seq_id)
+            for block in self.block_tables[seq_id]:
+                allocator.incref(block)
+            self.block_tables[child] = list(self.block_tables[seq_id])
+            self.seq_lens[child] = self.seq_lens[seq_id]
+            if seq_id in self.swapped:
+                self.swapped.add(child)
+            return child
+
+    def free(self, seq_id: int):
+        with self.lock:
+            allocator = self.allocator_of(seq_id)
+            for block in self.block_tables.pop(seq_id):
+                allocator.decref(block)
+            del self.seq_lens[seq_id]
+            del self.last_used[seq_id]
+            self.swapped.discard(seq_id)
+
+    def touch(self, seq_id: int):
+        self.clock += 1
+        self.last_used[seq_id] = self.clock
+
+    def allocator_of(self, seq_id: int) -> BlockAllocator:
+        return self.host_allocator if seq_id in self.swapped else self.allocator
+
+    def copy_blocks(self, src_pools, dst_pools, src: List[int], dst: List[int]):
+        if not src:
+            return
+        src_pools = [pool for pools in src_pools for pool in pools]
+        dst_pools = [pool for pools in dst_pools for pool in pools]
+        for src_pool, dst_pool in zip(src_pools, dst_pools):
+            src_ids = torch.as_tensor(src, device=src_pool.device)
+            dst_ids = torch.as_tensor(dst, device=dst_pool.device)
+            dst_pool[dst_ids] = src_pool[src_ids].to(dst_pool.device)
+
+    def move(self, seq_id: int, to_host: bool):
+        """Move the blocks of a sequence between the device and host pools.
+        Blocks that are still used by other sequences are copied."""
+        if to_host:
+            src_alloc, dst_alloc = self.allocator, self.host_allocator
+            src_pools, dst_pools = self.pools, self.host_pools
+        else:
+            src_alloc, dst_alloc = self.host_allocator, self.allocator
+            src_pools, dst_pools = self.host_pools, self.pools
+
+        table = self.block_tables[seq_id]
+        if dst_alloc.num_free < len(table):
+            where = "host" if to_host else "device"
+            raise RuntimeError(f"Out of {where} KV cache blocks to swap a sequence")
+        new_table = [dst_alloc.allocate() for _ in table]
+        self.copy_blocks(src_pools, dst_pools, table, new_table)
+        for block in table:
+            src_alloc.decref(block)
+        self.block_tables[seq_id] = new_table
+        if to_host:
+            self.swapped.add(seq_id)
+            self.stats["swap_outs"] += 1
+        else:
+            self.swapped.discard(seq_id)
+            self.stats["swap_ins"] += 1
+
+    def make_room(self, num_blocks: int, keep):
+        """Swap out the least recently used sequences outside keep and the
+        running steps until num_blocks device blocks are free."""
+        while self.allocator.num_free < num_blocks:
+            # A copy, since the garbage collection of PagedSequences may free
+            # sequences while the list is built.
+            victims = [
+                seq_id
+                for seq_id, table in list(self.block_tables.items())
+                if table
+                and seq_id not in self.swapped
+                and seq_id not in keep
+                and seq_id not in self.running
+            ]
+            if not victims:
+                raise RuntimeError(
+                    f"Out of KV cache blocks: {num_blocks} needed, "
+                    f"{self.allocator.num_free} free"
+                )
+            self.move(min(victims, key=self.last_used.get), to_host=True)
+
+    def blocks_needed(self, seq_id: int, num_tokens: int) -> int:
+        table = self.block_tables[seq_id]
+        seq_len = self.seq_lens[seq_id]
+        needed = math.ceil((seq_len + num_tokens) / self.block_size) - len(table)
+        if self.is_shared_tail(seq_id):
+            needed += 1
+        return needed
+
+    def is_shared_tail(self, seq_id: int) -> bool:
+        """Whether the next token goes into a partially filled shared block."""
+        table = self.block_tables[seq_id]
+        return (
+            self.seq_lens[seq_id] % self.block_size != 0
+            and self.allocator.ref_counts[table[-1]] > 1
+        )
+
+    def append_slots(self, seq_id: int, num_tokens: int):
+        table = self.block_tables[seq_id]
+        if self.is_shared_tail(seq_id):
+            block = self.allocator.allocate()
+            self.copy_blocks(self.pools, self.pools, [table[-1]], [block])
+            self.allocator.decref(table[-1])
+            table[-1] = block
+            self.stats["copy_on_writes"] += 1
+        while len(table) * self.block_size < self.seq_lens[seq_id] + num_tokens:
+            table.append(self.allocator.allocate())
+        self.seq_lens[seq_id] += num_tokens
+
+    @contextlib.contextmanager
+    def step(self, seq_ids: List[int], num_tokens: int, owner=None):
+        """Append num_tokens tokens to every sequence for one forward pass of the
+        patched model, and yield their position ids. With dense views, the view
+        of the PagedSequences owner is appended to."""
+        with self.lock:
+            keep = set(seq_ids)
+            for seq_id in seq_ids:
+                if seq_id in self.swapped:
+                    self.make_room(len(self.block_tables[seq_id]), keep)
+                    self.move(seq_id, to_host=False)
+            self.make_room(
+                sum(self.blocks_needed(seq_id, num_tokens) for seq_id in seq_ids),
+                keep,
+            )
+            past_lens = [self.seq_lens[seq_id] for seq_id in seq_ids]
+            for seq_id in seq_ids:
+                self.append_slots(seq_id, num_tokens)
+                self.touch(seq_id)
+            state = StepState(self, seq_ids, past_lens, num_tokens)
+            if self.dense_views and owner is not None:
+                # The view misses the tokens written through other objects,
+                # e.g. the rows prefilled one by one with select().
+                if owner.view is None or owner.view.lens != past_lens:
+                    owner.view = DenseView(self.num_layers)
+                    state.fill_view = True
+                state.view = owner.view
+                owner.view.lens = None
+            self.running.update(seq_ids)
+        self.local.state = state
+        try:
+            yield state.position_ids.to(self.devices[0])
+        finally:
+            self.local.state = None
+            with self.lock:
+                self.running.difference_update(seq_ids)
+        if state.view is not None:
+            state.view.lens = [n + num_tokens for n in past_lens]
+
+    def update(self, layer: int, key_states, value_states):
+        """Write the keys and values of the current step, [batch, heads, tokens,
+        head_dim], and return all keys and values of its sequences, [batch,
+        heads, kv_len, head_dim], together with the attention mask."""
+        state = self.active
+        slots, tables, mask, position_ids = state.to(key_states.device)
+        append_view = state.view is not None and not state.fill_view
+        outputs = []
+        new_states = []
+        for i, states in enumerate((key_states, value_states)):
+            pool = self.pools[i][layer]
+            states = states.transpose(1, 2).reshape(-1, self.num_heads, self.head_dim)
+            if self.quantized:
+                scale_pool = self.pools[i + 2][layer]
+                states, scale = quantize_int8(states)
+                scale_pool.view(-1, self.num_heads).index_copy_(0, slots, scale)
+            pool.view(-1, self.num_heads, self.head_dim).index_copy_(
+                0, slots, states.to(pool.dtype)
+            )
+            if append_view:
+                if self.quantized:
+                    states = dequantize_int8(states, scale)
+                new_states.append(states.view(*position_ids.shape, *states.shape[1:]))
+                continue
+            gathered = pool[tables]
+            if self.quantized:
+                gathered = dequantize_int8(gathered, scale_pool[tables])
+            gathered = gathered.view(tables.shape[0], -1, self.num_heads, self.head_dim)
+            outputs.append(gathered[:, : state.kv_len])
+        if append_view:
+            outputs = state.view.append(layer, *new_states, position_ids, state.kv_len)
+        elif state.view is not None:
+            state.view.fill(layer, outputs[0], outputs[1], state.kv_len)
+        return outputs[0].transpose(1, 2), outputs[1].transpose(1, 2), mask
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "kv_dtype": self.kv_dtype,
+                "block_size": self.block_size,
+                "num_blocks": self.allocator.num_blocks,
+                "num_free_blocks": self.allocator.num_free,
+                "num_host_blocks": self.host_allocator.num_blocks,
+                "num_free_host_blocks": self.host_allocator.num_free,
+                "num_sequences": len(self.block_tables),
+                "num_swapped": len(self.swapped),
+                **self.stats,
+            }
+
+
+class PagedSequences:
+    """A batch of sequences in a PagedKVCache, used in place of the
+    past_key_values of the Hugging Face cache.
+
+    The sequences are freed when the object is garbage collected, e.g. when a
+    streaming request is abandoned halfway.
+    """
+
+    def __init__(self, cache: PagedKVCache, seq_ids: List[int], owner: bool = True):
+        self.cache = cache
+        self.seq_ids = seq_ids
+        self.owner = owner
+        # The DenseView of the sequences if the cache keeps them.
+        self.view = None
+
+    def select(self, indices: List[int]) -> "PagedSequences":
+        """A view of some rows of the batch, e.g. to prefill them one by one."""
+        return PagedSequences(self.cache, [self.seq_ids[i] for i in indices], False)
+
+    def fork(self) -> "PagedSequences":
+        """New sequences that share the tokens of these ones."""
+        return PagedSequences(
+            self.cache, [self.cache.fork(seq_id) for seq_id in self.seq_ids]
+        )
+
+    def forward(self, model, head, input_ids):
+        """Run the model on the next tokens of every sequence and return
+        (self, logits of the last position)."""
+        # Views of rows, e.g. for a prefill one by one, keep no dense view.
+        owner = self if self.owner else None
+        with self.cache.step(self.seq_ids, input_ids.shape[1], owner) as position_ids:
+            if head is None:
+                out = model(
+                    input_ids=input_ids, position_ids=position_ids, use_cache=False
+                )
+                logits = out.logits[:, -1:, :]
+            else:
+                out = model.base_model(
+                    input_ids=input_ids, position_ids=position_ids, use_cache=False
+                )
+                logits = head(out[0][:, -1:, :])
+        return self, logits
+
+    def free(self):
+        if self.owner:
+            self.owner = False
+            self.view = None
+            for seq_id in self.seq_ids:
+                self.cache.free(seq_id)
+
+    def __del__(self):
+        self.free()
+
+
+def paged_attention_forward(
+    self,
+    hidden_states: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.LongTensor] = None,
+    past_key_value=None,
+    output_attentions: bool = False,
+    use_cache: bool = False,
+):
+    cache = self.paged_kv_cache
+    if cache.active is None:
+        return LlamaAttention.forward(
+            self,
+            hidden_states,
+            attention_mask,
+            position_ids,
+            past_key_value,
+            output_attentions,
+            use_cache,
+        )
+
+    bsz, q_len, _ = hidden_states.size()
+    query_states = (
+        self.q_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    key_states = (
+        self.k_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    value_states = (
+        self.v_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    cos, sin = self.rotary_emb(value_states, seq_len=cache.active.kv_len)
+    query_states, key_states = apply_rotary_pos_emb(
+        query_states, key_states, cos, sin, position_ids
+    )
+    # The mask of the step replaces the attention_mask built by the model.
+    key_states, value_states, mask = cache.update(
+        self.layer_idx, key_states, value_states
+    )
+
+    attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(
+        self.head_dim
+    )
+    attn_weights = attn_weights + mask.to(attn_weights.dtype)
+    # upcast attention to fp32
+    attn_weights = torch.nn.functional.softmax(
+        attn_weights, dim=-1, dtype=torch.float32
+    ).to(query_states.dtype)
+    attn_output = torch.matmul(attn_weights, value_states)
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
+    return self.o_proj(attn_output), None, None
+
+
+def kv_bytes_per_token(
+    num_layers: int, num_heads: int, head_dim: int, dtype, kv_dtype: str = "auto"
+) -> int:
+    element_size = torch.empty((), dtype=dtype).element_size()
+    if kv_dtype == "int8":
+        # One int8 per element and one scale per head.
+        return 2 * num_layers * num_heads * (head_dim + element_size)
+    return 2 * num_layers * num_heads * head_dim * element_size
+
+
+def enable_paged_kv_cache(
+    model,
+    memory_gb: float,
+    host_memory_gb: float = 0,
+    block_size: int = 16,
+    kv_dtype: str = "auto",
+    dense_views: bool = False,
+) -> PagedKVCache:
+    """Allocate a paged KV cache of memory_gb and patch the attention of a
+    LLaMA model to use it whenever it runs on PagedSequences. Dense views take
+    memory beyond memory_gb."""
+    layers = getattr(model.base_model, "layers", [])
+    attns = [layer.self_attn for layer in layers]
+    if not attns or not all(isinstance(attn, LlamaAttention) for attn in attns):
+        raise ValueError("The paged KV cache only supports LLaMA models")
+
+    config = model.config
+    num_heads = config.num_attention_heads
+    head_dim = config.hidden_size // num_heads
+    dtype = model.base_model.embed_tokens.weight.dtype
+    block_bytes = block_size * kv_bytes_per_token(
+        len(attns), num_heads, head_dim, dtype, kv_dtype
+    )
+    cache = PagedKVCache(
+        len(attns),
+        num_heads,
+        head_dim,
+        int(memory_gb * GB // block_bytes),
+        int(host_memory_gb * GB // block_bytes),
+        block_size,
+        dtype,
+        # Linear weights may be compressed, the norms never are.
+        [layer.input_layernorm.weight.device for layer in layers],
+        kv_dtype,
+        dense_views,
+    )
+    for i, attn in enumerate(attns):
+        attn.layer_idx = i
+        attn.paged_kv_cache = cache
+        attn.forward = types.MethodType(paged_attention_forward, attn)
+    model.paged_kv_cache = cache
+    return cache
+
+
+def disable_paged_kv_cache(model):
+    """Restore the attention of a model patched by enable_paged_kv_cache and
+    release its cache."""
+    for layer in model.base_model.layers:
+        attn = layer.self_attn
+        if "paged_kv_cache" in attn.__dict__:
+            del attn.forward, attn.paged_kv_cache, attn.layer_idx
+    del model.paged_kv_cache
+
+
+def shift_rotary_positions(key, inv_freq, shift: int):
+    """Move rotary embedded keys by shift positions."""
+    freqs = shift * inv_freq.float().to(key.device)
+    emb = torch.cat((freqs, freqs))
+    key = key.float()
+    return key * emb.cos() + rotate_half(key) * emb.sin()
+
+
+class AttentionSinkWindow:
+    """Cut a Hugging Face LLaMA KV cache to its first num_sinks tokens, the
+    attention sinks, and its most recent tokens, window tokens in total.
+
+    The cache never grows beyond window tokens however long the conversation
+    gets. The kept keys are rotated back by the number of evicted tokens, so the
+    positions in the cache stay contiguous and the next token gets the cache
+    length as its position, as the model computes it. The cache is cut by
+    evict_size tokens more than needed, so the rotation runs once in a while.
+    """
+
+    def __init__(self, model, num_sinks: int, window: int, evict_size: int = 64):
+        layers = getattr(model.base_model, "layers", [])
+        attns = [layer.self_attn for layer in layers]
+        if not attns or not all(isinstance(attn, LlamaAttention) for attn in attns):
+            raise ValueError("Attention sinks only support LLaMA models")
+        if window <= num_sinks + evict_size:
+            raise ValueError(
+                f"The KV window {window} must exceed {num_sinks + evict_size} tokens"
+            )
+        self.num_sinks = num_sinks
+        self.window = window
+        self.evict_size = evict_size
+        self.inv_freqs = [attn.rotary_emb.inv_freq for attn in attns]
+
+    def __call__(self, past_key_values):
+        length = past_key_values[0][0].shape[2]
+        if length <= self.window:
+            return past_key_values
+        num_evicted = length - self.window + self.evict_size
+        start = self.num_sinks + num_evicted
+        cut = []
+        for (key, value), inv_freq in zip(past_key_values, self.inv_freqs):
+            recent = shift_rotary_positions(key[:, :, start:], inv_freq, -num_evicted)
+            cut.append(
+                (
+                    torch.cat([key[:, :, : self.num_sinks], recent.to(key.dtype)], 2),
+                    torch.cat([value[:, :, : self.num_sinks], value[:, :, start:]], 2),
+                )
+            )
+        return tuple(cut)
+
+
+def new_paged_sequences(model, batch_size: int) -> Optional[PagedSequences]:
+    """New sequences in the paged KV cache of the model, or None if it has none."""
+    cache = getattr(model, "paged_kv_cache", None)
+    return None if cache is None else cache.new_sequences(batch_size)
@@ -0,0 +1,146 @@
+"""
+Monkey patch the llama attention in the huggingface/transformers library to use
+torch.nn.functional.scaled_dot_product_attention for inference.
+
+PyTorch picks the fastest kernel available on the device (flash, memory
+efficient or the math fallback on CPU). The Hugging Face KV cache and the
+padding masks of batched decode are supported as is.
+
+The flash kernel takes no explicit mask, so the model only builds its 4D mask
+if some row is padded. Otherwise a prefill runs with is_causal=True and a
+single-token decode step without a mask.
+"""
+from typing import Optional, Tuple
+
+import torch
+import transformers
+from transformers.models.llama.modeling_llama import (
+    LlamaAttention,
+    LlamaModel,
+    _make_causal_mask,
+    apply_rotary_pos_emb,
+)
+
+original_forward = LlamaAttention.forward
+original_prepare_decoder_attention_mask = LlamaModel._prepare_decoder_attention_mask
+
+
+def prepare_decoder_attention_mask(
+    self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+):
+    """No mask without padding, see forward."""
+    if attention_mask is None or bool(attention_mask.all()):
+        return None
+    return original_prepare_decoder_attention_mask(
+        self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+    )
+
+
+def to_sdpa_mask(attention_mask: torch.Tensor, dtype) -> torch.Tensor:
+    """Turn the additive [bsz, 1, q_len, kv_len] mask of the model into a
+    boolean one. Query rows that may not attend to anything, i.e. left padding,
+    attend to every key instead, which keeps their outputs finite. The outputs
+    of these rows are never used, since padding is masked out as a key."""
+    mask = attention_mask > torch.finfo(dtype).min / 2
+    return mask | ~mask.any(dim=-1, keepdim=True)
+
+
+def forward(
+    self,
+    hidden_states: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.LongTensor] = None,
+    past_key_value: Optional[Tuple[torch.Tensor]] = None,
+    output_attentions: bool = False,
+    use_cache: bool = False,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+    if output_attentions:
+        # The fused kernels do not return the attention weights.
+        if attention_mask is None and hidden_states.shape[1] > 1:
+            past_len = 0 if past_key_value is None else past_key_value[0].shape[-2]
+            attention_mask = _make_causal_mask(
+                hidden_states.shape[:2],
+                hidden_states.dtype,
+                device=hidden_states.device,
+                past_key_values_length=past_len,
+            )
+        return original_forward(
+            self,
+            hidden_states,
+            attention_mask,
+            position_ids,
+            past_key_value,
+            output_attentions,
+            use_cache,
+        )
+
+    bsz, q_len, _ = hidden_states.size()
+
+    query_states = (
+        self.q_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    key_states = (
+        self.k_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    value_states = (
+        self.v_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+
+    kv_seq_len = key_states.shape[-2]
+    if past_key_value is not None:
+        kv_seq_len += past_key_value[0].shape[-2]
+    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+    query_states, key_states = apply_rotary_pos_emb(
+        query_states, key_states, cos, sin, position_ids
+    )
+    # [bsz, nh, t, hd]
+
+    if past_key_value is not None:
+        # reuse k, v, self_attention
+        key_states = torch.cat([past_key_value[0], key_states], dim=2)
+        value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+    past_key_value = (key_states, value_states) if use_cache else None
+
+    if attention_mask is not None:
+        if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+            raise ValueError(
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, "
+                f"but is {attention_mask.size()}"
+            )
+        attention_mask = to_sdpa_mask(attention_mask, attention_mask.dtype)
+        attn_output = torch.nn.functional.scaled_dot_product_attention(
+            query_states, key_states, value_states, attn_mask=attention_mask
+        )
+    elif q_len == 1 or q_len == kv_seq_len:
+        # No padding: a decode step sees every key, a prefill is causal.
+        attn_output = torch.nn.functional.scaled_dot_product_attention(
+            query_states, key_states, value_states, is_causal=q_len > 1
+        )
+    else:
+        # A prefill chunk after cached tokens. is_causal would align the
+        # queries with the first keys instead of the last ones.
+        causal_mask = torch.ones(
+            q_len, kv_seq_len, dtype=torch.bool, device=query_states.device
+        ).tril(kv_seq_len - q_len)
+        attn_output = torch.nn.functional.scaled_dot_product_attention(
+            query_states, key_states, value_states, attn_mask=causal_mask
+        )
+
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
+    attn_output = self.o_proj(attn_output)
+
+    return attn_output, None, past_key_value
+
+
+def replace_llama_attn_with_sdpa():
+    if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        raise ValueError("SDPA attention requires torch>=2.0")
+    transformers.models.llama.modeling_llama.LlamaAttention.forward = forward
+    LlamaModel._prepare_decoder_attention_mask = prepare_decoder_attention_mask
@@ -23,12 +23,15 @@ from transformers import (
     T5Tokenizer,
 )
 
-from fastchat.conversation import Conversation, get_conv_template
+from fastchat.conversation import Conversation, conv_templates, get_conv_template
+from fastchat.model.compiled_decode import enable_compiled_decode
 from fastchat.model.compression import load_compress_model
+from fastchat.model.llama_sdpa_monkey_patch import replace_llama_attn_with_sdpa
+from fastchat.model.shared_weights import load_shared_model
 from fastchat.model.monkey_patch_non_inplace import (
     replace_llama_attn_with_non_inplace_operations,
 )
-from fastchat.utils import get_gpu_memory
+from fastchat.utils import cpu_supports_bf16, get_gpu_memory
 
 
 class BaseAdapter:
@@ -47,6 +50,12 @@ class BaseAdapter:
     def get_default_conv_template(self, model_path: str) -> Conversation:
         return get_conv_template("one_shot")
 
+    def get_attention_sinks(self, model_path: str) -> Optional[int]:
+        """The number of initial tokens to keep when the KV cache is cut to a
+        rolling window (see AttentionSinkWindow), or None if the model does not
+        support it."""
+        return None
+
 
 # A global registry for all model adapters
 model_adapters: List[BaseAdapter] = []
@@ -92,6 +101,23 @@ def raise_warning_for_incompatible_cpu_offloading_configuration(
     return cpu_offloading
 
 
+CPU_DTYPES = ["float32", "bfloat16", "int8"]
+
+
+def get_cpu_torch_dtype(cpu_dtype: str):
+    """The dtype to load the weights in for a --cpu-dtype."""
+    if cpu_dtype not in CPU_DTYPES:
+        raise ValueError(f"Invalid cpu dtype: {cpu_dtype}")
+    if cpu_dtype == "bfloat16":
+        if cpu_supports_bf16():
+            return torch.bfloat16
+        warnings.warn(
+            "The CPU has no native bfloat16 support. Continuing with float32."
+        )
+    # int8 quantizes float32 weights after loading.
+    return torch.float32
+
+
 def load_model(
     model_path: str,
     device: str,
@@ -100,15 +126,27 @@ def load_model(
     load_8bit: bool = False,
     cpu_offloading: bool = False,
     debug: bool = False,
+    sdpa_attn: bool = False,
+    compile_decode: bool = False,
+    compile_slots: int = 1,
+    compile_cache_dir: Optional[str] = None,
+    cpu_dtype: str = "float32",
+    shared_weights: Optional[str] = None,
 ):
     """Load a model from Hugging Face."""
+    if shared_weights and (device != "cpu" or load_8bit or cpu_dtype == "int8"):
+        raise ValueError("Shared weights need unquantized weights on the cpu device")
+    if cpu_dtype != "float32" and device != "cpu":
+        raise ValueError("cpu_dtype only applies to the cpu device")
+    if cpu_dtype == "int8" and load_8bit:
+        raise ValueError("The int8 cpu dtype does not work with 8-bit compression")
 
     # Handle device mapping
     cpu_offloading = raise_warning_for_incompatible_cpu_offloading_configuration(
         device, load_8bit, cpu_offloading
     )
     if device == "cpu":
-        kwargs = {"torch_dtype": torch.float32}
+        kwargs = {"torch_dtype": get_cpu_torch_dtype(cpu_dtype)}
     elif device == "cuda":
         kwargs = {"torch_dtype": torch.float16}
         if num_gpus != 1:
@@ -131,6 +169,10 @@ def load_model(
     else:
         raise ValueError(f"Invalid device: {device}")
 
+    if sdpa_attn:
+        # Only affects LLaMA models. SDPA has no in-place operations either.
+        replace_llama_attn_with_sdpa()
+
     if cpu_offloading:
         # raises an error on incompatible platforms
         from transformers import BitsAndBytesConfig
@@ -155,11 +197,39 @@ def load_model(
 
     # Load model
     adapter = get_model_adapter(model_path)
-    model, tokenizer = adapter.load_model(model_path, kwargs)
+    if shared_weights:
+        # Map the weights that every worker of the host shares.
+        model, tokenizer = load_shared_model(
+            shared_weights,
+            lambda: adapter.load_model(model_path, kwargs),
+            model_path,
+            kwargs["torch_dtype"],
+        )
+    else:
+        model, tokenizer = adapter.load_model(model_path, kwargs)
 
     if (device == "cuda" and num_gpus == 1 and not cpu_offloading) or device == "mps":
         model.to(device)
 
+    if cpu_dtype == "int8":
+        # Int8 weights with activations quantized on the fly. The lm_head of
+        # decoder-only models stays in float32 for RestrictedVocabHead.
+        torch.quantization.quantize_dynamic(
+            model.base_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+    if compile_decode:
+        # Decode sequences of up to the context length with a compiled step.
+        max_len = getattr(
+            model.config,
+            "max_sequence_length",
+            getattr(model.config, "max_position_embeddings", 2048),
+        )
+        decoder = enable_compiled_decode(
+            model, max_len, compile_slots, compile_cache_dir
+        )
+        print(f"Compiled the decode step in {decoder.stats['compile_seconds']:.1f}s")
+
     if debug:
         print(model)
 
@@ -205,6 +275,19 @@ def add_model_args(parser):
         action="store_true",
         help="Only when using 8-bit quantization: Offload excess weights to the CPU that don't fit on the GPU",
     )
+    parser.add_argument(
+        "--sdpa-attn",
+        action="store_true",
+        help="Use PyTorch scaled_dot_product_attention for LLaMA models",
+    )
+    parser.add_argument(
+        "--cpu-dtype",
+        type=str,
+        choices=CPU_DTYPES,
+        default="float32",
+        help="Only with --device cpu: bfloat16 where the CPU supports it, or "
+        "int8 dynamic quantization of the linear layers",
+    )
 
 
 class VicunaAdapter(BaseAdapter):
@@ -226,6 +309,9 @@ class VicunaAdapter(BaseAdapter):
     def get_default_conv_template(self, model_path: str) -> Conversation:
         return get_conv_template("vicuna_v1.1")
 
+    def get_attention_sinks(self, model_path: str) -> Optional[int]:
+        return 4
+
     def raise_warning_for_old_weights(self, model):
         if isinstance(model, LlamaForCausalLM) and model.model.vocab_size > 32000:
             warnings.warn(
@@ -261,6 +347,9 @@ class KoalaAdapter(BaseAdapter):
     def get_default_conv_template(self, model_path: str) -> Conversation:
         return get_conv_template("koala_v1")
 
+    def get_attention_sinks(self, model_path: str) -> Optional[int]:
+        return 4
+
 
 class ChatGLMAdapter(BaseAdapter):
     """The model adapter for THUDM/chatglm-6b"""
@@ -506,8 +595,30 @@ class H2OGPTAdapter(BaseAdapter):
         return get_conv_template("h2ogpt")
 
 
+class DistilledTemplateAdapter(BaseAdapter):
+    """The model adapter for models with a LoRA distilled from a few-shot template,
+    e.g. vicuna-13b-obuv_distilled. See fastchat/train/distill_template.py"""
+
+    def match(self, model_path: str):
+        return self.get_template_name(model_path) is not None
+
+    def get_template_name(self, model_path: str):
+        for name in conv_templates:
+            if name.endswith("_distilled") and name in model_path:
+                return name
+        return None
+
+    def get_default_conv_template(self, model_path: str) -> Conversation:
+        return get_conv_template(self.get_template_name(model_path))
+
+    def get_attention_sinks(self, model_path: str) -> Optional[int]:
+        # The distilled models are LoRA-tuned Vicuna models.
+        return 4
+
+
 # Note: the registration order matters.
 # The one registered earlier has a higher matching priority.
+register_model_adapter(DistilledTemplateAdapter)
 register_model_adapter(VicunaAdapter)
 register_model_adapter(T5Adapter)
 register_model_adapter(KoalaAdapter)
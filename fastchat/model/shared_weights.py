@@ -0,0 +1,209 @@
+"""
+Model weights shared by the worker processes of one host.
+
+The first worker loads the model as usual and exports it to a directory: the
+weights in a safetensors file, the config and the tokenizer. Every worker,
+the first one included, then builds the model without weights and maps the
+file read-only in place of its parameters. The page cache holds the only copy
+of the weights, so N workers take about the memory of one model plus their
+own KV caches. Use a directory on /dev/shm to keep the file in memory, or on a
+local disk to keep it across reboots.
+
+Only CPU models with regular (not quantized) weights are supported. The
+export records the model path, the model type and the dtype, and a worker
+that asks for another model or dtype exports it again.
+"""
+import gc
+import json
+import mmap
+import os
+import shutil
+import struct
+import warnings
+
+from accelerate import init_empty_weights
+import torch
+import transformers
+
+WEIGHTS_NAME = "weights.safetensors"
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+TORCH_DTYPES = {name: dtype for dtype, name in SAFETENSORS_DTYPES.items()}
+
+
+def element_size(dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def save_safetensors(tensors: dict, path: str, metadata: dict):
+    """Write tensors in the safetensors format. Larger elements come first, so
+    every tensor starts at a multiple of its element size and can be mapped
+    without a copy."""
+    names = sorted(tensors, key=lambda name: -element_size(tensors[name].dtype))
+    header = {"__metadata__": metadata}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": SAFETENSORS_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + num_bytes],
+        }
+        offset += num_bytes
+    header = json.dumps(header).encode()
+    header += b" " * (-len(header) % 8)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            tensor = tensors[name].detach().cpu().contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+
+
+def read_safetensors_metadata(path: str) -> dict:
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_len)).get("__metadata__", {})
+
+
+def map_safetensors(path: str):
+    """Map a safetensors file read-only. Return (tensors, metadata); the
+    tensors share the pages of the file."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    metadata = header.pop("__metadata__", {})
+    start = 8 + header_len
+    tensors = {}
+    with warnings.catch_warnings():
+        # Writing to the tensors is not supported, the mapping is read-only.
+        warnings.simplefilter("ignore", UserWarning)
+        for name, info in header.items():
+            dtype = TORCH_DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            if (start + begin) % element_size(dtype):
+                raise ValueError(f"{name} is not aligned in {path}")
+            tensor = torch.frombuffer(
+                buffer,
+                dtype=dtype,
+                count=(end - begin) // element_size(dtype),
+                offset=start + begin,
+            )
+            tensors[name] = tensor.view(info["shape"])
+    return tensors, metadata
+
+
+def export_metadata(model_path: str, model_type: str, torch_dtype) -> dict:
+    """The metadata that identifies an export."""
+    if os.path.exists(model_path):
+        model_path = os.path.abspath(model_path)
+    return {
+        "model_path": model_path,
+        "model_type": model_type,
+        "torch_dtype": str(torch_dtype).split(".")[-1],
+    }
+
+
+def export_shared_weights(model, tokenizer, path: str, model_path: str):
+    """Export a model loaded from model_path to path for attach_shared_weights."""
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    model.config.save_pretrained(tmp_path)
+    tokenizer.save_pretrained(tmp_path)
+    tensors = {name: param for name, param in model.named_parameters()}
+    save_safetensors(
+        tensors,
+        os.path.join(tmp_path, WEIGHTS_NAME),
+        {
+            "format": "pt",
+            "model_class": type(model).__name__,
+            "tokenizer_class": type(tokenizer).__name__,
+            **export_metadata(model_path, model.config.model_type, model.dtype),
+        },
+    )
+    os.rename(tmp_path, path)
+
+
+def attach_shared_weights(path: str):
+    """Build a model exported to path without weights and map its weights
+    from the shared file. Return (model, tokenizer)."""
+    tensors, metadata = map_safetensors(os.path.join(path, WEIGHTS_NAME))
+    model_class = getattr(transformers, metadata["model_class"], None)
+    tokenizer_class = getattr(transformers, metadata["tokenizer_class"], None)
+    if model_class is None or tokenizer_class is None:
+        raise ValueError("Shared weights only support models of transformers")
+
+    config = transformers.AutoConfig.from_pretrained(path)
+    dtype = getattr(torch, metadata["torch_dtype"])
+    with init_empty_weights():
+        model = model_class._from_config(config, torch_dtype=dtype)
+    for name, tensor in tensors.items():
+        module_name, _, param_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        module._parameters[param_name] = torch.nn.Parameter(
+            tensor, requires_grad=False
+        )
+    # Tied weights are stored once.
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"{path} has no weights for {missing[:3]}")
+    model.eval()
+
+    tokenizer = tokenizer_class.from_pretrained(path)
+    return model, tokenizer
+
+
+def find_mismatch(path: str, expected: dict):
+    """The first metadata entry of the export in path that differs from
+    expected, as a message, or None."""
+    metadata = read_safetensors_metadata(os.path.join(path, WEIGHTS_NAME))
+    for key, value in expected.items():
+        if metadata.get(key) != value:
+            return f"{key} is {metadata.get(key)}, expected {value}"
+    return None
+
+
+def load_shared_model(path: str, load_fn, model_path: str, torch_dtype):
+    """Attach to the shared weights in path, exporting them with the model of
+    load_fn() first if no worker has done it yet, or if they belong to another
+    model_path, model type or torch_dtype."""
+    import fcntl
+
+    config = transformers.AutoConfig.from_pretrained(model_path)
+    expected = export_metadata(model_path, config.model_type, torch_dtype)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(path):
+                mismatch = find_mismatch(path, expected)
+                if mismatch is not None:
+                    # Workers attached to the old export keep their mapping.
+                    warnings.warn(f"Exporting {path} again: {mismatch}")
+                    shutil.rmtree(path)
+            if not os.path.exists(path):
+                model, tokenizer = load_fn()
+                export_shared_weights(model, tokenizer, path, model_path)
+                del model, tokenizer
+                gc.collect()
+            # Attach under the lock, so no other worker replaces the export
+            # in between.
+            return attach_shared_weights(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
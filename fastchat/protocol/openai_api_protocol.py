@@ -60,6 +60,12 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
     user: Optional[str] = None
+    # Not part of the OpenAI API: only generate tokens found in these texts.
+    # The log-probs are then normalized over these tokens.
+    allowed_output: Optional[List[str]] = None
+    # Not part of the OpenAI API: lets the worker reuse the KV cache of the
+    # previous turns of the same conversation.
+    session_id: Optional[str] = None
 
 
 class ChatMessage(BaseModel):
@@ -115,6 +121,9 @@ class EmbeddingsRequest(BaseModel):
     engine: Optional[str] = None
     input: Union[str, List[Any]]
     user: Optional[str] = None
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    # Not part of the OpenAI API. "int8" embeddings are scaled by 127.
+    embedding_dtype: Optional[Literal["float32", "float16", "int8"]] = "float32"
 
 
 class EmbeddingsResponse(BaseModel):
@@ -139,13 +148,26 @@ class CompletionRequest(BaseModel):
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
     user: Optional[str] = None
+    # Not part of the OpenAI API: only generate tokens found in these texts.
+    # The log-probs are then normalized over these tokens.
+    allowed_output: Optional[List[str]] = None
+
+
+class LogProbs(BaseModel):
+    text_offset: List[int] = []
+    token_logprobs: List[Optional[float]] = []
+    tokens: List[str] = []
+    top_logprobs: List[Optional[Dict[str, float]]] = []
 
 
 class CompletionResponseChoice(BaseModel):
     index: int
     text: str
-    logprobs: Optional[int] = None
-    finish_reason: Optional[Literal["stop", "length"]]
+    logprobs: Optional[LogProbs] = None
+    finish_reason: Optional[Literal["stop", "length", "error"]]
+    # Not part of the OpenAI API: set with finish_reason "error" when this
+    # choice failed and the others did not.
+    error: Optional[ErrorResponse] = None
 
 
 class CompletionResponse(BaseModel):
@@ -160,7 +182,7 @@ class CompletionResponse(BaseModel):
 class CompletionResponseStreamChoice(BaseModel):
     index: int
     text: str
-    logprobs: Optional[float] = None
+    logprobs: Optional[LogProbs] = None
     finish_reason: Optional[Literal["stop", "length"]] = None
 
 
@@ -170,3 +192,131 @@ class CompletionStreamResponse(BaseModel):
     created: int = Field(default_factory=lambda: int(time.time()))
     model: str
     choices: List[CompletionResponseStreamChoice]
+
+
+class ScoreRequest(BaseModel):
+    model: str
+    prompt: str
+    candidates: List[str]
+    user: Optional[str] = None
+
+
+class ScoreData(BaseModel):
+    index: int
+    text: str
+    logprob: float
+    tokens: List[str]
+    token_logprobs: List[float]
+
+
+class ScoreResponse(BaseModel):
+    id: str = Field(default_factory=lambda: f"score-{shortuuid.random()}")
+    object: str = "list"
+    created: int = Field(default_factory=lambda: int(time.time()))
+    model: str
+    data: List[ScoreData]
+    usage: UsageInfo
+
+
+class CollectionCreateRequest(BaseModel):
+    name: str
+    model: str
+    quantization: Optional[Literal["int8"]] = None
+
+
+class CollectionAddRequest(BaseModel):
+    # Either texts to embed with the collection's model, or raw vectors.
+    input: Optional[Union[str, List[Any]]] = None
+    vectors: Optional[List[List[float]]] = None
+    ids: Optional[List[str]] = None
+    metadata: Optional[List[Dict[str, Any]]] = None
+
+
+class CollectionIndexRequest(BaseModel):
+    type: Literal["ivf", "hnsw"]
+    num_lists: Optional[int] = None
+    m: Optional[int] = 16
+    ef_construction: Optional[int] = 200
+
+
+class CollectionInfo(BaseModel):
+    id: str
+    object: str = "collection"
+    model: str
+    dim: Optional[int] = None
+    count: int
+    quantization: Optional[str] = None
+    index: Optional[str] = None
+
+
+class CollectionList(BaseModel):
+    object: str = "list"
+    data: List[CollectionInfo] = []
+
+
+class SearchRequest(BaseModel):
+    collection: str
+    # Either query texts or query vectors.
+    query: Optional[Union[str, List[Any]]] = None
+    vectors: Optional[List[List[float]]] = None
+    top_k: Optional[int] = 10
+    exact: Optional[bool] = False
+    nprobe: Optional[int] = 8
+    ef: Optional[int] = 64
+
+
+class SearchResponse(BaseModel):
+    object: str = "list"
+    data: List[Dict[str, Any]]
+    model: str
+    usage: UsageInfo
+
+
+class FileObject(BaseModel):
+    id: str
+    object: str = "file"
+    bytes: int
+    created_at: int
+    filename: str
+    purpose: str
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: Literal["/v1/chat/completions", "/v1/completions"]
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    id: str
+    object: str = "batch"
+    endpoint: str
+    errors: Optional[Dict[str, Any]] = None
+    input_file_id: str
+    completion_window: str
+    status: str
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchList(BaseModel):
+    object: str = "list"
+    data: List[BatchObject] = []
@@ -0,0 +1,627 @@
+"""
+Offline bulk inference over CSV/Parquet files.
+
+Rows are streamed from the input file in chunks. Every chunk is formatted
+with a conversation template, sorted by prompt length, generated in batches
+and appended to the output file. A checkpoint is written after each chunk,
+so an interrupted job resumes where it stopped.
+
+Usage:
+python3 -m fastchat.serve.batch_infer --model-path /path/to/vicuna-13b \
+    --input offers.csv --sep ";" --column name --conv-template obuv \
+    --output offers_obuv.csv --temperature 0.01 --max-new-tokens 40
+
+Send one representative per cluster of near-duplicate rows through the model
+and copy its output to the other rows (see fastchat/data/near_dedup.py):
+python3 -m fastchat.serve.batch_infer ... --dedup --dedup-threshold 0.85
+
+Answer with a small model first and regenerate the low-confidence rows with
+the main model (see fastchat/serve/cascade.py):
+python3 -m fastchat.serve.batch_infer ... --cascade-model-path /path/to/vicuna-7b \
+    --cascade-min-logprob -0.4
+
+Shard the job over several local GPUs or CPU processes (one process each).
+CPU processes split the cores between them. With --dedup, every shard clusters
+all rows and handles the clusters whose representatives it owns, so
+near-duplicates are found across shards:
+python3 -m fastchat.serve.batch_infer ... --devices 0,1,2,3
+python3 -m fastchat.serve.batch_infer ... --device cpu --devices cpu,cpu
+"""
+import argparse
+import copy
+import heapq
+import json
+import multiprocessing
+import os
+import time
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+import torch
+
+from fastchat.conversation import get_conv_template
+from fastchat.data.near_dedup import NearDuplicateIndex
+from fastchat.model.chatglm_model import chatglm_generate_stream
+from fastchat.model.model_adapter import (
+    add_model_args,
+    get_conversation_template,
+    load_model,
+)
+from fastchat.serve.cascade import Cascade, CascadeTier
+from fastchat.serve.inference import generate_batch, generate_stream
+
+ROW_ID_COLUMN = "row_id"
+DEDUP_OF_COLUMN = "dedup_of"
+DEDUP_CONFIDENCE_COLUMN = "dedup_confidence"
+
+
+def get_context_length(model):
+    config = model.config
+    if hasattr(config, "max_sequence_length"):
+        return config.max_sequence_length
+    elif hasattr(config, "max_position_embeddings"):
+        return config.max_position_embeddings
+    return 2048
+
+
+def read_chunks(path: str, chunk_size: int, sep: str) -> Iterator[pd.DataFrame]:
+    """Stream a CSV or Parquet file as DataFrames of at most chunk_size rows."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, sep=sep, chunksize=chunk_size)
+
+
+def read_output_chunks(
+    path: str, chunk_size: int, sep: str
+) -> Iterator[pd.DataFrame]:
+    # Read the values back as written, e.g. keep the leading zeros of ids.
+    if path.endswith(".jsonl"):
+        yield from pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False)
+    else:
+        yield from pd.read_csv(
+            path, sep=sep, chunksize=chunk_size, dtype=str, keep_default_na=False
+        )
+
+
+def write_chunk(df: pd.DataFrame, path: str, sep: str):
+    """Append a chunk to a CSV or JSONL file and flush it to disk."""
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", encoding="utf-8") as fout:
+        if path.endswith(".jsonl"):
+            df.to_json(fout, orient="records", lines=True, force_ascii=False)
+        else:
+            df.to_csv(fout, sep=sep, header=write_header, index=False)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def load_checkpoint(path: str):
+    if os.path.exists(path):
+        with open(path) as fin:
+            return json.load(fin)
+    return {"rows_done": 0, "output_bytes": 0}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(checkpoint, fout)
+    os.replace(tmp_path, path)
+
+
+class BatchGenerator:
+    """Generate completions for lists of texts with a conversation template."""
+
+    def __init__(self, model, tokenizer, device, args):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.context_len = get_context_length(model)
+        self.batch_size = args.batch_size
+        self.conv_template = args.conv_template
+        self.model_path = args.model_path
+        self.allowed_output = getattr(args, "allowed_output", None)
+        self.example_k = getattr(args, "example_k", None)
+        self.example_token_budget = getattr(args, "example_token_budget", None)
+        self.example_embed = None
+        if getattr(args, "example_selection", "ngram") == "embedding":
+            self.example_embed = self.embed
+        self.gen_params = {
+            "temperature": args.temperature,
+            "repetition_penalty": args.repetition_penalty,
+            "top_p": args.top_p,
+            "max_new_tokens": args.max_new_tokens,
+            "echo": False,
+        }
+        if getattr(args, "full_vocab_logprobs", False):
+            self.gen_params["full_vocab_logprobs"] = True
+
+        is_chatglm = "chatglm" in str(type(model)).lower()
+        self.is_chatglm = is_chatglm
+        self.use_generate_batch = not (
+            is_chatglm or model.config.is_encoder_decoder
+        )
+
+    def build_params(self, text: str) -> dict:
+        if self.conv_template:
+            conv = get_conv_template(self.conv_template)
+        else:
+            conv = get_conversation_template(self.model_path)
+        if conv.example_pool:
+            conv.select_examples(
+                text,
+                k=self.example_k,
+                token_budget=self.example_token_budget,
+                count_tokens=lambda t: len(self.tokenizer(t).input_ids),
+                embed=self.example_embed,
+            )
+        conv.append_message(conv.roles[0], text)
+        conv.append_message(conv.roles[1], None)
+        if self.is_chatglm:
+            prompt = conv.messages[conv.offset :]
+        else:
+            prompt = conv.get_prompt()
+        params = dict(
+            self.gen_params,
+            prompt=prompt,
+            stop=conv.stop_str,
+            stop_token_ids=conv.stop_token_ids,
+        )
+        allowed_output = self.allowed_output or conv.allowed_output
+        if allowed_output:
+            params["allowed_output"] = allowed_output + [text]
+        return params
+
+    @torch.inference_mode()
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Normalized mean-pooled last hidden states, one row per text."""
+        embeddings = []
+        for text in texts:
+            input_ids = torch.as_tensor(
+                [self.tokenizer(text).input_ids], device=self.model.device
+            )
+            hidden = self.model(input_ids, output_hidden_states=True).hidden_states[-1]
+            embedding = torch.nn.functional.normalize(hidden[0].float().mean(0), dim=-1)
+            embeddings.append(embedding.cpu().numpy())
+        return np.stack(embeddings)
+
+    def generate(self, texts: List[str]) -> List[dict]:
+        """Return one output (text, usage, finish_reason) per text, in order."""
+        params_list = [self.build_params(text) for text in texts]
+        if not self.use_generate_batch:
+            generate_stream_func = (
+                chatglm_generate_stream if self.is_chatglm else generate_stream
+            )
+            outputs = []
+            for params in params_list:
+                for output in generate_stream_func(
+                    self.model, self.tokenizer, params, self.device, self.context_len
+                ):
+                    pass
+                outputs.append(output)
+            return outputs
+
+        # Sort by prompt length so that each batch needs little padding.
+        lengths = [len(self.tokenizer(p["prompt"]).input_ids) for p in params_list]
+        order = sorted(range(len(params_list)), key=lambda i: lengths[i])
+        outputs = [None] * len(params_list)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            batch_outputs = generate_batch(
+                self.model,
+                self.tokenizer,
+                [params_list[i] for i in indices],
+                self.device,
+                self.context_len,
+            )
+            for i, output in zip(indices, batch_outputs):
+                outputs[i] = output
+        return outputs
+
+
+class Deduplicator:
+    """Remember the outputs of cluster representatives across chunks."""
+
+    def __init__(self, args):
+        self.index = NearDuplicateIndex(threshold=args.dedup_threshold)
+        # Dict[representative row_id -> output text]
+        self.outputs = {}
+
+    def restore(self, path: str, args, rows_done: int):
+        """Re-cluster the input rows before rows_done and reload the outputs of
+        the representatives already written to a resumed output."""
+        row_start = 0
+        for df in read_chunks(args.input, args.chunk_size, args.sep):
+            texts = df[args.column].fillna("").astype(str).tolist()
+            for row_id, text in enumerate(texts[: rows_done - row_start], row_start):
+                self.index.assign(row_id, text)
+            row_start += len(df)
+            if row_start >= rows_done:
+                break
+
+        row_id = 0
+        for df in read_output_chunks(path, args.chunk_size, args.sep):
+            for row in df.to_dict("records"):
+                row_id = int(row.get(ROW_ID_COLUMN, row_id))
+                rep_id = row[DEDUP_OF_COLUMN]
+                if rep_id is None or pd.isna(rep_id) or rep_id == "":
+                    self.outputs[row_id] = row[args.output_column]
+                row_id += 1
+
+    def process_chunk(
+        self,
+        generator: BatchGenerator,
+        df: pd.DataFrame,
+        args,
+        shard_id: int = 0,
+        num_shards: int = 1,
+    ):
+        """Cluster all rows of the chunk, and process the rows of the clusters
+        whose representative has row_id % num_shards == shard_id. Every shard
+        sees the same rows in the same order, so they all cluster alike."""
+        texts = df[args.column].fillna("").astype(str).tolist()
+        row_ids = df[ROW_ID_COLUMN].tolist()
+        assignments = [
+            self.index.assign(row_id, text) for row_id, text in zip(row_ids, texts)
+        ]
+        keep = [
+            (row_id if rep_id is None else rep_id) % num_shards == shard_id
+            for row_id, (rep_id, _) in zip(row_ids, assignments)
+        ]
+        df = df[keep].copy()
+        texts = [text for text, k in zip(texts, keep) if k]
+        row_ids = [row_id for row_id, k in zip(row_ids, keep) if k]
+        assignments = [a for a, k in zip(assignments, keep) if k]
+        new_reps = [i for i, (rep_id, _) in enumerate(assignments) if rep_id is None]
+        outputs = generator.generate([texts[i] for i in new_reps])
+        for i, output in zip(new_reps, outputs):
+            self.outputs[row_ids[i]] = output["text"].strip()
+
+        df[args.output_column] = [
+            self.outputs[row_id if rep_id is None else rep_id]
+            for row_id, (rep_id, _) in zip(row_ids, assignments)
+        ]
+        df[DEDUP_OF_COLUMN] = pd.array([a[0] for a in assignments], dtype="Int64")
+        df[DEDUP_CONFIDENCE_COLUMN] = [round(a[1], 4) for a in assignments]
+        return df, len(new_reps)
+
+
+class CascadeGenerator:
+    """Generate with a small model and escalate uncertain texts to the main one."""
+
+    def __init__(self, small: BatchGenerator, large: BatchGenerator, args):
+        self.generators = [small, large]
+        self.cascade = Cascade(
+            "batch_infer",
+            [
+                CascadeTier(
+                    args.cascade_model_path,
+                    args.cascade_min_logprob,
+                    args.cascade_format_regex,
+                ),
+                CascadeTier(args.model_path),
+            ],
+        )
+
+    def generate(self, texts: List[str]) -> List[dict]:
+        outputs = [None] * len(texts)
+        pending = list(range(len(texts)))
+        for i, generator in enumerate(self.generators):
+            tier_outputs = generator.generate([texts[j] for j in pending])
+            escalated = []
+            for j, output in zip(pending, tier_outputs):
+                if self.cascade.accept(i, output):
+                    outputs[j] = output
+                else:
+                    escalated.append(j)
+            pending = escalated
+        return outputs
+
+    def stats_str(self) -> str:
+        stats = self.cascade.get_stats()
+        return ", ".join(
+            f"{tier['model']}: {tier['hit_rate']:.1%}" for tier in stats["tiers"]
+        )
+
+
+def process_chunk(generator: BatchGenerator, df: pd.DataFrame, args) -> pd.DataFrame:
+    texts = df[args.column].fillna("").astype(str).tolist()
+    outputs = generator.generate(texts)
+    df[args.output_column] = [output["text"].strip() for output in outputs]
+    return df
+
+
+def shard_output_path(output: str, shard_id: int, num_shards: int) -> str:
+    if num_shards == 1:
+        return output
+    root, ext = os.path.splitext(output)
+    return f"{root}.shard{shard_id}-of-{num_shards}{ext}"
+
+
+def run_shard(args, shard_id: int, num_shards: int, device: str = None):
+    """Process the rows with row_id % num_shards == shard_id."""
+    if device == "cpu":
+        # Split the cores between the CPU processes instead of oversubscribing.
+        num_cpu_shards = args.devices.split(",").count("cpu")
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_cpu_shards))
+    elif device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+
+    output = shard_output_path(args.output, shard_id, num_shards)
+    checkpoint_path = output + ".ckpt"
+    if args.overwrite:
+        for path in [output, checkpoint_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.exists(output) and not os.path.exists(checkpoint_path):
+        raise ValueError(f"{output} exists. Use --overwrite to replace it.")
+    checkpoint = load_checkpoint(checkpoint_path)
+    if os.path.exists(output):
+        # Drop the rows written after the last checkpoint.
+        os.truncate(output, checkpoint["output_bytes"])
+    rows_done = checkpoint["rows_done"]
+    if rows_done:
+        print(f"[shard {shard_id}] resuming after {rows_done} rows")
+
+    model, tokenizer = load_model(
+        args.model_path,
+        args.device,
+        args.num_gpus,
+        args.max_gpu_memory,
+        args.load_8bit,
+        args.cpu_offloading,
+        sdpa_attn=args.sdpa_attn,
+        cpu_dtype=args.cpu_dtype,
+    )
+    generator = BatchGenerator(model, tokenizer, args.device, args)
+    if args.cascade_model_path:
+        small_model, small_tokenizer = load_model(
+            args.cascade_model_path,
+            args.device,
+            args.num_gpus,
+            args.max_gpu_memory,
+            args.load_8bit,
+            args.cpu_offloading,
+            sdpa_attn=args.sdpa_attn,
+            cpu_dtype=args.cpu_dtype,
+        )
+        small_args = copy.copy(args)
+        small_args.model_path = args.cascade_model_path
+        small_args.conv_template = args.cascade_conv_template or args.conv_template
+        # Judge the confidence by the unrestricted distribution.
+        small_args.full_vocab_logprobs = args.cascade_min_logprob is not None
+        small_generator = BatchGenerator(
+            small_model, small_tokenizer, args.device, small_args
+        )
+        generator = CascadeGenerator(small_generator, generator, args)
+    deduplicator = None
+    if args.dedup:
+        deduplicator = Deduplicator(args)
+        if rows_done:
+            deduplicator.restore(output, args, rows_done)
+
+    row_start = 0
+    num_processed = 0
+    num_generated = 0
+    start_time = time.time()
+    for df in read_chunks(args.input, args.chunk_size, args.sep):
+        row_end = row_start + len(df)
+        if row_end <= rows_done:
+            row_start = row_end
+            continue
+        df = df.reset_index(drop=True)
+        df.insert(0, ROW_ID_COLUMN, range(row_start, row_end))
+        df = df[df[ROW_ID_COLUMN] >= rows_done]
+        if deduplicator is None:
+            df = df[df[ROW_ID_COLUMN] % num_shards == shard_id].copy()
+            df_out = process_chunk(generator, df, args)
+            num_generated += len(df)
+        else:
+            df_out, num_rep = deduplicator.process_chunk(
+                generator, df.copy(), args, shard_id, num_shards
+            )
+            num_generated += num_rep
+        if num_shards == 1 and not args.keep_row_id:
+            df_out = df_out.drop(columns=[ROW_ID_COLUMN])
+
+        write_chunk(df_out, output, args.sep)
+        save_checkpoint(
+            checkpoint_path,
+            {"rows_done": row_end, "output_bytes": os.path.getsize(output)},
+        )
+        num_processed += len(df_out)
+        elapsed = time.time() - start_time
+        print(
+            f"[shard {shard_id}] rows: {row_end}, processed: {num_processed}, "
+            f"generated: {num_generated}, "
+            f"throughput: {num_processed / elapsed:.2f} rows/s"
+        )
+        if args.cascade_model_path:
+            print(f"[shard {shard_id}] cascade hit rates: {generator.stats_str()}")
+        row_start = row_end
+
+    return output
+
+
+def merge_shards(args, num_shards: int):
+    """Merge the shard outputs into args.output, in the original row order."""
+    paths = [
+        shard_output_path(args.output, i, num_shards) for i in range(num_shards)
+    ]
+
+    def iter_rows(path):
+        if not os.path.exists(path):
+            return
+        for df in read_output_chunks(path, args.chunk_size, args.sep):
+            yield from df.to_dict("records")
+
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    buffer = []
+    rows = heapq.merge(
+        *[iter_rows(p) for p in paths], key=lambda r: int(r[ROW_ID_COLUMN])
+    )
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) >= args.chunk_size:
+            write_merged(buffer, args)
+            buffer = []
+    if buffer:
+        write_merged(buffer, args)
+
+
+def write_merged(rows: List[dict], args):
+    df = pd.DataFrame(rows)
+    if not args.keep_row_id:
+        df = df.drop(columns=[ROW_ID_COLUMN])
+    write_chunk(df, args.output, args.sep)
+
+
+def main(args):
+    if args.devices:
+        devices = args.devices.split(",")
+        num_shards = len(devices)
+        ctx = multiprocessing.get_context("spawn")
+        processes = [
+            ctx.Process(target=run_shard, args=(args, i, num_shards, device))
+            for i, device in enumerate(devices)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+        if failed:
+            raise RuntimeError(
+                f"Shards {failed} failed. Rerun the same command to resume."
+            )
+        merge_shards(args, num_shards)
+    elif args.num_shards > 1:
+        # One shard of a job spread over several hosts or manual processes.
+        run_shard(args, args.shard_id, args.num_shards)
+    else:
+        run_shard(args, 0, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument(
+        "--input", type=str, required=True, help="A CSV or Parquet file"
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="A CSV or JSONL file"
+    )
+    parser.add_argument("--sep", type=str, default=",", help="The CSV separator")
+    parser.add_argument(
+        "--column", type=str, default="name", help="The input text column"
+    )
+    parser.add_argument(
+        "--output-column",
+        type=str,
+        default="prompt",
+        help="The generated text column",
+    )
+    parser.add_argument(
+        "--conv-template", type=str, default=None, help="Conversation prompt template."
+    )
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    parser.add_argument(
+        "--batch-size", type=int, default=16, help="Prompts decoded together"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1024,
+        help="Rows read, generated and checkpointed at a time",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default=None,
+        help="Shard the job over these devices, one process each. "
+        "Use GPU ids like 0,1,2,3, or cpu,cpu for CPU processes",
+    )
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-id", type=int, default=0)
+    parser.add_argument(
+        "--keep-row-id", action="store_true", help="Keep the row_id column"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Start over instead of resuming"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Generate once per cluster of near-duplicate inputs and copy the "
+        "output to the other rows, marked by the dedup_of and dedup_confidence columns",
+    )
+    parser.add_argument(
+        "--allowed-output",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only generate tokens found in these texts (e.g. the field labels) "
+        "and in the input row. Overrides the template's allowed_output",
+    )
+    parser.add_argument(
+        "--example-selection",
+        type=str,
+        default="ngram",
+        choices=["ngram", "embedding"],
+        help="How templates with an example pool pick the examples per row",
+    )
+    parser.add_argument(
+        "--example-k", type=int, default=None, help="Override the template's k"
+    )
+    parser.add_argument(
+        "--example-token-budget",
+        type=int,
+        default=None,
+        help="Override the template's token budget for examples",
+    )
+    parser.add_argument(
+        "--cascade-model-path",
+        type=str,
+        default=None,
+        help="A smaller model that answers first; uncertain rows go to --model-path",
+    )
+    parser.add_argument(
+        "--cascade-conv-template",
+        type=str,
+        default=None,
+        help="The conversation template of the smaller model",
+    )
+    parser.add_argument(
+        "--cascade-min-logprob",
+        type=float,
+        default=-0.5,
+        help="Escalate if the mean token log-prob of the smaller model is lower",
+    )
+    parser.add_argument(
+        "--cascade-format-regex",
+        type=str,
+        default=None,
+        help="Escalate if the output of the smaller model does not match it",
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.85,
+        help="The minimum estimated Jaccard similarity of near-duplicates",
+    )
+    args = parser.parse_args()
+
+    if args.gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    main(args)
@@ -0,0 +1,438 @@
+"""
+OpenAI-compatible batch jobs (/v1/files and /v1/batches) for the API server.
+
+Uploaded files, job states and results are persisted under one directory:
+- files/{file_id}.jsonl and files/{file_id}.json: the content and the metadata.
+- batches/{batch_id}.json: the state of a batch job.
+
+A job is split into chunks of requests with identical sampling parameters.
+Every worker serving the job's model receives at most one chunk at a time,
+and only while it has no other queued requests, so batch jobs fill idle
+capacity, and the worker runs them at a lower priority than interactive
+requests. Results are appended to the output file as soon as a chunk finishes,
+and unfinished jobs are resumed after a restart.
+
+A job that is not done within its completion window expires: the requests
+left are written to the error file. A job fails if no worker serves its model
+for BATCH_JOB_NO_WORKER_TIMEOUT seconds.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import shortuuid
+
+from fastchat.constants import WORKER_API_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+BATCH_JOB_CHUNK_SIZE = int(os.getenv("FASTCHAT_BATCH_JOB_CHUNK_SIZE", 32))
+BATCH_JOB_POLL_INTERVAL = float(os.getenv("FASTCHAT_BATCH_JOB_POLL_INTERVAL", 1))
+BATCH_JOB_MAX_RETRIES = 3
+BATCH_JOB_NO_WORKER_TIMEOUT = float(
+    os.getenv("FASTCHAT_BATCH_JOB_NO_WORKER_TIMEOUT", 600)
+)
+
+SUPPORTED_ENDPOINTS = ["/v1/chat/completions", "/v1/completions"]
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_completion_window(completion_window: str) -> int:
+    """The completion window in seconds, e.g. 86400 for "24h"."""
+    match = re.fullmatch(r"(\d+)([smhd])", completion_window)
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid completion_window: {completion_window}")
+    return int(match.group(1)) * TIME_UNITS[match.group(2)]
+
+
+class BatchJobManager:
+    def __init__(
+        self,
+        root_dir: str,
+        controller_address: str,
+        prepare_request: Callable[[str, Dict[str, Any]], Tuple[Dict, List]],
+        build_response: Callable[[str, Dict[str, Any], List[Dict[str, Any]]], Dict],
+    ):
+        """
+        :param prepare_request: (endpoint, body) -> (gen_params, prompts), where
+            prompts holds every prompt of the request repeated n times
+        :param build_response: (endpoint, body, outputs) -> response body
+        """
+        self.root_dir = root_dir
+        self.controller_address = controller_address
+        self.prepare_request = prepare_request
+        self.build_response = build_response
+        self.files_dir = os.path.join(root_dir, "files")
+        self.batches_dir = os.path.join(root_dir, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+
+        self.files = {}
+        for name in os.listdir(self.files_dir):
+            if name.endswith(".json"):
+                with open(os.path.join(self.files_dir, name)) as fin:
+                    info = json.load(fin)
+                self.files[info["id"]] = info
+        self.batches = {}
+        for name in os.listdir(self.batches_dir):
+            with open(os.path.join(self.batches_dir, name)) as fin:
+                batch = json.load(fin)
+            self.batches[batch["id"]] = batch
+        self.tasks = {}
+
+    # Files
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def save_file_info(self, info: Dict[str, Any]):
+        self.files[info["id"]] = info
+        with open(os.path.join(self.files_dir, f"{info['id']}.json"), "w") as fout:
+            json.dump(info, fout)
+
+    def create_file(self, filename: str, purpose: str, content: bytes):
+        file_id = f"file-{shortuuid.random()}"
+        with open(self.file_path(file_id), "wb") as fout:
+            fout.write(content)
+        info = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        self.save_file_info(info)
+        return info
+
+    def get_file(self, file_id: str) -> Dict[str, Any]:
+        if file_id not in self.files:
+            raise KeyError(f"No such file: {file_id}")
+        info = dict(self.files[file_id])
+        if os.path.exists(self.file_path(file_id)):
+            info["bytes"] = os.path.getsize(self.file_path(file_id))
+        return info
+
+    def new_output_file(self, batch_id: str, kind: str) -> str:
+        info = self.create_file(f"{batch_id}_{kind}.jsonl", "batch_output", b"")
+        return info["id"]
+
+    # Batches
+    def save_batch(self, batch: Dict[str, Any]):
+        path = os.path.join(self.batches_dir, f"{batch['id']}.json")
+        with open(path + ".tmp", "w") as fout:
+            json.dump(batch, fout)
+        os.replace(path + ".tmp", path)
+
+    def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        if batch_id not in self.batches:
+            raise KeyError(f"No such batch: {batch_id}")
+        return self.batches[batch_id]
+
+    def list_batches(self) -> List[Dict[str, Any]]:
+        return sorted(self.batches.values(), key=lambda b: -b["created_at"])
+
+    def load_requests(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        requests = []
+        with open(self.file_path(batch["input_file_id"]), encoding="utf-8") as fin:
+            for line_no, line in enumerate(fin):
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if "custom_id" not in request or "body" not in request:
+                    raise ValueError(f"Line {line_no + 1}: custom_id and body required")
+                if request.get("url", batch["endpoint"]) != batch["endpoint"]:
+                    raise ValueError(
+                        f"Line {line_no + 1}: url must be {batch['endpoint']}"
+                    )
+                requests.append(request)
+        if not requests:
+            raise ValueError("The input file is empty")
+        models = {r["body"].get("model") for r in requests}
+        if len(models) != 1:
+            raise ValueError(f"All requests must use the same model, got {models}")
+        return requests
+
+    def create_batch(
+        self,
+        input_file_id: str,
+        endpoint: str,
+        completion_window: str,
+        metadata: Optional[Dict[str, str]],
+    ) -> Dict[str, Any]:
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise ValueError(f"Unsupported endpoint: {endpoint}")
+        window = parse_completion_window(completion_window)
+        self.get_file(input_file_id)
+        batch_id = f"batch_{shortuuid.random()}"
+        created_at = int(time.time())
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": self.new_output_file(batch_id, "output"),
+            "error_file_id": self.new_output_file(batch_id, "error"),
+            "created_at": created_at,
+            "in_progress_at": None,
+            "expires_at": created_at + window,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self.batches[batch_id] = batch
+        self.save_batch(batch)
+        self.start(batch_id)
+        return batch
+
+    def cancel_batch(self, batch_id: str) -> Dict[str, Any]:
+        batch = self.get_batch(batch_id)
+        if batch["status"] in ["validating", "in_progress"]:
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+            self.save_batch(batch)
+            if batch_id not in self.tasks:
+                self.finish(batch, "cancelled")
+        return batch
+
+    def start(self, batch_id: str):
+        self.tasks[batch_id] = asyncio.create_task(self.run_batch(batch_id))
+
+    def resume_all(self):
+        """Restart the jobs interrupted by a server restart."""
+        for batch_id, batch in self.batches.items():
+            if batch["status"] in ["validating", "in_progress"]:
+                self.start(batch_id)
+            elif batch["status"] == "cancelling":
+                self.finish(batch, "cancelled")
+
+    def finish(self, batch: Dict[str, Any], status: str):
+        batch["status"] = status
+        batch[f"{status}_at"] = int(time.time())
+        self.save_batch(batch)
+
+    def finished_ids(self, batch: Dict[str, Any]) -> set:
+        done = set()
+        for file_id in [batch["output_file_id"], batch["error_file_id"]]:
+            with open(self.file_path(file_id), encoding="utf-8") as fin:
+                for line in fin:
+                    if line.strip():
+                        done.add(json.loads(line)["custom_id"])
+        return done
+
+    def append_result(self, batch, request, response=None, error=None):
+        file_id = batch["output_file_id"] if error is None else batch["error_file_id"]
+        result = {
+            "id": f"batch_req_{shortuuid.random()}",
+            "custom_id": request["custom_id"],
+            "response": response,
+            "error": error,
+        }
+        with open(self.file_path(file_id), "a", encoding="utf-8") as fout:
+            fout.write(json.dumps(result, ensure_ascii=False) + "\n")
+        if error is None:
+            batch["request_counts"]["completed"] += 1
+        else:
+            batch["request_counts"]["failed"] += 1
+
+    def make_chunks(self, batch, requests) -> List[Tuple[Dict[str, Any], List]]:
+        """Group consecutive requests with the same parameters into chunks."""
+        chunks = []
+        for request in requests:
+            try:
+                gen_params, prompts = self.prepare_request(
+                    batch["endpoint"], request["body"]
+                )
+            except Exception as e:
+                self.append_result(
+                    batch, request, error={"code": "invalid_request", "message": str(e)}
+                )
+                continue
+            if (
+                chunks
+                and chunks[-1][0] == gen_params
+                and len(chunks[-1][1]) < BATCH_JOB_CHUNK_SIZE
+            ):
+                chunks[-1][1].append((request, prompts))
+            else:
+                chunks.append((gen_params, [(request, prompts)]))
+        return chunks
+
+    async def worker_is_idle(self, client: httpx.AsyncClient, worker_addr: str):
+        try:
+            ret = await client.post(worker_addr + "/worker_get_status", timeout=5)
+            return ret.json()["queue_length"] == 0
+        except (httpx.HTTPError, KeyError, ValueError):
+            return False
+
+    async def run_chunk(self, client, worker_addr, batch, chunk):
+        gen_params, items = chunk
+        payload = dict(gen_params)
+        payload["prompts"] = [prompt for _, prompts in items for prompt in prompts]
+        payload["priority"] = "background"
+        response = await client.post(
+            worker_addr + "/worker_generate_completion_batch",
+            json=payload,
+            timeout=WORKER_API_TIMEOUT * len(payload["prompts"]),
+        )
+        response.raise_for_status()
+        outputs = response.json()["outputs"]
+
+        # Build every result before writing any, so that a failed chunk is
+        # retried without leaving some of its results behind.
+        results = []
+        start = 0
+        for request, prompts in items:
+            request_outputs = outputs[start : start + len(prompts)]
+            start += len(prompts)
+            errors = [o for o in request_outputs if o["error_code"] != 0]
+            if errors:
+                error = {
+                    "code": int(errors[0]["error_code"]),
+                    "message": errors[0]["text"],
+                }
+                results.append((request, None, error))
+            else:
+                body = self.build_response(
+                    batch["endpoint"], request["body"], request_outputs
+                )
+                response = {
+                    "status_code": 200,
+                    "request_id": body.get("id"),
+                    "body": body,
+                }
+                results.append((request, response, None))
+        for request, response, error in results:
+            self.append_result(batch, request, response=response, error=error)
+        self.save_batch(batch)
+
+    async def run_batch(self, batch_id: str):
+        batch = self.get_batch(batch_id)
+        try:
+            requests = self.load_requests(batch)
+        except (ValueError, KeyError, OSError) as e:
+            batch["errors"] = {
+                "object": "list",
+                "data": [{"code": "invalid_input_file", "message": str(e)}],
+            }
+            self.finish(batch, "failed")
+            self.tasks.pop(batch_id, None)
+            return
+
+        model_name = requests[0]["body"].get("model")
+        expires_at = batch.get("expires_at") or batch["created_at"] + (
+            parse_completion_window(batch["completion_window"])
+        )
+        batch["request_counts"]["total"] = len(requests)
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+        self.save_batch(batch)
+
+        done = self.finished_ids(batch)
+        chunks = self.make_chunks(
+            batch, [r for r in requests if r["custom_id"] not in done]
+        )
+        retries = {}
+        running = {}  # worker_addr -> asyncio.Task
+        status = "completed"
+        last_worker_time = time.time()
+
+        async with httpx.AsyncClient() as client:
+            while (chunks or running) and batch["status"] != "cancelling":
+                if time.time() > expires_at:
+                    status = "expired"
+                    break
+                # Collect the finished chunks and requeue the failed ones.
+                for worker_addr, (task, chunk) in list(running.items()):
+                    if not task.done():
+                        continue
+                    del running[worker_addr]
+                    if task.exception() is not None:
+                        key = id(chunk)
+                        retries[key] = retries.get(key, 0) + 1
+                        logger.warning(f"{batch_id} chunk failed: {task.exception()}")
+                        if retries[key] < BATCH_JOB_MAX_RETRIES:
+                            chunks.insert(0, chunk)
+                        else:
+                            for request, _ in chunk[1]:
+                                self.append_result(
+                                    batch,
+                                    request,
+                                    error={
+                                        "code": "worker_error",
+                                        "message": str(task.exception()),
+                                    },
+                                )
+                            self.save_batch(batch)
+
+                # Give a chunk to every idle worker of the model.
+                try:
+                    ret = await client.post(
+                        self.controller_address + "/get_worker_addresses",
+                        json={"model": model_name},
+                    )
+                    worker_addrs = ret.json()["addresses"]
+                except (httpx.HTTPError, KeyError, ValueError) as e:
+                    logger.warning(f"Cannot list workers: {e}")
+                    worker_addrs = []
+                if worker_addrs or running:
+                    last_worker_time = time.time()
+                elif time.time() - last_worker_time > BATCH_JOB_NO_WORKER_TIMEOUT:
+                    status = "failed"
+                    break
+                for worker_addr in worker_addrs:
+                    if not chunks:
+                        break
+                    if worker_addr in running:
+                        continue
+                    if not await self.worker_is_idle(client, worker_addr):
+                        continue
+                    chunk = chunks.pop(0)
+                    task = asyncio.create_task(
+                        self.run_chunk(client, worker_addr, batch, chunk)
+                    )
+                    running[worker_addr] = (task, chunk)
+
+                await asyncio.sleep(BATCH_JOB_POLL_INTERVAL)
+
+            # On cancellation or expiry, let the chunks in flight finish.
+            for task, chunk in running.values():
+                try:
+                    await task
+                except Exception as e:
+                    logger.warning(f"{batch_id} chunk failed: {e}")
+                    chunks.append(chunk)
+
+        if batch["status"] == "cancelling":
+            self.finish(batch, "cancelled")
+            self.tasks.pop(batch_id, None)
+            return
+
+        if status == "expired":
+            error = {
+                "code": "batch_expired",
+                "message": "The request was not run within the completion window",
+            }
+        elif status == "failed":
+            message = f"No worker serves the model {model_name}"
+            error = {"code": "model_not_found", "message": message}
+            batch["errors"] = {"object": "list", "data": [error]}
+        for chunk in chunks:
+            for request, _ in chunk[1]:
+                self.append_result(batch, request, error=error)
+        batch["finalizing_at"] = int(time.time())
+        self.finish(batch, status)
+        self.tasks.pop(batch_id, None)
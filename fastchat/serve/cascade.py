@@ -0,0 +1,109 @@
+"""
+Model cascades: run a request on a cheap model first and escalate to a larger
+one when the answer looks unreliable.
+
+A cascade is a list of tiers, from the cheapest model to the most expensive.
+The output of a tier is accepted when it has no error, its mean token log-prob
+is at least `min_mean_logprob`, and it matches `format_regex`. The last tier
+is always accepted. Per-tier counters are kept to tune the thresholds.
+
+Tiers with `min_mean_logprob` generate with `full_vocab_logprobs`, so that an
+`allowed_output` restriction does not inflate the mean log-prob: the tokens
+are sampled from the allowed set, but scored over the full vocabulary.
+
+A cascade config file is a JSON list:
+[
+    {
+        "name": "vicuna-cascade",
+        "tiers": [
+            {"model": "vicuna-7b-v1.1", "min_mean_logprob": -0.4,
+             "format_regex": "Brand name:.+\\nDevice:.+\\nColor:.+"},
+            {"model": "vicuna-13b-v1.1"}
+        ]
+    }
+]
+"""
+import dataclasses
+import json
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+@dataclasses.dataclass
+class CascadeTier:
+    model: str
+    # Escalate if the mean log-prob of the generated tokens is lower.
+    min_mean_logprob: Optional[float] = None
+    # Escalate if the stripped output does not fully match this pattern.
+    format_regex: Optional[str] = None
+
+    def is_confident(self, output: Dict[str, Any]) -> bool:
+        if output.get("error_code", 0) != 0:
+            return False
+        if self.min_mean_logprob is not None:
+            mean_logprob = output.get("mean_logprob")
+            if mean_logprob is None or mean_logprob < self.min_mean_logprob:
+                return False
+        if self.format_regex is not None:
+            if re.fullmatch(self.format_regex, output["text"].strip(), re.S) is None:
+                return False
+        return True
+
+
+class Cascade:
+    def __init__(self, name: str, tiers: List[CascadeTier]):
+        if not tiers:
+            raise ValueError(f"Cascade {name} has no tiers")
+        self.name = name
+        self.tiers = tiers
+        self.lock = threading.Lock()
+        self.stats = [{"requests": 0, "accepted": 0} for _ in tiers]
+
+    def accept(self, tier_index: int, output: Dict[str, Any]) -> bool:
+        """Decide whether the output of a tier is final and record the decision."""
+        is_last = tier_index == len(self.tiers) - 1
+        accepted = is_last or self.tiers[tier_index].is_confident(output)
+        with self.lock:
+            self.stats[tier_index]["requests"] += 1
+            self.stats[tier_index]["accepted"] += int(accepted)
+        return accepted
+
+    async def run(
+        self, generate: Callable[[str], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """Call generate(model_name) tier by tier until an output is accepted.
+        The returned output has the serving model under "model"."""
+        for i, tier in enumerate(self.tiers):
+            output = await generate(tier.model)
+            if self.accept(i, output):
+                output["model"] = tier.model
+                return output
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.stats[0]["requests"]
+            tiers = []
+            for tier, stats in zip(self.tiers, self.stats):
+                tiers.append(
+                    {
+                        "model": tier.model,
+                        "requests": stats["requests"],
+                        "accepted": stats["accepted"],
+                        # The share of all cascade requests answered by this tier.
+                        "hit_rate": stats["accepted"] / total if total else 0.0,
+                        "min_mean_logprob": tier.min_mean_logprob,
+                        "format_regex": tier.format_regex,
+                    }
+                )
+        return {"name": self.name, "requests": total, "tiers": tiers}
+
+
+def load_cascades(path: str) -> Dict[str, Cascade]:
+    with open(path) as fin:
+        configs = json.load(fin)
+    cascades = {}
+    for config in configs:
+        tiers = [CascadeTier(**tier) for tier in config["tiers"]]
+        cascades[config["name"]] = Cascade(config["name"], tiers)
+    return cascades
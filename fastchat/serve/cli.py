@@ -170,6 +170,13 @@ def main(args):
             args.max_new_tokens,
             chatio,
             args.debug,
+            args.kv_window,
+            args.sdpa_attn,
+            args.compile_decode,
+            args.compile_slots,
+            args.compile_cache_dir,
+            args.cpu_dtype,
+            args.session_cache_gb,
         )
     except KeyboardInterrupt:
         print("exit...")
@@ -191,6 +198,38 @@ if __name__ == "__main__":
         choices=["simple", "rich", "programmatic"],
         help="Display style.",
     )
+    parser.add_argument(
+        "--kv-window",
+        type=int,
+        default=None,
+        help="Keep the attention sinks and a rolling window of this many KV "
+        "entries instead of truncating long chats (LLaMA-based models only)",
+    )
+    parser.add_argument(
+        "--compile-decode",
+        action="store_true",
+        help="Decode with a torch.compile'd step over a static KV buffer "
+        "(LLaMA models on one device only)",
+    )
+    parser.add_argument(
+        "--compile-slots",
+        type=int,
+        default=1,
+        help="The number of sequences that can use the compiled step at once",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=str,
+        default=None,
+        help="Cache the compiled kernels here across runs",
+    )
+    parser.add_argument(
+        "--session-cache-gb",
+        type=float,
+        default=0,
+        help="Keep the KV cache between turns in this much device memory in GiB, "
+        "so a turn only prefills the new message. 0 disables it",
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -177,6 +177,13 @@ class Controller:
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
+    def get_worker_addresses(self, model_name: str):
+        return [
+            w_name
+            for w_name, w_info in self.worker_info.items()
+            if model_name in w_info.model_names
+        ]
+
     def receive_heart_beat(self, worker_name: str, queue_length: int):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
@@ -311,6 +318,13 @@ async def get_worker_address(request: Request):
     return {"address": addr}
 
 
+@app.post("/get_worker_addresses")
+async def get_worker_addresses(request: Request):
+    data = await request.json()
+    addrs = controller.get_worker_addresses(data["model"])
+    return {"addresses": addrs}
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
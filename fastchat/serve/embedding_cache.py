@@ -0,0 +1,174 @@
+"""
+A content-addressed embedding cache backed by append-only files on disk.
+
+The cache directory holds four files:
+- meta.json: the embedding dimension.
+- keys.bin: one record per cached text, a 16-byte digest of
+  (model, pooling mode, text) followed by the token count as uint32.
+- vectors.bin: the float32 embeddings, row i belongs to record i.
+- cache.lock: locked by a process while it appends to the files.
+
+Both data files are only ever appended to, and vectors.bin is read through a
+memory map, so a warm cache survives restarts without loading it into RAM.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+DIGEST_SIZE = 16
+KEY_RECORD_SIZE = DIGEST_SIZE + 4
+
+
+def embedding_cache_key(model_name: str, mode: str, text: str) -> bytes:
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for part in (model_name, mode, text):
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.digest()
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """An exclusive lock shared by all processes that use a cache directory."""
+    import fcntl
+
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """Several workers may share a cache directory. Appends take a file lock,
+    and each process reads the records appended by the others before it
+    writes, so rows are numbered from the size of vectors.bin."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.keys_path = os.path.join(cache_dir, "keys.bin")
+        self.vectors_path = os.path.join(cache_dir, "vectors.bin")
+        self.meta_path = os.path.join(cache_dir, "meta.json")
+        self.lock_path = os.path.join(cache_dir, "cache.lock")
+        self.lock = threading.Lock()
+
+        # Dict[digest -> (row, token_num)]
+        self.index = {}
+        # The number of records read from the files.
+        self.num_rows = 0
+        self.dim = None
+        self.vectors = None
+        os.makedirs(cache_dir, exist_ok=True)
+        with file_lock(self.lock_path):
+            self._sync()
+
+    def _sync(self):
+        """Read the records appended since the last call, also by other
+        processes. Must hold the file lock."""
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as fin:
+                self.dim = json.load(fin)["dim"]
+        row_bytes = self.dim * 4
+        keys_size = vectors_size = 0
+        if os.path.exists(self.keys_path):
+            keys_size = os.path.getsize(self.keys_path)
+        if os.path.exists(self.vectors_path):
+            vectors_size = os.path.getsize(self.vectors_path)
+        # Drop a partially written trailing record, e.g. after a crash.
+        num_rows = min(keys_size // KEY_RECORD_SIZE, vectors_size // row_bytes)
+        if keys_size != num_rows * KEY_RECORD_SIZE:
+            os.truncate(self.keys_path, num_rows * KEY_RECORD_SIZE)
+        if vectors_size != num_rows * row_bytes:
+            os.truncate(self.vectors_path, num_rows * row_bytes)
+        if num_rows == self.num_rows:
+            return
+
+        with open(self.keys_path, "rb") as fin:
+            fin.seek(self.num_rows * KEY_RECORD_SIZE)
+            records = fin.read((num_rows - self.num_rows) * KEY_RECORD_SIZE)
+        for i, row in enumerate(range(self.num_rows, num_rows)):
+            record = records[i * KEY_RECORD_SIZE : (i + 1) * KEY_RECORD_SIZE]
+            token_num = int.from_bytes(record[DIGEST_SIZE:], "little")
+            # A key written twice, e.g. by two workers at once, maps to its
+            # last record.
+            self.index[record[:DIGEST_SIZE]] = (row, token_num)
+        self.num_rows = num_rows
+        self._remap()
+
+    def _remap(self):
+        if self.num_rows == 0:
+            self.vectors = None
+        else:
+            self.vectors = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.num_rows, self.dim),
+            )
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, keys: List[bytes]) -> List[Optional[Tuple[np.ndarray, int]]]:
+        """Return (embedding, token_num) for every key, or None on a miss."""
+        with self.lock:
+            if any(key not in self.index for key in keys):
+                # Read the records appended by other processes since the last
+                # sync before reporting a miss.
+                with file_lock(self.lock_path):
+                    self._sync()
+            ret = []
+            for key in keys:
+                hit = self.index.get(key)
+                if hit is None:
+                    ret.append(None)
+                else:
+                    row, token_num = hit
+                    ret.append((np.array(self.vectors[row]), token_num))
+            return ret
+
+    def put(self, keys: List[bytes], embeddings: np.ndarray, token_nums: List[int]):
+        """Append new embeddings. Keys that are already cached are skipped."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self.lock, file_lock(self.lock_path):
+            self._sync()
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                with open(self.meta_path, "w") as fout:
+                    json.dump({"dim": self.dim}, fout)
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {embeddings.shape[1]} does not match "
+                    f"the cache dimension {self.dim}"
+                )
+
+            new_rows = []
+            seen = set()
+            for i, key in enumerate(keys):
+                if key not in self.index and key not in seen:
+                    seen.add(key)
+                    new_rows.append(i)
+            if not new_rows:
+                return
+
+            # Write the vectors before the keys, so that a crash never leaves
+            # a key without its vector.
+            with open(self.vectors_path, "ab") as fout:
+                fout.write(embeddings[new_rows].tobytes())
+            with open(self.keys_path, "ab") as fout:
+                for i in new_rows:
+                    fout.write(keys[i] + int(token_nums[i]).to_bytes(4, "little"))
+
+            for i in new_rows:
+                self.index[keys[i]] = (self.num_rows, int(token_nums[i]))
+                self.num_rows += 1
+            self._remap()
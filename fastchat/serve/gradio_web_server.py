@@ -259,7 +259,15 @@ def post_process_code(code):
 
 
 def model_worker_stream_iter(
-    conv, model_name, worker_addr, prompt, temperature, repetition_penalty, top_p, max_new_tokens
+    conv,
+    model_name,
+    worker_addr,
+    prompt,
+    temperature,
+    repetition_penalty,
+    top_p,
+    max_new_tokens,
+    session_id=None,
 ):
     # Make requests
     gen_params = {
@@ -272,6 +280,8 @@ def model_worker_stream_iter(
         "stop": conv.stop_str,
         "stop_token_ids": conv.stop_token_ids,
         "echo": False,
+        # Lets the worker reuse the KV cache of the previous turns.
+        "session_id": session_id,
     }
     logger.info(f"==== request ====\n{gen_params}")
 
@@ -352,7 +362,15 @@ def http_bot(state, temperature, top_p, max_new_tokens, request: gr.Request):
         else:
             repetition_penalty = 1.0
         stream_iter = model_worker_stream_iter(
-            conv, model_name, worker_addr, prompt, temperature, repetition_penalty, top_p, max_new_tokens
+            conv,
+            model_name,
+            worker_addr,
+            prompt,
+            temperature,
+            repetition_penalty,
+            top_p,
+            max_new_tokens,
+            state.conv_id,
         )
 
     conv.messages[-1][-1] = "▌"
@@ -24,6 +24,8 @@ def main(args):
         args.load_8bit,
         args.cpu_offloading,
         debug=args.debug,
+        sdpa_attn=args.sdpa_attn,
+        cpu_dtype=args.cpu_dtype,
     )
 
     msg = args.message
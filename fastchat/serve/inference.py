@@ -1,9 +1,13 @@
 """Inference for FastChat models."""
 import abc
+import contextlib
+import functools
 import gc
+import inspect
 import math
 from typing import Iterable, Optional
 import sys
+import threading
 import warnings
 
 import psutil
@@ -27,8 +31,19 @@ from transformers.generation.logits_process import (
 )
 
 from fastchat.conversation import get_conv_template, SeparatorStyle
-from fastchat.model.model_adapter import load_model, get_conversation_template
+from fastchat.model.compiled_decode import StaticSequence, acquire_static_sequence
+from fastchat.model.kv_cache import (
+    AttentionSinkWindow,
+    PagedSequences,
+    new_paged_sequences,
+)
+from fastchat.model.model_adapter import (
+    load_model,
+    get_conversation_template,
+    get_model_adapter,
+)
 from fastchat.model.chatglm_model import chatglm_generate_stream
+from fastchat.serve.session_cache import SessionCache
 
 
 def prepare_logits_processor(
@@ -54,6 +69,311 @@ def partial_stop(output, stop_str):
     return False
 
 
+def apply_stop_str(output, stop_str, rfind_start):
+    """Truncate the output at the first stop string found after rfind_start.
+
+    Returns the (possibly truncated) output, whether a stop string was found,
+    and whether the output ends with a prefix of a stop string.
+    """
+    stopped = False
+    partially_stopped = False
+    if stop_str:
+        if isinstance(stop_str, str):
+            pos = output.rfind(stop_str, rfind_start)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
+            else:
+                partially_stopped = partial_stop(output, stop_str)
+        elif isinstance(stop_str, Iterable):
+            for each_stop in stop_str:
+                pos = output.rfind(each_stop, rfind_start)
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                    break
+                else:
+                    partially_stopped = partial_stop(output, each_stop)
+                    if partially_stopped:
+                        break
+        else:
+            raise ValueError("Invalid stop field type.")
+    return output, stopped, partially_stopped
+
+
+# The longest a background turn of FairStepLock waits for other requests.
+BACKGROUND_MAX_WAIT = 2.0
+
+
+class FairStepLock:
+    """A FIFO lock around single forward passes of a shared model.
+
+    Concurrent requests take turns in the order they asked, so a request that
+    prefills a long prompt chunk by chunk lets the decode steps of the other
+    requests run between its chunks. Turns taken in a `background()` block
+    wait until no request registered with `add_request` is in flight, for at
+    most BACKGROUND_MAX_WAIT seconds per turn, so a request that was never
+    removed does not stall them for good.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.num_requests = 0
+        self.local = threading.local()
+
+    def add_request(self):
+        with self.cond:
+            self.num_requests += 1
+
+    def remove_request(self):
+        with self.cond:
+            self.num_requests -= 1
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def background(self, enabled: bool = True):
+        """Give the turns of the current thread a lower priority."""
+        self.local.background = enabled
+        try:
+            yield
+        finally:
+            self.local.background = False
+
+    def __enter__(self):
+        background = getattr(self.local, "background", False)
+        with self.cond:
+            if background:
+                self.cond.wait_for(lambda: self.num_requests == 0, BACKGROUND_MAX_WAIT)
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving:
+                self.cond.wait()
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.serving += 1
+            self.cond.notify_all()
+
+
+model_step_lock = FairStepLock()
+
+
+def get_lm_head(model):
+    """The output projection of a decoder-only model with a separate base model."""
+    if model.config.is_encoder_decoder or model.base_model is model:
+        return None
+    return model.get_output_embeddings()
+
+
+def forward_last_logits(model, head, **kwargs):
+    """Run one forward pass and project only the last position to logits.
+
+    Return (past_key_values, logits of shape [batch, 1, vocab]). Without a
+    head, fall back to the full model call. With PagedSequences or a
+    StaticSequence as past_key_values, the attention mask and position ids are
+    ignored.
+    """
+    past_key_values = kwargs.get("past_key_values", None)
+    if isinstance(past_key_values, (PagedSequences, StaticSequence)):
+        return past_key_values.forward(model, head, kwargs["input_ids"])
+    if head is None:
+        out = model(**kwargs)
+        return out.past_key_values, out.logits[:, -1:, :]
+    out = model.base_model(**kwargs)
+    return out.past_key_values, head(out[0][:, -1:, :])
+
+
+def prefill(
+    model,
+    head,
+    input_ids,
+    chunk_size=None,
+    attention_mask=None,
+    position_ids=None,
+    past_key_values=None,
+    evict=None,
+):
+    """Run the prompt through the model in chunks of chunk_size tokens.
+
+    Each chunk is a separate turn of model_step_lock, so other requests can
+    decode in between, and only the logits of the last position are computed.
+    input_ids is a [batch, seq_len] tensor; attention_mask and position_ids
+    cover the whole prompt if given. past_key_values may be new PagedSequences.
+    evict, e.g. an AttentionSinkWindow, cuts the cache after every chunk.
+    """
+    seq_len = input_ids.shape[1]
+    chunk_size = chunk_size or seq_len
+    logits = None
+    for start in range(0, seq_len, chunk_size):
+        end = min(start + chunk_size, seq_len)
+        kwargs = {"input_ids": input_ids[:, start:end], "use_cache": True}
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+        if attention_mask is not None:
+            kwargs["attention_mask"] = attention_mask[:, :end]
+        if position_ids is not None:
+            kwargs["position_ids"] = position_ids[:, start:end]
+        with model_step_lock:
+            past_key_values, logits = forward_last_logits(model, head, **kwargs)
+        if evict is not None:
+            past_key_values = evict(past_key_values)
+    return past_key_values, logits
+
+
+class RestrictedVocabHead:
+    """An output projection over an allowed subset of the vocabulary.
+
+    Only the rows of the lm_head weight that belong to the allowed tokens take
+    part in the matmul, and only for the last position. The returned logits
+    still span the full vocabulary, with -inf outside the allowed set, so the
+    logits processors and the sampling code work unchanged. The logits of the
+    allowed tokens are exactly those of the full head, but the log-probs
+    computed from them are normalized over the allowed set only, i.e. they are
+    conditioned on the output being restricted.
+
+    With full_vocab_logprobs, e.g. for the confidence of a cascade tier, the
+    full head is computed after all and its log-normalizer is kept in
+    log_normalizer, so that get_logprobs returns the log-probs of the
+    unrestricted model. Only the sampling is restricted then.
+    """
+
+    def __init__(
+        self,
+        lm_head: torch.nn.Linear,
+        allowed_token_ids,
+        full_vocab_logprobs: bool = False,
+    ):
+        self.vocab_size = lm_head.weight.shape[0]
+        self.ids = torch.as_tensor(
+            sorted(set(allowed_token_ids)), device=lm_head.weight.device
+        )
+        self.full_head = lm_head if full_vocab_logprobs else None
+        self.weight = lm_head.weight[self.ids]
+        self.bias = None if lm_head.bias is None else lm_head.bias[self.ids]
+        # The logsumexp of the full logits of the last call, [batch, 1].
+        self.log_normalizer = None
+
+    def __call__(self, hidden_states):
+        if self.full_head is not None:
+            full_logits = self.full_head(hidden_states[:, -1:, :])
+            self.log_normalizer = torch.logsumexp(full_logits.float(), dim=-1)
+            sub_logits = full_logits[:, :, self.ids]
+        else:
+            sub_logits = torch.nn.functional.linear(
+                hidden_states[:, -1:, :], self.weight, self.bias
+            )
+        logits = sub_logits.new_full(
+            (*sub_logits.shape[:2], self.vocab_size), float("-inf")
+        )
+        logits[:, :, self.ids] = sub_logits
+        return logits
+
+
+def get_logprobs(head, logits):
+    """Log-probs of logits of shape [batch, vocab] from head. They are normalized
+    over the full vocabulary if the head is a RestrictedVocabHead that keeps its
+    log-normalizer, and over the finite logits otherwise."""
+    log_normalizer = getattr(head, "log_normalizer", None)
+    if log_normalizer is None:
+        return torch.log_softmax(logits.float(), dim=-1)
+    return logits.float() - log_normalizer.to(logits.device)
+
+
+@functools.lru_cache(maxsize=8)
+def get_vocab_strings(tokenizer):
+    """Return ({text of a token: token ids}, the longest text length), with the
+    word boundary marker of SentencePiece spelled as a space."""
+    special_ids = set(tokenizer.all_special_ids)
+    strings = {}
+    for token, token_id in tokenizer.get_vocab().items():
+        if token_id in special_ids:
+            continue
+        if "\u2581" in token:
+            string = token.replace("\u2581", " ")
+        else:
+            string = tokenizer.convert_tokens_to_string([token])
+        if string:
+            strings.setdefault(string, []).append(token_id)
+    return strings, max(map(len, strings), default=0)
+
+
+def get_allowed_token_ids(tokenizer, texts, stop_token_ids):
+    """The tokens needed to copy from the texts: every token of the vocabulary
+    whose text occurs in a text (or in it after a space), the tokens of every
+    single character, the digits and the stop tokens."""
+    ids = set(stop_token_ids)
+    strings, max_len = get_vocab_strings(tokenizer)
+    for text in texts:
+        text = " " + text
+        for start in range(len(text)):
+            for end in range(start + 1, min(start + max_len, len(text)) + 1):
+                ids.update(strings.get(text[start:end], ()))
+    # Characters without a token of their own, e.g. byte fallback tokens.
+    for char in set("".join(texts)) | set("0123456789"):
+        ids.update(tokenizer(char, add_special_tokens=False).input_ids)
+    ids.discard(None)
+    return ids
+
+
+def get_restricted_head(
+    model,
+    tokenizer,
+    allowed_output,
+    stop_token_ids,
+    stop_str=None,
+    full_vocab_logprobs=False,
+):
+    """Return a RestrictedVocabHead if the request and the model allow it."""
+    if not allowed_output or model.config.is_encoder_decoder:
+        return None
+    if stop_str:
+        # The stop strings must stay reachable.
+        stop_strs = [stop_str] if isinstance(stop_str, str) else list(stop_str)
+        allowed_output = list(allowed_output) + stop_strs
+    lm_head = model.get_output_embeddings()
+    if not isinstance(lm_head, torch.nn.Linear) or model.base_model is model:
+        # e.g. compressed 8-bit weights, which cannot be sliced.
+        return None
+    return RestrictedVocabHead(
+        lm_head,
+        get_allowed_token_ids(tokenizer, allowed_output, stop_token_ids),
+        full_vocab_logprobs,
+    )
+
+
+def record_logprobs(ret_logprobs, tokenizer, token_logprobs, token, num_top):
+    """Append a sampled token to logprobs in the OpenAI completions format."""
+    token_str = tokenizer.decode([token])
+    if ret_logprobs["tokens"]:
+        offset = ret_logprobs["text_offset"][-1] + len(ret_logprobs["tokens"][-1])
+    else:
+        offset = 0
+    ret_logprobs["tokens"].append(token_str)
+    ret_logprobs["text_offset"].append(offset)
+    ret_logprobs["token_logprobs"].append(float(token_logprobs[token]))
+    if num_top:
+        top = torch.topk(token_logprobs, num_top)
+        ret_logprobs["top_logprobs"].append(
+            {
+                tokenizer.decode([int(i)]): float(v)
+                for v, i in zip(top.values.tolist(), top.indices.tolist())
+            }
+        )
+    else:
+        ret_logprobs["top_logprobs"].append(None)
+
+
+def new_logprobs():
+    return {
+        "text_offset": [],
+        "token_logprobs": [],
+        "tokens": [],
+        "top_logprobs": [],
+    }
+
+
 @torch.inference_mode()
 def generate_stream(
     model, tokenizer, params, device, context_len=2048, stream_interval=2
@@ -69,6 +389,32 @@ def generate_stream(
     echo = bool(params.get("echo", True))
     stop_token_ids = params.get("stop_token_ids", None) or []
     stop_token_ids.append(tokenizer.eos_token_id)
+    # The number of top log-probs to return per token, as in the OpenAI API.
+    num_logprobs = params.get("logprobs", None)
+    ret_logprobs = None if num_logprobs is None else new_logprobs()
+    # Restrict the output to the tokens of these texts, see RestrictedVocabHead.
+    restricted_head = get_restricted_head(
+        model,
+        tokenizer,
+        params.get("allowed_output", None),
+        stop_token_ids,
+        stop_str,
+        bool(params.get("full_vocab_logprobs", False)),
+    )
+
+    head = restricted_head or get_lm_head(model)
+    prefill_chunk_size = params.get("prefill_chunk_size", None)
+    decode_steps = max(int(params.get("decode_steps", None) or 1), 1)
+    # Keep the attention sinks and a rolling window of the KV cache instead of
+    # truncating long prompts.
+    kv_window = params.get("kv_window", None)
+    evict = None
+    if kv_window and not model.config.is_encoder_decoder:
+        evict = AttentionSinkWindow(model, params["attention_sinks"], kv_window)
+        # Every chunk must fit into the context next to the window.
+        prefill_chunk_size = min(
+            prefill_chunk_size or context_len, context_len - kv_window
+        )
 
     logits_processor = prepare_logits_processor(
         temperature, repetition_penalty, top_p, top_k
@@ -83,70 +429,150 @@ def generate_stream(
     else:
         max_src_len = context_len - max_new_tokens - 8
 
-    input_ids = input_ids[-max_src_len:]
+    if evict is None:
+        input_ids = input_ids[-max_src_len:]
 
+    # Reuse the KV cache of the previous turn of a session, see SessionCache.
+    session_cache = getattr(model, "session_cache", None)
+    session_id = params.get("session_id", None)
     if model.config.is_encoder_decoder:
-        encoder_output = model.encoder(
-            input_ids=torch.as_tensor([input_ids], device=device)
-        )[0]
+        session_cache = None
+
+    if model.config.is_encoder_decoder:
+        with model_step_lock:
+            encoder_output = model.encoder(
+                input_ids=torch.as_tensor([input_ids], device=device)
+            )[0]
         start_ids = torch.as_tensor(
             [[model.generation_config.decoder_start_token_id]],
             dtype=torch.int64,
             device=device,
         )
 
-    past_key_values = out = None
+    out = None
+    past_key_values = new_paged_sequences(model, 1)
+    num_reused = 0
+    if session_cache is not None and session_id and past_key_values is None:
+        past_key_values, num_reused = session_cache.reuse(session_id, input_ids)
+    # The sum of the log-probs of the sampled tokens under the unprocessed
+    # model distribution. Their mean is a cheap confidence signal.
+    sum_logprob = 0.0
+    # Tokens sampled on the device but not yet processed on the host. With
+    # multi-step decode, decode_steps tokens are sampled back to back, and the
+    # host only syncs once per burst.
+    pending = []
+    # The prompt and the sampled tokens on the device, for the repetition
+    # penalty, so that no step copies the ids from the host.
+    penalty_ids = None
     for i in range(max_new_tokens):
-        if i == 0:
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=start_ids,
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                )
-                logits = model.lm_head(out[0])
-            else:
-                out = model(torch.as_tensor([input_ids], device=device), use_cache=True)
-                logits = out.logits
-            past_key_values = out.past_key_values
-        else:
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=torch.as_tensor([[token]], device=device),
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                    past_key_values=past_key_values,
-                )
+        if not pending:
+            for j in range(min(decode_steps, max_new_tokens - i)):
+                if i + j == 0:
+                    if model.config.is_encoder_decoder:
+                        with model_step_lock:
+                            out = model.decoder(
+                                input_ids=start_ids,
+                                encoder_hidden_states=encoder_output,
+                                use_cache=True,
+                            )
+                            logits = model.lm_head(out[0])
+                        past_key_values = out.past_key_values
+                    else:
+                        past_key_values, logits = prefill(
+                            model,
+                            head,
+                            torch.as_tensor([input_ids[num_reused:]], device=device),
+                            prefill_chunk_size,
+                            past_key_values=past_key_values,
+                            evict=evict,
+                        )
+                        if evict is None:
+                            # Decode with the compiled step if the model has one.
+                            past_key_values = (
+                                acquire_static_sequence(
+                                    model, past_key_values, max_new_tokens
+                                )
+                                or past_key_values
+                            )
+                else:
+                    if model.config.is_encoder_decoder:
+                        with model_step_lock:
+                            out = model.decoder(
+                                input_ids=last_token.view(1, 1).to(device),
+                                encoder_hidden_states=encoder_output,
+                                use_cache=True,
+                                past_key_values=past_key_values,
+                            )
+                            logits = model.lm_head(out[0])
+                        past_key_values = out.past_key_values
+                    else:
+                        with model_step_lock:
+                            past_key_values, logits = forward_last_logits(
+                                model,
+                                head,
+                                input_ids=last_token.view(1, 1).to(device),
+                                use_cache=True,
+                                past_key_values=past_key_values,
+                            )
+                        if evict is not None:
+                            past_key_values = evict(past_key_values)
 
-                logits = model.lm_head(out[0])
-            else:
-                out = model(
-                    input_ids=torch.as_tensor([[token]], device=device),
-                    use_cache=True,
-                    past_key_values=past_key_values,
-                )
-                logits = out.logits
-            past_key_values = out.past_key_values
+                if logits_processor:
+                    if repetition_penalty > 1.0:
+                        if penalty_ids is None:
+                            penalty_ids = torch.as_tensor(
+                                output_ids, device=logits.device
+                            )
+                        tmp_output_ids = penalty_ids.unsqueeze(0)
+                    else:
+                        tmp_output_ids = None
+                    last_token_logits = logits_processor(
+                        tmp_output_ids, logits[:, -1, :]
+                    )[0]
+                else:
+                    last_token_logits = logits[0, -1, :]
 
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
+                if device == "mps":
+                    # Switch to CPU by avoiding some bugs in mps backend.
+                    last_token_logits = last_token_logits.float().to("cpu")
 
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
+                if temperature < 1e-5 or top_p < 1e-8:  # greedy
+                    last_token = torch.argmax(last_token_logits)
+                else:
+                    probs = torch.softmax(last_token_logits, dim=-1)
+                    last_token = torch.multinomial(probs, num_samples=1)[0]
 
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            token = int(torch.argmax(last_token_logits))
-        else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            token = int(torch.multinomial(probs, num_samples=1))
+                if penalty_ids is not None:
+                    penalty_ids = torch.cat(
+                        [penalty_ids, last_token.view(1).to(penalty_ids.device)]
+                    )
+                # Normalized over the allowed tokens with a RestrictedVocabHead,
+                # unless the request asks for full_vocab_logprobs.
+                token_logprobs = get_logprobs(head, logits[:, -1, :])[0]
+                pending.append(
+                    (
+                        last_token,
+                        token_logprobs[last_token.to(token_logprobs.device)],
+                        token_logprobs if ret_logprobs is not None else None,
+                    )
+                )
+
+            # The only device to host sync of the burst.
+            tokens = torch.stack([t for t, _, _ in pending]).tolist()
+            logprobs = torch.stack([lp for _, lp, _ in pending]).tolist()
+            pending = [
+                (token, logprob, token_logprobs)
+                for token, logprob, (_, _, token_logprobs) in zip(
+                    tokens, logprobs, pending
+                )
+            ]
 
+        token, logprob, token_logprobs = pending.pop(0)
+        sum_logprob += logprob
+        if ret_logprobs is not None:
+            record_logprobs(
+                ret_logprobs, tokenizer, token_logprobs, token, num_logprobs
+            )
         output_ids.append(token)
 
         if token in stop_token_ids:
@@ -154,7 +580,12 @@ def generate_stream(
         else:
             stopped = False
 
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+        if decode_steps > 1:
+            # Decode and check the stop strings once per burst.
+            sync_point = not pending
+        else:
+            sync_point = i % stream_interval == 0
+        if sync_point or i == max_new_tokens - 1 or stopped:
             if echo:
                 tmp_output_ids = output_ids
                 rfind_start = len_prompt
@@ -168,29 +599,11 @@ def generate_stream(
                 spaces_between_special_tokens=False,
             )
 
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
-            
+            output, str_stopped, partially_stopped = apply_stop_str(
+                output, stop_str, rfind_start
+            )
+            stopped = stopped or str_stopped
+
             # prevent yielding partial stop sequence
             if not partially_stopped:
                 yield {
@@ -200,6 +613,8 @@ def generate_stream(
                         "completion_tokens": i,
                         "total_tokens": input_echo_len + i,
                     },
+                    "mean_logprob": sum_logprob / (i + 1),
+                    "logprobs": ret_logprobs,
                     "finish_reason": None,
                 }
 
@@ -221,15 +636,385 @@ def generate_stream(
             "completion_tokens": i,
             "total_tokens": input_echo_len + i,
         },
+        "mean_logprob": sum_logprob / (i + 1),
+        "logprobs": ret_logprobs,
         "finish_reason": finish_reason,
     }
 
+    if session_cache is not None and isinstance(past_key_values, StaticSequence):
+        past_key_values = past_key_values.to_tuple()
+    if session_cache is not None and session_id and isinstance(past_key_values, tuple):
+        if pending:
+            # Roll back the tokens fed after the stop within the last burst.
+            past_key_values = tuple(
+                (key[:, :, : -len(pending)], value[:, :, : -len(pending)])
+                for key, value in past_key_values
+            )
+        # The last sampled token has not been fed to the model yet.
+        session_cache.put(
+            session_id,
+            input_ids + output_ids[input_echo_len:-1],
+            past_key_values,
+            params.get("attention_sinks", None) or 0,
+        )
+
     # clean
     del past_key_values, out
     gc.collect()
     torch.cuda.empty_cache()
 
 
+@torch.inference_mode()
+def generate_batch(model, tokenizer, params_list, device, context_len=2048):
+    """Generate completions for several prompts with one batched decode loop.
+
+    The prompts are left-padded so that every row ends at the same position and
+    each decode step runs a single forward pass for all unfinished rows. The
+    return value holds one output per prompt, in order, in the same format as
+    the last message of `generate_stream`.
+    """
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+
+    rows = []
+    for params in params_list:
+        prompt = params["prompt"]
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        temperature = float(params.get("temperature", 1.0))
+        repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        top_p = float(params.get("top_p", 1.0))
+        top_k = int(params.get("top_k", -1))  # -1 means disable
+        stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        stop_token_ids.append(tokenizer.eos_token_id)
+        num_logprobs = params.get("logprobs", None)
+
+        input_ids = tokenizer(prompt).input_ids
+        max_src_len = context_len - max_new_tokens - 8
+        rows.append(
+            {
+                "len_prompt": len(prompt),
+                "input_echo_len": len(input_ids),
+                "input_ids": input_ids[-max_src_len:],
+                "output_ids": list(input_ids),
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "repetition_penalty": repetition_penalty,
+                "top_p": top_p,
+                "logits_processor": prepare_logits_processor(
+                    temperature, repetition_penalty, top_p, top_k
+                ),
+                "stop_str": params.get("stop", None),
+                "stop_token_ids": stop_token_ids,
+                "echo": bool(params.get("echo", True)),
+                "output": "",
+                "steps": 0,
+                "sum_logprob": 0.0,
+                "num_logprobs": num_logprobs,
+                "allowed_output": params.get("allowed_output", None),
+                "logprobs": None if num_logprobs is None else new_logprobs(),
+                "finish_reason": None,
+            }
+        )
+
+    max_len = max(len(row["input_ids"]) for row in rows)
+    input_ids = torch.as_tensor(
+        [
+            [pad_token_id] * (max_len - len(row["input_ids"])) + row["input_ids"]
+            for row in rows
+        ],
+        device=device,
+    )
+    attention_mask = torch.as_tensor(
+        [
+            [0] * (max_len - len(row["input_ids"])) + [1] * len(row["input_ids"])
+            for row in rows
+        ],
+        device=device,
+    )
+    # Left padding shifts the positions of rotary/learned position embeddings,
+    # so pass explicit position ids whenever the model accepts them.
+    use_position_ids = "position_ids" in inspect.signature(model.forward).parameters
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    # A restricted head over the union of the allowed sets is only usable if
+    # every row is restricted. Each row is then masked to its own set.
+    restricted_head = None
+    if all(row["allowed_output"] for row in rows):
+        for row in rows:
+            stop_strs = row["stop_str"] or []
+            if isinstance(stop_strs, str):
+                stop_strs = [stop_strs]
+            # The stop strings must stay reachable.
+            row["allowed_output"] = list(row["allowed_output"]) + list(stop_strs)
+            row["allowed_ids"] = torch.as_tensor(
+                sorted(
+                    get_allowed_token_ids(
+                        tokenizer, row["allowed_output"], row["stop_token_ids"]
+                    )
+                ),
+                device=device,
+            )
+        restricted_head = get_restricted_head(
+            model,
+            tokenizer,
+            [t for row in rows for t in row["allowed_output"]],
+            [t for row in rows for t in row["stop_token_ids"]],
+            full_vocab_logprobs=any(
+                p.get("full_vocab_logprobs", False) for p in params_list
+            ),
+        )
+
+    head = restricted_head or get_lm_head(model)
+    prefill_chunk_size = params_list[0].get("prefill_chunk_size", None)
+
+    out = None
+    past_key_values = new_paged_sequences(model, len(rows))
+    max_new_tokens = max(row["max_new_tokens"] for row in rows)
+    for i in range(max_new_tokens):
+        if i == 0 and past_key_values is not None:
+            # Paged sequences need no padding, so prefill the rows one by one.
+            row_logits, log_normalizers = [], []
+            for b, row in enumerate(rows):
+                row_logits.append(
+                    prefill(
+                        model,
+                        head,
+                        torch.as_tensor([row["input_ids"]], device=device),
+                        prefill_chunk_size,
+                        past_key_values=past_key_values.select([b]),
+                    )[1]
+                )
+                log_normalizers.append(getattr(head, "log_normalizer", None))
+            logits = torch.cat(row_logits)
+            if log_normalizers[0] is not None:
+                head.log_normalizer = torch.cat(log_normalizers)
+        elif i == 0:
+            past_key_values, logits = prefill(
+                model,
+                head,
+                input_ids,
+                prefill_chunk_size,
+                attention_mask,
+                position_ids if use_position_ids else None,
+            )
+        else:
+            kwargs = {"attention_mask": attention_mask, "use_cache": True}
+            if use_position_ids:
+                kwargs["position_ids"] = position_ids
+            with model_step_lock:
+                past_key_values, logits = forward_last_logits(
+                    model,
+                    head,
+                    input_ids=next_ids,
+                    past_key_values=past_key_values,
+                    **kwargs,
+                )
+        logits = logits[:, -1, :]
+        if restricted_head is not None:
+            for b, row in enumerate(rows):
+                row_logits = torch.full_like(logits[b], float("-inf"))
+                row_logits[row["allowed_ids"]] = logits[b, row["allowed_ids"]]
+                logits[b] = row_logits
+        # Normalized over the allowed tokens of each row if restricted, unless
+        # a request asks for full_vocab_logprobs.
+        logprobs = get_logprobs(head, logits)
+
+        tokens = []
+        for b, row in enumerate(rows):
+            if row["finish_reason"] is not None:
+                tokens.append(pad_token_id)
+                continue
+
+            last_token_logits = logits[b]
+            if row["logits_processor"]:
+                if row["repetition_penalty"] > 1.0:
+                    tmp_output_ids = torch.as_tensor(
+                        [row["output_ids"]], device=logits.device
+                    )
+                else:
+                    tmp_output_ids = None
+                last_token_logits = row["logits_processor"](
+                    tmp_output_ids, last_token_logits.unsqueeze(0)
+                )[0]
+            if device == "mps":
+                # Switch to CPU by avoiding some bugs in mps backend.
+                last_token_logits = last_token_logits.float().to("cpu")
+
+            if row["temperature"] < 1e-5 or row["top_p"] < 1e-8:  # greedy
+                token = int(torch.argmax(last_token_logits))
+            else:
+                probs = torch.softmax(last_token_logits, dim=-1)
+                token = int(torch.multinomial(probs, num_samples=1))
+            row["output_ids"].append(token)
+            row["sum_logprob"] += float(logprobs[b, token])
+            if row["logprobs"] is not None:
+                record_logprobs(
+                    row["logprobs"], tokenizer, logprobs[b], token, row["num_logprobs"]
+                )
+            row["steps"] = i
+            tokens.append(token)
+
+            stopped = token in row["stop_token_ids"]
+            if row["echo"]:
+                tmp_output_ids = row["output_ids"]
+                rfind_start = row["len_prompt"]
+            else:
+                tmp_output_ids = row["output_ids"][row["input_echo_len"] :]
+                rfind_start = 0
+            output = tokenizer.decode(
+                tmp_output_ids,
+                skip_special_tokens=True,
+                spaces_between_special_tokens=False,
+            )
+            output, str_stopped, _ = apply_stop_str(
+                output, row["stop_str"], rfind_start
+            )
+            row["output"] = output
+
+            if i == row["max_new_tokens"] - 1:
+                row["finish_reason"] = "length"
+            elif stopped or str_stopped:
+                row["finish_reason"] = "stop"
+
+        if all(row["finish_reason"] is not None for row in rows):
+            break
+
+        next_ids = torch.as_tensor(tokens, device=device).unsqueeze(-1)
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1
+        )
+        position_ids = position_ids[:, -1:] + 1
+
+    outputs = []
+    for row in rows:
+        outputs.append(
+            {
+                "text": row["output"],
+                "usage": {
+                    "prompt_tokens": row["input_echo_len"],
+                    "completion_tokens": row["steps"],
+                    "total_tokens": row["input_echo_len"] + row["steps"],
+                },
+                "mean_logprob": row["sum_logprob"] / (row["steps"] + 1),
+                "logprobs": row["logprobs"],
+                "finish_reason": row["finish_reason"],
+            }
+        )
+
+    # clean
+    del past_key_values, out
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    return outputs
+
+
+@torch.inference_mode()
+def score_candidates(
+    model,
+    tokenizer,
+    prompt,
+    candidates,
+    device,
+    context_len=2048,
+    prefill_chunk_size=None,
+):
+    """Return the log-probabilities of candidate continuations of a prompt.
+
+    The prompt is prefilled once. Its KV cache is then shared by all candidates,
+    which are scored together in one right-padded forward pass. Each candidate
+    is tokenized together with the prompt, so tokens that merge across the
+    boundary are handled, and only the tokens after the prompt are scored.
+    """
+    prompt_ids = tokenizer(prompt).input_ids
+    full_ids = [tokenizer(prompt + c).input_ids for c in candidates]
+
+    def common_prefix_len(a, b):
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        return n
+
+    # The first token of each candidate that is not part of the prompt.
+    starts = [common_prefix_len(prompt_ids, ids) for ids in full_ids]
+    # The shared prefix is prefilled once; keep at least one token per row.
+    prefix_len = min(min(starts), min(len(ids) for ids in full_ids) - 1)
+    prefix_len = max(prefix_len, 1)
+    if max(len(ids) for ids in full_ids) > context_len:
+        raise ValueError(
+            f"The prompt and the candidates exceed the context length {context_len}"
+        )
+
+    past_key_values, prefix_logits = prefill(
+        model,
+        get_lm_head(model),
+        torch.as_tensor([full_ids[0][:prefix_len]], device=device),
+        prefill_chunk_size,
+    )
+    prefix_logits = prefix_logits[0, -1]
+    num_rows = len(candidates)
+    past_key_values = tuple(
+        (k.expand(num_rows, -1, -1, -1), v.expand(num_rows, -1, -1, -1))
+        for k, v in past_key_values
+    )
+
+    rows = [ids[prefix_len:] for ids in full_ids]
+    max_len = max(len(row) for row in rows)
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    input_ids = torch.as_tensor(
+        [row + [pad_token_id] * (max_len - len(row)) for row in rows], device=device
+    )
+    attention_mask = torch.as_tensor(
+        [[1] * (prefix_len + len(row)) + [0] * (max_len - len(row)) for row in rows],
+        device=device,
+    )
+    with model_step_lock:
+        out = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+    # The logits that predict row token j are at position j - 1, or come from
+    # the prefill for j = 0.
+    logits = torch.cat(
+        [prefix_logits.expand(len(rows), 1, -1), out.logits[:, :-1]], dim=1
+    )
+    logprobs = torch.log_softmax(logits.float(), dim=-1)
+    token_logprobs = logprobs.gather(-1, input_ids.unsqueeze(-1)).squeeze(-1)
+
+    results = []
+    for b, (row, start) in enumerate(zip(rows, starts)):
+        first = max(start - prefix_len, 0)
+        scored = row[first:]
+        values = token_logprobs[b, first : len(row)].tolist()
+        results.append(
+            {
+                "text": candidates[b],
+                "logprob": sum(values),
+                "tokens": [tokenizer.decode([t]) for t in scored],
+                "token_logprobs": values,
+            }
+        )
+
+    del past_key_values, out
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    return {
+        "scores": results,
+        "usage": {
+            "prompt_tokens": len(prompt_ids),
+            "completion_tokens": sum(len(r["token_logprobs"]) for r in results),
+            "total_tokens": len(prompt_ids)
+            + sum(len(r["token_logprobs"]) for r in results),
+        },
+    }
+
+
 class ChatIO(abc.ABC):
     @abc.abstractmethod
     def prompt_for_input(self, role: str) -> str:
@@ -257,10 +1042,28 @@ def chat_loop(
     max_new_tokens: int,
     chatio: ChatIO,
     debug: bool,
+    kv_window: Optional[int] = None,
+    sdpa_attn: bool = False,
+    compile_decode: bool = False,
+    compile_slots: int = 1,
+    compile_cache_dir: Optional[str] = None,
+    cpu_dtype: str = "float32",
+    session_cache_gb: float = 0,
 ):
     # Model
     model, tokenizer = load_model(
-        model_path, device, num_gpus, max_gpu_memory, load_8bit, cpu_offloading, debug
+        model_path,
+        device,
+        num_gpus,
+        max_gpu_memory,
+        load_8bit,
+        cpu_offloading,
+        debug,
+        sdpa_attn,
+        compile_decode,
+        compile_slots,
+        compile_cache_dir,
+        cpu_dtype,
     )
     is_chatglm = "chatglm" in str(type(model)).lower()
     is_fastchat_t5 = "t5" in str(type(model)).lower()
@@ -269,6 +1072,19 @@ def chat_loop(
     if is_fastchat_t5 and repetition_penalty == 1.0:
         repetition_penalty = 1.2
 
+    # Keep the KV cache between turns, so a turn only prefills the new message.
+    if session_cache_gb and not is_chatglm and not is_fastchat_t5:
+        model.session_cache = SessionCache(device_gb=session_cache_gb)
+
+    # Keep a rolling KV window with attention sinks for long chats.
+    attention_sinks = None
+    if kv_window:
+        attention_sinks = get_model_adapter(model_path).get_attention_sinks(
+            model_path
+        )
+        if attention_sinks is None:
+            raise ValueError(f"{model_path} does not support a rolling KV window")
+
     # Chat
     if conv_template:
         conv = get_conv_template(conv_template)
@@ -284,6 +1100,10 @@ def chat_loop(
             print("exit...")
             break
 
+        if conv.example_pool and len(conv.messages) == conv.offset:
+            conv.select_examples(
+                inp, count_tokens=lambda text: len(tokenizer(text).input_ids)
+            )
         conv.append_message(conv.roles[0], inp)
         conv.append_message(conv.roles[1], None)
 
@@ -303,6 +1123,9 @@ def chat_loop(
             "stop": conv.stop_str,
             "stop_token_ids": conv.stop_token_ids,
             "echo": False,
+            "attention_sinks": attention_sinks,
+            "kv_window": kv_window,
+            "session_id": "cli",
         }
 
         chatio.prompt_for_output(conv.roles[1])
@@ -311,4 +1134,7 @@ def chat_loop(
         conv.messages[-1][-1] = outputs.strip()
 
         if debug:
-            print("\n", {"prompt": prompt, "outputs": outputs}, "\n")
\ No newline at end of file
+            print("\n", {"prompt": prompt, "outputs": outputs}, "\n")
+            static_decoder = getattr(model, "static_decoder", None)
+            if static_decoder is not None:
+                print({"compiled_decode": static_decoder.get_stats()}, "\n")
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""
+Launch one model worker per NUMA node, or per core set, of a CPU host.
+
+A single worker spreads its threads over every socket and keeps fetching
+weights across the interconnect. Here each worker process is pinned to the
+cores and the memory of one NUMA node (with numactl if available, or with a
+CPU affinity mask otherwise), gets intra-op threads for its cores only, and
+registers with the controller on its own port, so throughput grows with the
+number of sockets.
+
+All arguments after "--" are passed to every fastchat.serve.model_worker.
+
+Usage:
+python3 -m fastchat.serve.launch_cpu_workers --port 31000 \
+    --controller-address http://localhost:21001 \
+    -- --model-path /path/to/vicuna-13b --device cpu --cpu-dtype bfloat16
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import warnings
+from typing import Dict, List, Tuple
+
+NODE_DIR = "/sys/devices/system/node"
+CPU_DIR = "/sys/devices/system/cpu"
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Parse a Linux CPU list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_numa_nodes() -> Dict[int, List[int]]:
+    """The CPUs of every NUMA node that this process may run on."""
+    allowed = set(os.sched_getaffinity(0))
+    nodes = {}
+    if os.path.isdir(NODE_DIR):
+        for name in sorted(os.listdir(NODE_DIR)):
+            if not (name.startswith("node") and name[4:].isdigit()):
+                continue
+            with open(os.path.join(NODE_DIR, name, "cpulist")) as f:
+                cpus = [cpu for cpu in parse_cpu_list(f.read()) if cpu in allowed]
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    if not nodes:
+        nodes = {0: sorted(allowed)}
+    return nodes
+
+
+def physical_cores(cpus: List[int]) -> List[int]:
+    """Keep the first hyperthread of every core."""
+    kept = []
+    cpu_set = set(cpus)
+    for cpu in cpus:
+        path = os.path.join(CPU_DIR, f"cpu{cpu}", "topology", "thread_siblings_list")
+        try:
+            with open(path) as f:
+                siblings = parse_cpu_list(f.read())
+        except OSError:
+            siblings = [cpu]
+        if cpu == min(s for s in siblings + [cpu] if s in cpu_set):
+            kept.append(cpu)
+    return kept
+
+
+def build_core_sets(args) -> List[Tuple[List[int], List[int]]]:
+    """Return (cpus, memory nodes) for every worker."""
+    nodes = get_numa_nodes()
+    core_sets = []
+    if args.core_sets:
+        for text in args.core_sets.split(";"):
+            cpus = parse_cpu_list(text)
+            mems = [
+                node for node, node_cpus in nodes.items() if set(cpus) & set(node_cpus)
+            ]
+            core_sets.append((cpus, mems))
+    else:
+        for node, cpus in nodes.items():
+            n = args.workers_per_node
+            size = len(cpus) // n
+            if size == 0:
+                raise ValueError(f"NUMA node {node} has fewer than {n} CPUs")
+            for i in range(n):
+                core_sets.append((cpus[i * size : (i + 1) * size], [node]))
+
+    if args.physical_cores_only:
+        core_sets = [(physical_cores(cpus), mems) for cpus, mems in core_sets]
+    return core_sets
+
+
+def launch_worker(args, index, cpus, mems, worker_args) -> subprocess.Popen:
+    port = args.port + index
+    num_threads = args.threads_per_worker or len(cpus)
+    cmd = [
+        sys.executable,
+        "-m",
+        "fastchat.serve.model_worker",
+        "--host",
+        args.host,
+        "--port",
+        str(port),
+        "--worker-address",
+        f"http://{args.worker_host}:{port}",
+        "--controller-address",
+        args.controller_address,
+        "--num-threads",
+        str(num_threads),
+        "--num-interop-threads",
+        str(args.interop_threads),
+    ] + worker_args
+
+    cpu_list = ",".join(map(str, cpus))
+    preexec_fn = None
+    if args.use_numactl:
+        cmd = [
+            "numactl",
+            f"--physcpubind={cpu_list}",
+            f"--membind={','.join(map(str, mems))}",
+        ] + cmd
+    else:
+        preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+
+    env = dict(os.environ)
+    env["OMP_NUM_THREADS"] = str(num_threads)
+    env["MKL_NUM_THREADS"] = str(num_threads)
+    print(f"worker {index}: cpus {cpu_list}, memory nodes {mems}, port {port}")
+    return subprocess.Popen(cmd, env=env, preexec_fn=preexec_fn)
+
+
+def main(args, worker_args):
+    args.use_numactl = not args.no_numactl and shutil.which("numactl") is not None
+    if not args.use_numactl:
+        warnings.warn("Without numactl, only threads are pinned, memory is not bound.")
+
+    procs = [
+        launch_worker(args, i, cpus, mems, worker_args)
+        for i, (cpus, mems) in enumerate(build_core_sets(args))
+    ]
+
+    def stop(*_):
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Stop all workers as soon as one of them exits.
+    while all(proc.poll() is None for proc in procs):
+        time.sleep(1)
+    stop()
+    for proc in procs:
+        proc.wait()
+    sys.exit(max(abs(proc.returncode) for proc in procs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument(
+        "--port", type=int, default=31000, help="The port of the first worker"
+    )
+    parser.add_argument(
+        "--worker-host",
+        type=str,
+        default="localhost",
+        help="The host name in the worker addresses given to the controller",
+    )
+    parser.add_argument(
+        "--controller-address", type=str, default="http://localhost:21001"
+    )
+    parser.add_argument(
+        "--workers-per-node",
+        type=int,
+        default=1,
+        help="Split the CPUs of every NUMA node between this many workers",
+    )
+    parser.add_argument(
+        "--core-sets",
+        type=str,
+        default=None,
+        help='One worker per CPU list instead of per NUMA node, e.g. "0-15;16-31"',
+    )
+    parser.add_argument(
+        "--physical-cores-only",
+        action="store_true",
+        help="Leave out the hyperthread siblings of the cores",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="The intra-op thread count. The number of CPUs of a worker by default",
+    )
+    parser.add_argument("--interop-threads", type=int, default=1)
+    parser.add_argument(
+        "--no-numactl",
+        action="store_true",
+        help="Pin with a CPU affinity mask even if numactl is installed",
+    )
+    args, worker_args = parser.parse_known_args()
+    if worker_args and worker_args[0] == "--":
+        worker_args = worker_args[1:]
+    main(args, worker_args)
@@ -3,6 +3,7 @@ A model worker executes the model.
 """
 import argparse
 import asyncio
+import base64
 import dataclasses
 import logging
 import json
@@ -35,9 +36,21 @@ import torch.nn.functional as F
 import uvicorn
 
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL, ErrorCode, SERVER_ERROR_MSG
-from fastchat.model.model_adapter import load_model, add_model_args
+from fastchat.model.kv_cache import KV_DTYPES, enable_paged_kv_cache
+from fastchat.model.model_adapter import (
+    load_model,
+    add_model_args,
+    get_model_adapter,
+)
 from fastchat.model.chatglm_model import chatglm_generate_stream
-from fastchat.serve.inference import generate_stream
+from fastchat.serve.embedding_cache import EmbeddingCache, embedding_cache_key
+from fastchat.serve.session_cache import SessionCache
+from fastchat.serve.inference import (
+    generate_stream,
+    generate_batch,
+    model_step_lock,
+    score_candidates,
+)
 from fastchat.utils import build_logger, pretty_print_semaphore
 
 GB = 1 << 30
@@ -49,6 +62,71 @@ global_counter = 0
 model_semaphore = None
 
 
+def encode_embeddings(embedding, encoding_format="float", embedding_dtype="float32"):
+    """Convert a batch of normalized embeddings into their wire format.
+
+    "base64" packs every row as little-endian bytes of `embedding_dtype`.
+    Since the rows are L2-normalized, "int8" stores round(x * 127).
+    """
+    if embedding_dtype == "int8":
+        embedding = (embedding * 127).round().clamp(-127, 127).to(torch.int8)
+    elif embedding_dtype == "float16":
+        embedding = embedding.to(torch.float16)
+    elif embedding_dtype == "float32":
+        embedding = embedding.to(torch.float32)
+    else:
+        raise ValueError(f"Invalid embedding dtype: {embedding_dtype}")
+
+    if encoding_format == "base64":
+        array = embedding.numpy()
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        return [base64.b64encode(row.tobytes()).decode() for row in array]
+    elif encoding_format == "float":
+        return embedding.tolist()
+    else:
+        raise ValueError(f"Invalid encoding format: {encoding_format}")
+
+
+class StopForward(Exception):
+    """Raised by a forward hook to skip the remaining layers of a model."""
+
+    def __init__(self, hidden_states):
+        super().__init__()
+        self.hidden_states = hidden_states
+
+
+def get_decoder_layers(base_model):
+    for attr in ["layers", "h", "blocks"]:
+        if hasattr(base_model, attr):
+            return getattr(base_model, attr)
+    raise ValueError(f"Cannot find the decoder layers of {type(base_model)}")
+
+
+def forward_until_layer(base_model, layer, **kwargs):
+    """Run base_model and return the hidden states output by its layer-th layer.
+
+    The layers after it are never executed.
+    """
+    layers = get_decoder_layers(base_model)
+    if not 1 <= layer <= len(layers):
+        raise ValueError(f"Invalid embedding layer {layer}, the model has {len(layers)}")
+    thread_id = threading.get_ident()
+
+    def hook(module, inputs, output):
+        # Other threads may run generation through the same layers concurrently.
+        if threading.get_ident() == thread_id:
+            raise StopForward(output[0] if isinstance(output, tuple) else output)
+
+    handle = layers[layer - 1].register_forward_hook(hook)
+    try:
+        base_model(**kwargs)
+    except StopForward as e:
+        return e.hidden_states
+    finally:
+        handle.remove()
+    raise RuntimeError("The forward pass did not reach the embedding layer")
+
+
 def heart_beat_worker(controller):
     while True:
         time.sleep(WORKER_HEART_BEAT_INTERVAL)
@@ -69,6 +147,14 @@ class ModelWorker:
         max_gpu_memory,
         load_8bit=False,
         cpu_offloading=False,
+        headless_embedding=False,
+        embedding_layer=None,
+        sdpa_attn=False,
+        compile_decode=False,
+        compile_slots=1,
+        compile_cache_dir=None,
+        cpu_dtype="float32",
+        shared_weights=None,
     ):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
@@ -77,10 +163,31 @@ class ModelWorker:
             model_path = model_path[:-1]
         self.model_name = model_name or model_path.split("/")[-1]
         self.device = device
+        # Embed with the base transformer only, optionally stopping early.
+        self.headless_embedding = headless_embedding or embedding_layer is not None
+        self.embedding_layer = embedding_layer
+        # Identifies how embeddings are computed, e.g. for the embedding cache.
+        if embedding_layer is not None:
+            self.embedding_mode = f"mean-layer{embedding_layer}"
+        elif self.headless_embedding:
+            self.embedding_mode = "mean-base"
+        else:
+            self.embedding_mode = "mean"
 
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.model, self.tokenizer = load_model(
-            model_path, device, num_gpus, max_gpu_memory, load_8bit, cpu_offloading
+            model_path,
+            device,
+            num_gpus,
+            max_gpu_memory,
+            load_8bit,
+            cpu_offloading,
+            sdpa_attn=sdpa_attn,
+            compile_decode=compile_decode,
+            compile_slots=compile_slots,
+            compile_cache_dir=compile_cache_dir,
+            cpu_dtype=cpu_dtype,
+            shared_weights=shared_weights,
         )
         if self.tokenizer.pad_token == None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
@@ -91,14 +198,33 @@ class ModelWorker:
             self.context_len = self.model.config.max_position_embeddings
         else:
             self.context_len = 2048
+        self.attention_sinks = get_model_adapter(model_path).get_attention_sinks(
+            model_path
+        )
 
         # generate_stream
         is_chatglm = "chatglm" in str(type(self.model)).lower()
+        self.is_chatglm = is_chatglm
+        self.is_t5 = "t5" in str(type(self.model)).lower()
+        if not is_chatglm:
+            # Pad on the right for the batched embedding forward, so that the
+            # position ids of the real tokens are not shifted.
+            self.tokenizer.padding_side = "right"
         if is_chatglm:
             self.generate_stream_func = chatglm_generate_stream
         else:
             self.generate_stream_func = generate_stream
 
+        # generate_batch only supports decoder-only huggingface models.
+        if (
+            is_chatglm
+            or not isinstance(self.model, torch.nn.Module)
+            or self.model.config.is_encoder_decoder
+        ):
+            self.generate_batch_func = None
+        else:
+            self.generate_batch_func = generate_batch
+
         if not no_register:
             self.register_to_controller()
             self.heart_beat_thread = threading.Thread(
@@ -161,11 +287,21 @@ class ModelWorker:
             )
 
     def get_status(self):
-        return {
+        status = {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
         }
+        paged_kv_cache = getattr(self.model, "paged_kv_cache", None)
+        if paged_kv_cache is not None:
+            status["kv_cache"] = paged_kv_cache.get_stats()
+        session_cache = getattr(self.model, "session_cache", None)
+        if session_cache is not None:
+            status["session_cache"] = session_cache.get_stats()
+        static_decoder = getattr(self.model, "static_decoder", None)
+        if static_decoder is not None:
+            status["compiled_decode"] = static_decoder.get_stats()
+        return status
 
     def count_token(self, params):
         prompt = params["prompt"]
@@ -178,7 +314,16 @@ class ModelWorker:
         }
         return ret
 
+    def add_inference_params(self, params):
+        """Add the worker-wide inference options to the params of a request."""
+        params["prefill_chunk_size"] = args.prefill_chunk_size
+        params["decode_steps"] = args.decode_steps
+        if args.kv_window:
+            params["attention_sinks"] = self.attention_sinks
+            params["kv_window"] = args.kv_window
+
     def generate_stream_gate(self, params):
+        self.add_inference_params(params)
         try:
             for output in self.generate_stream_func(
                 self.model,
@@ -198,6 +343,8 @@ class ModelWorker:
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
+                if "mean_logprob" in output:
+                    ret["mean_logprob"] = output["mean_logprob"]
                 yield json.dumps(ret).encode() + b"\0"
         except torch.cuda.OutOfMemoryError as e:
             ret = {
@@ -213,6 +360,7 @@ class ModelWorker:
             yield json.dumps(ret).encode() + b"\0"
 
     def generate_gate(self, params):
+        self.add_inference_params(params)
         try:
             ret = {"text": "", "error_code": 0}
             for output in self.generate_stream_func(
@@ -230,6 +378,8 @@ class ModelWorker:
                 ret["finish_reason"] = output["finish_reason"]
             if "logprobs" in output:
                 ret["logprobs"] = output["logprobs"]
+            if "mean_logprob" in output:
+                ret["mean_logprob"] = output["mean_logprob"]
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -242,57 +392,169 @@ class ModelWorker:
             }
         return ret
 
-    @torch.inference_mode()
-    def get_embeddings(self, params):
+    def score_gate(self, params):
+        if self.generate_batch_func is None:
+            return {
+                "text": f"Scoring is not supported by {self.model_name}",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
         try:
-            tokenizer = self.tokenizer
-            is_llama = "llama" in str(type(self.model)) # vicuna support batch inference
-            is_chatglm = "chatglm" in str(type(self.model))
-            is_t5 = "t5" in str(type(self.model))
-            if is_llama:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
+            ret = score_candidates(
+                self.model,
+                self.tokenizer,
+                params["prompt"],
+                params["candidates"],
+                self.device,
+                self.context_len,
+                args.prefill_chunk_size,
+            )
+            ret["error_code"] = 0
+        except torch.cuda.OutOfMemoryError as e:
+            ret = {
+                "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
+            }
+        except ValueError as e:
+            ret = {
+                "text": str(e),
+                "error_code": ErrorCode.CONTEXT_OVERFLOW,
+            }
+        except RuntimeError as e:
+            ret = {
+                "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+        return ret
+
+    def generate_batch_gate(self, params):
+        prompts = params.pop("prompts")
+        # Batch jobs yield every model step to the interactive requests.
+        background = params.pop("priority", None) == "background"
+        self.add_inference_params(params)
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        rets = [None] * len(prompts)
+
+        # Reject the prompts that do not fit and sort the rest by length,
+        # so that each batch needs as little padding as possible.
+        lengths = []
+        for idx, prompt in enumerate(prompts):
+            token_num = len(self.tokenizer(prompt).input_ids)
+            if token_num + max_new_tokens > self.context_len:
+                rets[idx] = {
+                    "text": f"This model's maximum context length is {self.context_len} tokens. "
+                    f"However, you requested {max_new_tokens + token_num} tokens "
+                    f"({token_num} in the messages, "
+                    f"{max_new_tokens} in the completion). "
+                    f"Please reduce the length of the messages or completion.",
+                    "error_code": ErrorCode.CONTEXT_OVERFLOW,
+                }
+            else:
+                lengths.append((token_num, idx))
+        lengths.sort()
+
+        for start in range(0, len(lengths), args.max_batch_size):
+            indices = [idx for _, idx in lengths[start : start + args.max_batch_size]]
+            params_list = [dict(params, prompt=prompts[idx]) for idx in indices]
+            if self.generate_batch_func is None:
+                with model_step_lock.background(background):
+                    outputs = [self.generate_gate(p) for p in params_list]
+            else:
+                try:
+                    with model_step_lock.background(background):
+                        outputs = self.generate_batch_func(
+                            self.model,
+                            self.tokenizer,
+                            params_list,
+                            self.device,
+                            self.context_len,
+                        )
+                    for output in outputs:
+                        output["error_code"] = 0
+                except torch.cuda.OutOfMemoryError as e:
+                    outputs = [
+                        {
+                            "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                            "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
+                        }
+                    ] * len(indices)
+                except (ValueError, RuntimeError) as e:
+                    outputs = [
+                        {
+                            "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                            "error_code": ErrorCode.INTERNAL_ERROR,
+                        }
+                    ] * len(indices)
+            for idx, output in zip(indices, outputs):
+                rets[idx] = output
+        return {"outputs": rets}
+
+    @torch.inference_mode()
+    def embed_batch(self, texts):
+        """Run one padded forward pass over a batch of texts.
+
+        Returns the L2-normalized mean-pooled embeddings and the token count
+        of each text.
+        """
+        tokenizer = self.tokenizer
+        # Take turns with the generation steps, see FairStepLock.
+        with model_step_lock:
+            if self.is_chatglm:
+                # ChatGLM's tokenizer builds its own attention masks and position ids.
+                encoding = tokenizer(texts, padding=True, return_tensors="pt").to(
+                    self.device
                 )
+                input_ids = encoding["input_ids"]
+                if self.headless_embedding:
+                    data = self.headless_forward(**encoding).transpose(0, 1)
+                else:
+                    model_output = self.model(**encoding, output_hidden_states=True)
+                    data = model_output.hidden_states[-1].transpose(0, 1)
+                attention_mask = (input_ids != tokenizer.pad_token_id).long()
+            else:
+                encoding = tokenizer(texts, padding=True, return_tensors="pt")
                 input_ids = encoding["input_ids"].to(self.device)
                 attention_mask = encoding["attention_mask"].to(self.device)
-                model_output = self.model(
-                    input_ids, attention_mask, output_hidden_states=True
-                )
-                data = model_output.hidden_states[-1]
-                mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
-                masked_embeddings = data * mask
-                sum_embeddings = torch.sum(masked_embeddings, dim=1)
-                seq_length = torch.sum(mask, dim=1)
-                embedding = sum_embeddings / seq_length
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret = {
-                    "embedding": normalized_embeddings.tolist(),
-                    "token_num": torch.sum(attention_mask).item(),
-                }
-            else:
-                embedding = []
-                token_num = 0
-                for text in params["input"]:
-                    input_ids = tokenizer.encode(text, return_tensors="pt").to(
-                        self.device
+                if self.is_t5:
+                    data = self.model.encoder(
+                        input_ids=input_ids, attention_mask=attention_mask
+                    ).last_hidden_state
+                elif self.headless_embedding:
+                    data = self.headless_forward(
+                        input_ids=input_ids, attention_mask=attention_mask
                     )
-                    if is_t5:
-                        model_output = self.model(input_ids, decoder_input_ids=input_ids)
-                    else:
-                        model_output = self.model(input_ids, output_hidden_states=True)
-                    if is_chatglm:
-                        data = (model_output.hidden_states[-1].transpose(0, 1))[0]
-                    elif is_t5:
-                        data = model_output.encoder_last_hidden_state[0]
-                    else:
-                        data = model_output.hidden_states[-1][0]
-                    data = F.normalize(torch.mean(data, dim=0), p=2, dim=0)
-                    embedding.append(data.tolist())
-                    token_num += len(input_ids[0])
-                ret = {
-                    "embedding": embedding,
-                    "token_num": token_num,
-                }
+                else:
+                    model_output = self.model(
+                        input_ids, attention_mask, output_hidden_states=True
+                    )
+                    data = model_output.hidden_states[-1]
+        mask = attention_mask.unsqueeze(-1).expand(data.size()).to(data.dtype)
+        masked_embeddings = data * mask
+        sum_embeddings = torch.sum(masked_embeddings, dim=1)
+        seq_length = torch.sum(mask, dim=1)
+        embedding = sum_embeddings / seq_length
+        normalized_embeddings = F.normalize(embedding.float(), p=2, dim=1)
+        return normalized_embeddings.cpu(), torch.sum(attention_mask, dim=1).tolist()
+
+    def headless_forward(self, **kwargs):
+        """Get the hidden states without the LM head, the KV cache or the
+        hidden states of the other layers."""
+        base_model = self.model.base_model
+        kwargs.update(use_cache=False, output_hidden_states=False)
+        if self.embedding_layer is None:
+            return base_model(**kwargs)[0]
+        return forward_until_layer(base_model, self.embedding_layer, **kwargs)
+
+    def get_embeddings(self, params):
+        try:
+            embedding, token_nums = self.embed_batch(params["input"])
+            ret = {
+                "embedding": encode_embeddings(
+                    embedding,
+                    params.get("encoding_format", "float"),
+                    params.get("embedding_dtype", "float32"),
+                ),
+                "token_num": sum(token_nums),
+            }
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -306,19 +568,137 @@ class ModelWorker:
         return ret
 
 
+class EmbeddingBatcher:
+    """Merge the texts of concurrent embedding requests into shared batches.
+
+    Texts that arrive within `wait_ms` of each other are pooled, sorted by
+    token length and cut into buckets of similar length, so that each forward
+    pass pads as little as possible.
+    """
+
+    def __init__(
+        self, worker, max_batch_size, max_batch_tokens, wait_ms, cache=None
+    ):
+        self.worker = worker
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.wait_ms = wait_ms
+        self.cache = cache
+        self.pending = []
+        self.wakeup = None
+        self.loop_task = None
+
+    async def embed(self, texts):
+        """Return the embeddings and token counts of `texts`."""
+        if self.loop_task is None:
+            self.wakeup = asyncio.Event()
+            self.loop_task = asyncio.create_task(self.batch_loop())
+
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            keys = [
+                embedding_cache_key(
+                    self.worker.model_name, self.worker.embedding_mode, text
+                )
+                for text in texts
+            ]
+            # The cache reads files, so keep it off the event loop.
+            hits = await loop.run_in_executor(None, self.cache.get, keys)
+        else:
+            keys = [None] * len(texts)
+            hits = [None] * len(texts)
+
+        futures = []
+        for text, key, hit in zip(texts, keys, hits):
+            future = loop.create_future()
+            if hit is not None:
+                emb, token_num = hit
+                future.set_result((torch.from_numpy(emb), token_num))
+            else:
+                num_tokens = len(self.worker.tokenizer(text).input_ids)
+                self.pending.append((num_tokens, text, future, key))
+            futures.append(future)
+        if self.pending:
+            self.wakeup.set()
+
+        results = await asyncio.gather(*futures)
+        embedding = torch.stack([emb for emb, _ in results])
+        token_nums = [token_num for _, token_num in results]
+        return embedding, token_nums
+
+    def make_buckets(self, items):
+        items.sort(key=lambda x: x[0])
+        buckets = []
+        bucket = []
+        for item in items:
+            # items are sorted, so the new item is the longest one of the bucket
+            if bucket and (
+                len(bucket) >= self.max_batch_size
+                or item[0] * (len(bucket) + 1) > self.max_batch_tokens
+            ):
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(item)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # Give concurrent requests a moment to join this round.
+            await asyncio.sleep(self.wait_ms / 1000)
+            self.wakeup.clear()
+            items, self.pending = self.pending, []
+
+            for bucket in self.make_buckets(items):
+                texts = [text for _, text, _, _ in bucket]
+                await acquire_model_semaphore()
+                try:
+                    embedding, token_nums = await loop.run_in_executor(
+                        None, self.worker.embed_batch, texts
+                    )
+                except Exception as e:
+                    for _, _, future, _ in bucket:
+                        future.set_exception(e)
+                    continue
+                finally:
+                    release_model_semaphore()
+
+                for i, (_, _, future, _) in enumerate(bucket):
+                    future.set_result((embedding[i], token_nums[i]))
+                if self.cache is not None:
+                    keys = [key for _, _, _, key in bucket]
+                    try:
+                        await loop.run_in_executor(
+                            None, self.cache.put, keys, embedding.numpy(), token_nums
+                        )
+                    except Exception as e:
+                        logger.warning(f"Cannot write the embedding cache: {e}")
+
+
 app = FastAPI()
 
 
-def release_model_semaphore():
+def release_model_semaphore(background=False):
     model_semaphore.release()
+    if not background:
+        model_step_lock.remove_request()
 
 
-def acquire_model_semaphore():
+async def acquire_model_semaphore(background=False):
+    """Background requests, i.e. batch jobs, yield every model step to the
+    other requests that hold the semaphore."""
     global model_semaphore, global_counter
     global_counter += 1
     if model_semaphore is None:
         model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    return model_semaphore.acquire()
+    await model_semaphore.acquire()
+    # Counted only once it runs, so that a background request holding the
+    # semaphore never waits for a request that waits for the semaphore.
+    if not background:
+        model_step_lock.add_request()
 
 
 def create_background_tasks():
@@ -363,13 +743,53 @@ async def api_generate_completion(request: Request):
     return JSONResponse(content=completion, background=background_tasks)
 
 
-@app.post("/worker_get_embeddings")
-async def api_get_embeddings(request: Request):
+@app.post("/worker_generate_completion_batch")
+async def api_generate_completion_batch(request: Request):
+    params = await request.json()
+    background = params.get("priority", None) == "background"
+    await acquire_model_semaphore(background)
+    try:
+        completions = await asyncio.get_running_loop().run_in_executor(
+            None, worker.generate_batch_gate, params
+        )
+    finally:
+        release_model_semaphore(background)
+    return JSONResponse(content=completions)
+
+
+@app.post("/worker_score")
+async def api_score(request: Request):
     params = await request.json()
     await acquire_model_semaphore()
-    embedding = worker.get_embeddings(params)
+    scores = worker.score_gate(params)
     background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    return JSONResponse(content=scores, background=background_tasks)
+
+
+@app.post("/worker_get_embeddings")
+async def api_get_embeddings(request: Request):
+    params = await request.json()
+    try:
+        embedding, token_nums = await embedding_batcher.embed(params["input"])
+        ret = {
+            "embedding": encode_embeddings(
+                embedding,
+                params.get("encoding_format", "float"),
+                params.get("embedding_dtype", "float32"),
+            ),
+            "token_num": sum(token_nums),
+        }
+    except torch.cuda.OutOfMemoryError as e:
+        ret = {
+            "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+            "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
+        }
+    except (ValueError, RuntimeError) as e:
+        ret = {
+            "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+            "error_code": ErrorCode.INTERNAL_ERROR,
+        }
+    return JSONResponse(content=ret)
 
 
 @app.post("/worker_get_status")
@@ -400,6 +820,171 @@ if __name__ == "__main__":
     parser.add_argument("--model-name", type=str, help="Optional display name")
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="The maximum number of prompts decoded together by the batch endpoint",
+    )
+    parser.add_argument(
+        "--prefill-chunk-size",
+        type=int,
+        default=512,
+        help="Prefill prompts in chunks of this many tokens, so that other "
+        "requests can decode in between. 0 prefills a prompt at once",
+    )
+    parser.add_argument(
+        "--decode-steps",
+        type=int,
+        default=1,
+        help="Sample this many tokens on the device back to back before "
+        "syncing with the host for stop checks and streaming",
+    )
+    parser.add_argument(
+        "--kv-window",
+        type=int,
+        default=None,
+        help="Keep the attention sinks and a rolling window of this many KV "
+        "entries instead of truncating prompts longer than the context "
+        "(streaming generation of LLaMA-based models only)",
+    )
+    parser.add_argument(
+        "--session-cache-gb",
+        type=float,
+        default=0,
+        help="Keep the KV cache of chat sessions (requests with a session_id) "
+        "across turns in this much device memory in GiB. 0 disables it",
+    )
+    parser.add_argument(
+        "--session-host-gb",
+        type=float,
+        default=0,
+        help="The host memory that idle sessions are demoted to in GiB",
+    )
+    parser.add_argument(
+        "--session-spill-dir",
+        type=str,
+        default=None,
+        help="A local directory that idle sessions are demoted to from host memory",
+    )
+    parser.add_argument(
+        "--session-disk-gb",
+        type=float,
+        default=None,
+        help="The disk space of --session-spill-dir in GiB. Unlimited by default",
+    )
+    parser.add_argument(
+        "--paged-kv-cache",
+        action="store_true",
+        help="Store the KV cache of all requests in a shared pool of blocks "
+        "(LLaMA models only). Raise --limit-model-concurrency to use the room",
+    )
+    parser.add_argument(
+        "--kv-cache-gb",
+        type=float,
+        default=4,
+        help="The device memory of the paged KV cache in GiB",
+    )
+    parser.add_argument(
+        "--kv-swap-gb",
+        type=float,
+        default=0,
+        help="The host memory that idle sequences of the paged KV cache are "
+        "swapped out to in GiB",
+    )
+    parser.add_argument(
+        "--kv-block-size",
+        type=int,
+        default=16,
+        help="The number of tokens per block of the paged KV cache",
+    )
+    parser.add_argument(
+        "--kv-cache-dtype",
+        type=str,
+        choices=KV_DTYPES,
+        default="auto",
+        help="The storage type of the paged KV cache. int8 fits about twice "
+        "the tokens of float16, see fastchat/eval/eval_kv_cache.py",
+    )
+    parser.add_argument(
+        "--kv-dense-views",
+        action="store_true",
+        help="Keep a contiguous copy of the paged KV cache of the running "
+        "requests, so a decode step appends to it instead of gathering the blocks",
+    )
+    parser.add_argument(
+        "--compile-decode",
+        action="store_true",
+        help="Decode with a torch.compile'd step over a static KV buffer "
+        "(LLaMA models on one device only)",
+    )
+    parser.add_argument(
+        "--compile-slots",
+        type=int,
+        default=1,
+        help="The number of sequences that can use the compiled step at once",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=str,
+        default=None,
+        help="Cache the compiled kernels here across restarts",
+    )
+    parser.add_argument(
+        "--headless-embedding",
+        action="store_true",
+        help="Compute embeddings with the base transformer only, skipping the LM head",
+    )
+    parser.add_argument(
+        "--embedding-layer",
+        type=int,
+        default=None,
+        help="Pool the output of this layer (1-based) and skip the later layers. "
+        "Implies --headless-embedding",
+    )
+    parser.add_argument(
+        "--embedding-batch-size",
+        type=int,
+        default=32,
+        help="The maximum number of texts in one embedding forward pass",
+    )
+    parser.add_argument(
+        "--embedding-batch-tokens",
+        type=int,
+        default=16384,
+        help="The maximum number of padded tokens in one embedding forward pass",
+    )
+    parser.add_argument(
+        "--embedding-batch-wait-ms",
+        type=float,
+        default=5,
+        help="How long to wait for concurrent embedding requests to join a batch",
+    )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        type=str,
+        default=None,
+        help="Cache embeddings on disk in this directory and reuse them across restarts",
+    )
+    parser.add_argument(
+        "--shared-weights",
+        type=str,
+        default=None,
+        help="Only with --device cpu: share the weights with the other workers "
+        "of the host through this directory, e.g. /dev/shm/vicuna-13b",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="The intra-op thread count of PyTorch, e.g. the cores of a socket",
+    )
+    parser.add_argument(
+        "--num-interop-threads",
+        type=int,
+        default=None,
+        help="The inter-op thread count of PyTorch",
+    )
     parser.add_argument("--no-register", action="store_true")
     args = parser.parse_args()
     logger.info(f"args: {args}")
@@ -410,6 +995,13 @@ if __name__ == "__main__":
                 f"Larger --num-gpus ({args.num_gpus}) than --gpus {args.gpus}!"
             )
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+    if args.compile_decode and args.paged_kv_cache:
+        raise ValueError("--compile-decode does not work with --paged-kv-cache")
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads:
+        # Must run before any inter-op parallel work starts.
+        torch.set_num_interop_threads(args.num_interop_threads)
 
     worker = ModelWorker(
         args.controller_address,
@@ -423,5 +1015,51 @@ if __name__ == "__main__":
         args.max_gpu_memory,
         args.load_8bit,
         args.cpu_offloading,
+        args.headless_embedding,
+        args.embedding_layer,
+        args.sdpa_attn,
+        args.compile_decode,
+        args.compile_slots,
+        args.compile_cache_dir,
+        args.cpu_dtype,
+        args.shared_weights,
+    )
+    if args.kv_window:
+        if worker.attention_sinks is None:
+            raise ValueError(f"{args.model_path} does not support --kv-window")
+        if args.paged_kv_cache:
+            raise ValueError("--kv-window does not work with --paged-kv-cache")
+        if args.kv_window >= worker.context_len:
+            raise ValueError(
+                f"--kv-window must be smaller than the context ({worker.context_len})"
+            )
+    if args.session_cache_gb:
+        if args.paged_kv_cache:
+            raise ValueError("--session-cache-gb does not work with --paged-kv-cache")
+        worker.model.session_cache = SessionCache(
+            args.session_cache_gb,
+            args.session_host_gb,
+            args.session_spill_dir,
+            args.session_disk_gb,
+        )
+    if args.paged_kv_cache:
+        enable_paged_kv_cache(
+            worker.model,
+            args.kv_cache_gb,
+            args.kv_swap_gb,
+            args.kv_block_size,
+            args.kv_cache_dtype,
+            args.kv_dense_views,
+        )
+    if args.embedding_cache_dir:
+        embedding_cache = EmbeddingCache(args.embedding_cache_dir)
+    else:
+        embedding_cache = None
+    embedding_batcher = EmbeddingBatcher(
+        worker,
+        args.embedding_batch_size,
+        args.embedding_batch_tokens,
+        args.embedding_batch_wait_ms,
+        embedding_cache,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -3,6 +3,10 @@
 - Chat Completions. (Reference: https://platform.openai.com/docs/api-reference/chat)
 - Completions. (Reference: https://platform.openai.com/docs/api-reference/completions)
 - Embeddings. (Reference: https://platform.openai.com/docs/api-reference/embeddings)
+- Vector search over named collections. (Not part of the OpenAI API)
+- Log-likelihood scoring of candidate continuations. (Not part of the OpenAI API)
+- Model cascades that escalate low-confidence answers to a larger model. (Not part of the OpenAI API)
+- Files and Batches. (Reference: https://platform.openai.com/docs/api-reference/batch)
 
 Usage:
 python3 -m fastchat.serve.openai_api_server
@@ -11,6 +15,7 @@ import asyncio
 
 import argparse
 import asyncio
+import base64
 import json
 import logging
 
@@ -18,9 +23,11 @@ import os
 from typing import Generator, Optional, Union, Dict, List, Any
 
 import fastapi
+from fastapi import File, Form, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 import httpx
+import numpy as np
 from pydantic import BaseSettings
 import shortuuid
 import tiktoken
@@ -28,8 +35,14 @@ import uvicorn
 
 from fastchat.constants import WORKER_API_TIMEOUT, WORKER_API_EMBEDDING_BATCH_SIZE, ErrorCode
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.serve.batch_jobs import BatchJobManager
+from fastchat.serve.cascade import load_cascades
+from fastchat.serve.vector_store import VectorStore
 from fastapi.exceptions import RequestValidationError
 from fastchat.protocol.openai_api_protocol import (
+    BatchCreateRequest,
+    BatchList,
+    BatchObject,
     ChatCompletionRequest,
     ChatCompletionResponse,
     ChatCompletionResponseStreamChoice,
@@ -42,12 +55,23 @@ from fastchat.protocol.openai_api_protocol import (
     DeltaMessage,
     CompletionResponseStreamChoice,
     CompletionStreamResponse,
+    CollectionAddRequest,
+    CollectionCreateRequest,
+    CollectionIndexRequest,
+    CollectionInfo,
+    CollectionList,
     EmbeddingsRequest,
     EmbeddingsResponse,
     ErrorResponse,
+    FileObject,
     ModelCard,
     ModelList,
     ModelPermission,
+    ScoreData,
+    ScoreRequest,
+    ScoreResponse,
+    SearchRequest,
+    SearchResponse,
     TokenCheckRequest,
     TokenCheckResponse,
     UsageInfo,
@@ -59,9 +83,18 @@ logger = logging.getLogger(__name__)
 class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
+    # The directory of the vector collections. Vector search is off if unset.
+    vector_store_dir: Optional[str] = None
+    # The directory of the uploaded files and batch jobs. Batches are off if unset.
+    batch_dir: Optional[str] = None
+    # A JSON file of model cascades, served under their own model names.
+    cascade_config: Optional[str] = None
 
 
 app_settings = AppSettings()
+vector_store = None
+batch_manager = None
+cascades = {}
 
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
@@ -154,6 +187,12 @@ def check_requests(request) -> Optional[JSONResponse]:
             ErrorCode.PARAM_OUT_OF_RANGE,
             f"{request.top_p} is less than the minimum of 0 - 'top_p'",
         )
+    logprobs = getattr(request, "logprobs", None)
+    if logprobs is not None and not 0 <= logprobs <= 5:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE,
+            f"{logprobs} is not in the range [0, 5] - 'logprobs'",
+        )
     if request.top_p is not None and request.top_p > 1:
         return create_error_response(
             ErrorCode.PARAM_OUT_OF_RANGE,
@@ -194,12 +233,23 @@ def get_gen_params(
     echo: Optional[bool],
     stream: Optional[bool],
     stop: Optional[Union[str, List[str]]],
+    logprobs: Optional[int] = None,
+    allowed_output: Optional[List[str]] = None,
+    session_id: Optional[str] = None,
 ) -> Dict[str, Any]:
     conv = get_conversation_template(model_name)
 
     if isinstance(messages, str):
         prompt = messages
+        if allowed_output:
+            allowed_output = allowed_output + [messages]
     else:
+        if conv.example_pool:
+            # Templates with an example pool get the examples most similar to
+            # the latest user message.
+            user_messages = [m["content"] for m in messages if m["role"] == "user"]
+            if user_messages:
+                conv.select_examples(user_messages[-1])
         for message in messages:
             msg_role = message["role"]
             if msg_role == "system":
@@ -214,6 +264,14 @@ def get_gen_params(
         # Add a blank message for the assistant.
         conv.append_message(conv.roles[1], None)
 
+        if allowed_output is None:
+            allowed_output = conv.allowed_output
+        if allowed_output:
+            # The output may also copy anything from the user messages.
+            allowed_output = allowed_output + [
+                m["content"] for m in messages if m["role"] == "user"
+            ]
+
         is_chatglm = "chatglm" in model_name.lower()
         if is_chatglm:
             prompt = conv.messages[conv.offset :]
@@ -239,6 +297,12 @@ def get_gen_params(
         )
     else:
         gen_params.update({"stop": stop})
+    if logprobs is not None:
+        gen_params["logprobs"] = logprobs
+    if allowed_output:
+        gen_params["allowed_output"] = allowed_output
+    if session_id:
+        gen_params["session_id"] = session_id
 
     logger.debug(f"==== request ====\n{gen_params}")
     return gen_params
@@ -267,13 +331,38 @@ async def _get_worker_address(model_name: str, client: httpx.AsyncClient) -> str
     return worker_addr
 
 
+async def _get_worker_addresses(
+    model_name: str, client: httpx.AsyncClient
+) -> List[str]:
+    """
+    Get the addresses of all workers serving the requested model
+
+    :param model_name: The worker's model name
+    :param client: The httpx client to use
+    :return: Worker addresses from the controller
+    :raises: :class:`ValueError`: No available worker for requested model
+    """
+    controller_address = app_settings.controller_address
+
+    ret = await client.post(
+        controller_address + "/get_worker_addresses", json={"model": model_name}
+    )
+    worker_addrs = ret.json()["addresses"]
+    # No available worker
+    if not worker_addrs:
+        raise ValueError(f"No available worker for {model_name}")
+
+    logger.debug(f"model_name: {model_name}, worker_addrs: {worker_addrs}")
+    return worker_addrs
+
+
 @app.get("/v1/models")
 async def show_available_models():
     controller_address = app_settings.controller_address
     async with httpx.AsyncClient() as client:
         ret = await client.post(controller_address + "/refresh_all_workers")
         ret = await client.post(controller_address + "/list_models")
-    models = ret.json()["models"]
+    models = ret.json()["models"] + list(cascades.keys())
     models.sort()
     # TODO: return real model permission details
     model_cards = []
@@ -318,6 +407,8 @@ async def count_tokens(request: TokenCheckRequest):
 @app.post("/v1/chat/completions")
 async def create_chat_completion(request: ChatCompletionRequest):
     """Creates a completion for the chat message"""
+    if request.model in cascades:
+        return await create_cascade_completion(request)
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
         return error_check_ret
@@ -334,6 +425,8 @@ async def create_chat_completion(request: ChatCompletionRequest):
         echo=False,
         stream=request.stream,
         stop=request.stop,
+        allowed_output=request.allowed_output,
+        session_id=request.session_id,
     )
     error_check_ret = await check_length(
         request, gen_params["prompt"], gen_params["max_new_tokens"]
@@ -477,6 +570,8 @@ async def chat_completion(
 
 @app.post("/v1/completions")
 async def create_completion(request: CompletionRequest):
+    if request.model in cascades:
+        return await create_cascade_completion(request)
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
         return error_check_ret
@@ -486,41 +581,59 @@ async def create_completion(request: CompletionRequest):
 
     request.prompt = process_input(request.model, request.prompt)
 
-    for text in request.prompt:
-        error_check_ret = await check_length(request, text, request.max_tokens)
-        if error_check_ret is not None:
-            return error_check_ret
-
     if request.stream:
+        for text in request.prompt:
+            error_check_ret = await check_length(request, text, request.max_tokens)
+            if error_check_ret is not None:
+                return error_check_ret
+
         generator = generate_completion_stream_generator(request, request.n)
         return StreamingResponse(generator, media_type="text/event-stream")
     else:
-        text_completions = []
-        for text in request.prompt:
-            payload = get_gen_params(
-                request.model,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                max_tokens=request.max_tokens,
-                echo=request.echo,
-                stream=request.stream,
-                stop=request.stop,
-            )
-            for i in range(request.n):
-                content = asyncio.create_task(generate_completion(payload))
-                text_completions.append(content)
+        # All prompts (and their n samples) go to one worker in a single call.
+        # The worker checks the context length and batches the prompts itself.
+        payload = get_gen_params(
+            request.model,
+            request.prompt[0],
+            temperature=request.temperature,
+            top_p=request.top_p,
+            max_tokens=request.max_tokens,
+            echo=request.echo,
+            stream=request.stream,
+            stop=request.stop,
+            allowed_output=request.allowed_output,
+            logprobs=request.logprobs,
+        )
+        del payload["prompt"]
+        payload["prompts"] = [text for text in request.prompt for _ in range(request.n)]
+        if request.allowed_output:
+            payload["allowed_output"] = request.allowed_output + request.prompt
 
         try:
-            all_tasks = await asyncio.gather(*text_completions)
+            all_tasks = (await generate_completion_batch(payload))["outputs"]
         except Exception as e:
             return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
 
+        errors = [content for content in all_tasks if content["error_code"] != 0]
+        if len(errors) == len(all_tasks):
+            return create_error_response(errors[0]["error_code"], errors[0]["text"])
+
         choices = []
         usage = UsageInfo()
         for i, content in enumerate(all_tasks):
             if content["error_code"] != 0:
-                return create_error_response(content["error_code"], content["text"])
+                # Keep the choices that succeeded.
+                choices.append(
+                    CompletionResponseChoice(
+                        index=i,
+                        text="",
+                        finish_reason="error",
+                        error=ErrorResponse(
+                            message=content["text"], code=content["error_code"]
+                        ),
+                    )
+                )
+                continue
             choices.append(
                 CompletionResponseChoice(
                     index=i,
@@ -554,7 +667,10 @@ async def generate_completion_stream_generator(request: CompletionRequest, n: in
                 echo=request.echo,
                 stream=request.stream,
                 stop=request.stop,
+                allowed_output=request.allowed_output,
+                logprobs=request.logprobs,
             )
+            previous_num_tokens = 0
             async for content in generate_completion_stream(payload):
                 if content["error_code"] != 0:
                     yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
@@ -563,11 +679,16 @@ async def generate_completion_stream_generator(request: CompletionRequest, n: in
                 decoded_unicode = content["text"].replace("\ufffd", "")
                 delta_text = decoded_unicode[len(previous_text) :]
                 previous_text = decoded_unicode
+                # The worker sends the log-probs of all tokens so far.
+                logprobs = content.get("logprobs", None)
+                if logprobs is not None:
+                    logprobs = {k: v[previous_num_tokens:] for k, v in logprobs.items()}
+                    previous_num_tokens += len(logprobs["tokens"])
                 # todo: index is not apparent
                 choice_data = CompletionResponseStreamChoice(
                     index=i,
                     text=delta_text,
-                    logprobs=content.get("logprobs", None),
+                    logprobs=logprobs,
                     finish_reason=content.get("finish_reason", None),
                 )
                 chunk = CompletionStreamResponse(
@@ -624,6 +745,144 @@ async def generate_completion(payload: Dict[str, Any]):
         return completion
 
 
+async def generate_completion_batch(payload: Dict[str, Any]):
+    async with httpx.AsyncClient() as client:
+        worker_addr = await _get_worker_address(payload["model"], client)
+
+        response = await client.post(
+            worker_addr + "/worker_generate_completion_batch",
+            headers=headers,
+            json=payload,
+            timeout=WORKER_API_TIMEOUT * len(payload["prompts"]),
+        )
+        completions = response.json()
+        return completions
+
+
+async def create_cascade_completion(
+    request: Union[ChatCompletionRequest, CompletionRequest]
+):
+    """Run a chat or text completion through the tiers of a model cascade."""
+    cascade = cascades[request.model]
+    error_check_ret = check_requests(request)
+    if error_check_ret is not None:
+        return error_check_ret
+    if request.stream:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE,
+            f"Streaming is not supported by the cascade {request.model}",
+        )
+
+    is_chat = isinstance(request, ChatCompletionRequest)
+    if is_chat:
+        inputs = [request.messages]
+    else:
+        inputs = process_input(request.model, request.prompt)
+    confidence_models = {
+        tier.model for tier in cascade.tiers if tier.min_mean_logprob is not None
+    }
+
+    def make_generate(messages):
+        async def generate(model_name):
+            gen_params = get_gen_params(
+                model_name,
+                messages,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                max_tokens=request.max_tokens,
+                echo=False if is_chat else request.echo,
+                stream=False,
+                stop=request.stop,
+                allowed_output=request.allowed_output,
+                logprobs=None if is_chat else request.logprobs,
+            )
+            if model_name in confidence_models:
+                # Judge the confidence by the unrestricted distribution.
+                gen_params["full_vocab_logprobs"] = True
+            if is_chat:
+                return await chat_completion(model_name, gen_params)
+            return await generate_completion(gen_params)
+
+        return generate
+
+    tasks = [
+        cascade.run(make_generate(messages))
+        for messages in inputs
+        for _ in range(request.n)
+    ]
+    try:
+        all_tasks = await asyncio.gather(*tasks)
+    except Exception as e:
+        return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
+
+    choices = []
+    usage = UsageInfo()
+    for i, content in enumerate(all_tasks):
+        if content["error_code"] != 0:
+            return create_error_response(content["error_code"], content["text"])
+        if is_chat:
+            choice = ChatCompletionResponseChoice(
+                index=i,
+                message=ChatMessage(role="assistant", content=content["text"]),
+                finish_reason=content.get("finish_reason", "stop"),
+            )
+        else:
+            choice = CompletionResponseChoice(
+                index=i,
+                text=content["text"],
+                logprobs=content.get("logprobs", None),
+                finish_reason=content.get("finish_reason", "stop"),
+            )
+        choices.append(choice)
+        task_usage = UsageInfo.parse_obj(content["usage"])
+        for usage_key, usage_value in task_usage.dict().items():
+            setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+
+    # Report the tier that answered, if all choices come from the same one.
+    served_models = {content["model"] for content in all_tasks}
+    model = served_models.pop() if len(served_models) == 1 else request.model
+    if is_chat:
+        return ChatCompletionResponse(model=model, choices=choices, usage=usage)
+    return CompletionResponse(model=model, choices=choices, usage=usage)
+
+
+@app.get("/v1/cascades")
+async def show_cascade_stats():
+    """Per-tier request counts and hit rates of the model cascades"""
+    return {"object": "list", "data": [c.get_stats() for c in cascades.values()]}
+
+
+@app.post("/v1/scores")
+async def create_scores(request: ScoreRequest):
+    """Scores candidate continuations of a prompt by their log-probabilities.
+    Not part of the OpenAI API."""
+    error_check_ret = await check_model(request)
+    if error_check_ret is not None:
+        return error_check_ret
+    if not request.candidates:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, "[] is too short - 'candidates'"
+        )
+
+    async with httpx.AsyncClient() as client:
+        worker_addr = await _get_worker_address(request.model, client)
+        response = await client.post(
+            worker_addr + "/worker_score",
+            headers=headers,
+            json={"prompt": request.prompt, "candidates": request.candidates},
+            timeout=WORKER_API_TIMEOUT,
+        )
+        content = response.json()
+    if content["error_code"] != 0:
+        return create_error_response(content["error_code"], content["text"])
+
+    return ScoreResponse(
+        model=request.model,
+        data=[ScoreData(index=i, **score) for i, score in enumerate(content["scores"])],
+        usage=UsageInfo.parse_obj(content["usage"]),
+    )
+
+
 @app.post("/v1/embeddings")
 @app.post("/v1/engines/{model_name}/embeddings")
 async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
@@ -636,19 +895,23 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
 
     request.input = process_input(request.model, request.input)
 
-    data = []
-    token_num = 0
     batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
     batches = [
         request.input[i : min(i + batch_size, len(request.input))]
         for i in range(0, len(request.input), batch_size)
     ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-        }
-        embedding = await get_embedding(payload)
+    try:
+        embeddings = await embed_batches(
+            request.model, batches, request.encoding_format, request.embedding_dtype
+        )
+    except Exception as e:
+        return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
+
+    data = []
+    token_num = 0
+    for num_batch, embedding in enumerate(embeddings):
+        if embedding.get("error_code", 0) != 0:
+            return create_error_response(embedding["error_code"], embedding["text"])
         data += [
             {
                 "object": "embedding",
@@ -669,20 +932,377 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
     ).dict(exclude_none=True)
 
 
-async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    model_name = payload["model"]
+async def embed_batches(
+    model_name: str,
+    batches: List[List[str]],
+    encoding_format: str = "float",
+    embedding_dtype: str = "float32",
+) -> List[Dict[str, Any]]:
     async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(model_name, client)
+        worker_addrs = await _get_worker_addresses(model_name, client)
+        # Fan the batches out to all workers of the model at once, the
+        # workers merge concurrent batches into larger forward passes.
+        embedding_tasks = [
+            get_embedding(
+                {
+                    "model": model_name,
+                    "input": batch,
+                    "encoding_format": encoding_format,
+                    "embedding_dtype": embedding_dtype,
+                },
+                worker_addrs[num_batch % len(worker_addrs)],
+                client,
+            )
+            for num_batch, batch in enumerate(batches)
+        ]
+        return await asyncio.gather(*embedding_tasks)
 
-        response = await client.post(
-            worker_addr + "/worker_get_embeddings",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
+
+async def embed_texts(model_name: str, texts: List[str]):
+    """Embed texts into a float32 matrix, returned with the token count."""
+    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    embeddings = await embed_batches(model_name, batches, "base64", "float32")
+    vectors = []
+    token_num = 0
+    for embedding in embeddings:
+        if embedding.get("error_code", 0) != 0:
+            raise ValueError(embedding["text"])
+        vectors += [
+            np.frombuffer(base64.b64decode(emb), dtype="<f4")
+            for emb in embedding["embedding"]
+        ]
+        token_num += embedding["token_num"]
+    return np.stack(vectors), token_num
+
+
+async def get_embedding(
+    payload: Dict[str, Any], worker_addr: str, client: httpx.AsyncClient
+):
+    response = await client.post(
+        worker_addr + "/worker_get_embeddings",
+        headers=headers,
+        json=payload,
+        timeout=WORKER_API_TIMEOUT,
+    )
+    embedding = response.json()
+    return embedding
+
+
+def get_collection_info(name: str) -> CollectionInfo:
+    collection = vector_store.get(name)
+    return CollectionInfo(
+        id=name,
+        model=collection.meta["model"],
+        dim=collection.dim,
+        count=len(collection),
+        quantization=collection.quantization,
+        index=collection.meta.get("index"),
+    )
+
+
+def check_vector_store(name: Optional[str] = None) -> Optional[JSONResponse]:
+    if vector_store is None:
+        return create_error_response(
+            ErrorCode.INVALID_COLLECTION,
+            "Vector search is disabled. Start the server with --vector-store-dir.",
+        )
+    if name is not None and name not in vector_store.collections:
+        return create_error_response(
+            ErrorCode.INVALID_COLLECTION, f"Collection {name} does not exist"
+        )
+    return None
+
+
+@app.get("/v1/collections")
+async def list_collections():
+    """Lists the vector collections. This is not part of the OpenAI API spec."""
+    error_check_ret = check_vector_store()
+    if error_check_ret is not None:
+        return error_check_ret
+    return CollectionList(data=[get_collection_info(n) for n in vector_store.list()])
+
+
+@app.post("/v1/collections")
+async def create_collection(request: CollectionCreateRequest):
+    """Creates an empty vector collection for the embeddings of a model."""
+    error_check_ret = check_vector_store()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        vector_store.create(request.name, request.model, None, request.quantization)
+    except ValueError as e:
+        return create_error_response(ErrorCode.INVALID_COLLECTION, str(e))
+    return get_collection_info(request.name)
+
+
+@app.delete("/v1/collections/{name}")
+async def delete_collection(name: str):
+    error_check_ret = check_vector_store(name)
+    if error_check_ret is not None:
+        return error_check_ret
+    vector_store.delete(name)
+    return {"id": name, "object": "collection", "deleted": True}
+
+
+@app.post("/v1/collections/{name}/vectors")
+async def add_to_collection(name: str, request: CollectionAddRequest):
+    """Adds texts (embedded with the collection's model) or vectors."""
+    error_check_ret = check_vector_store(name)
+    if error_check_ret is not None:
+        return error_check_ret
+    collection = vector_store.get(name)
+
+    token_num = 0
+    try:
+        if request.vectors is not None:
+            vectors = np.asarray(request.vectors, dtype=np.float32)
+        elif request.input is not None:
+            texts = process_input(collection.meta["model"], request.input)
+            vectors, token_num = await embed_texts(collection.meta["model"], texts)
+        else:
+            raise ValueError("Either input or vectors is required")
+        ids = await asyncio.get_running_loop().run_in_executor(
+            None, collection.add, vectors, request.ids, request.metadata
+        )
+    except ValueError as e:
+        return create_error_response(ErrorCode.PARAM_OUT_OF_RANGE, str(e))
+    return {
+        "object": "list",
+        "ids": ids,
+        "usage": UsageInfo(
+            prompt_tokens=token_num, total_tokens=token_num, completion_tokens=None
+        ).dict(exclude_none=True),
+    }
+
+
+@app.post("/v1/collections/{name}/index")
+async def build_collection_index(name: str, request: CollectionIndexRequest):
+    """Builds an approximate (IVF or HNSW) index over the collection."""
+    error_check_ret = check_vector_store(name)
+    if error_check_ret is not None:
+        return error_check_ret
+    collection = vector_store.get(name)
+    if request.type == "ivf":
+        kwargs = {"num_lists": request.num_lists}
+    else:
+        kwargs = {"m": request.m, "ef_construction": request.ef_construction}
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: collection.build_index(request.type, **kwargs)
+        )
+    except (ValueError, ImportError) as e:
+        return create_error_response(ErrorCode.PARAM_OUT_OF_RANGE, str(e))
+    return get_collection_info(name)
+
+
+@app.post("/v1/search")
+async def search(request: SearchRequest):
+    """Finds the nearest neighbors of texts or vectors in a collection."""
+    error_check_ret = check_vector_store(request.collection)
+    if error_check_ret is not None:
+        return error_check_ret
+    collection = vector_store.get(request.collection)
+    model_name = collection.meta["model"]
+
+    token_num = 0
+    try:
+        if request.vectors is not None:
+            queries = np.asarray(request.vectors, dtype=np.float32)
+        elif request.query is not None:
+            texts = process_input(model_name, request.query)
+            queries, token_num = await embed_texts(model_name, texts)
+        else:
+            raise ValueError("Either query or vectors is required")
+        results = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: collection.search(
+                queries,
+                top_k=request.top_k,
+                exact=request.exact,
+                nprobe=request.nprobe,
+                ef=request.ef,
+            ),
+        )
+    except ValueError as e:
+        return create_error_response(ErrorCode.PARAM_OUT_OF_RANGE, str(e))
+
+    return SearchResponse(
+        data=[
+            {"object": "search_result", "index": i, "results": result}
+            for i, result in enumerate(results)
+        ],
+        model=model_name,
+        usage=UsageInfo(
+            prompt_tokens=token_num, total_tokens=token_num, completion_tokens=None
+        ),
+    ).dict(exclude_none=True)
+
+
+def prepare_batch_request(endpoint: str, body: Dict[str, Any]):
+    """Turn one line of a batch input file into worker params and prompts."""
+    if endpoint == "/v1/chat/completions":
+        request = ChatCompletionRequest.parse_obj(body)
+        messages = request.messages
+        prompts = None
+    else:
+        request = CompletionRequest.parse_obj(body)
+        prompts = process_input(request.model, request.prompt)
+        messages = prompts[0]
+    error_check_ret = check_requests(request)
+    if error_check_ret is not None:
+        raise ValueError(json.loads(error_check_ret.body)["message"])
+
+    gen_params = get_gen_params(
+        request.model,
+        messages,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        max_tokens=request.max_tokens,
+        echo=getattr(request, "echo", False),
+        stream=False,
+        stop=request.stop,
+        allowed_output=request.allowed_output,
+        logprobs=getattr(request, "logprobs", None),
+    )
+    if prompts is None:
+        prompts = [gen_params["prompt"]]
+    del gen_params["prompt"]
+    return gen_params, [prompt for prompt in prompts for _ in range(request.n)]
+
+
+def build_batch_response(
+    endpoint: str, body: Dict[str, Any], outputs: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    usage = UsageInfo()
+    for content in outputs:
+        task_usage = UsageInfo.parse_obj(content["usage"])
+        for usage_key, usage_value in task_usage.dict().items():
+            setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+
+    if endpoint == "/v1/chat/completions":
+        choices = [
+            ChatCompletionResponseChoice(
+                index=i,
+                message=ChatMessage(role="assistant", content=content["text"]),
+                finish_reason=content.get("finish_reason", "stop"),
+            )
+            for i, content in enumerate(outputs)
+        ]
+        response = ChatCompletionResponse(
+            model=body["model"], choices=choices, usage=usage
+        )
+    else:
+        choices = [
+            CompletionResponseChoice(
+                index=i,
+                text=content["text"],
+                logprobs=content.get("logprobs", None),
+                finish_reason=content.get("finish_reason", "stop"),
+            )
+            for i, content in enumerate(outputs)
+        ]
+        response = CompletionResponse(model=body["model"], choices=choices, usage=usage)
+    return json.loads(response.json())
+
+
+def check_batch_manager() -> Optional[JSONResponse]:
+    if batch_manager is None:
+        return create_error_response(
+            ErrorCode.INVALID_BATCH,
+            "Batches are disabled. Start the server with --batch-dir.",
+        )
+    return None
+
+
+@app.on_event("startup")
+async def resume_batches():
+    if batch_manager is not None:
+        batch_manager.resume_all()
+
+
+@app.post("/v1/files")
+async def create_file(file: UploadFile = File(...), purpose: str = Form("batch")):
+    """Upload a JSONL file of batch requests."""
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    content = await file.read()
+    return FileObject(**batch_manager.create_file(file.filename, purpose, content))
+
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str):
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        return FileObject(**batch_manager.get_file(file_id))
+    except KeyError as e:
+        return create_error_response(ErrorCode.INVALID_BATCH, str(e))
+
+
+@app.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str):
+    """Return a file. The output file of a running batch holds the partial results."""
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        batch_manager.get_file(file_id)
+    except KeyError as e:
+        return create_error_response(ErrorCode.INVALID_BATCH, str(e))
+    return FileResponse(
+        batch_manager.file_path(file_id), media_type="application/jsonl"
+    )
+
+
+@app.post("/v1/batches")
+async def create_batch(request: BatchCreateRequest):
+    """Creates a batch job that runs on the idle capacity of the workers"""
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        batch = batch_manager.create_batch(
+            request.input_file_id,
+            request.endpoint,
+            request.completion_window,
+            request.metadata,
         )
-        embedding = response.json()
-        return embedding
+    except (KeyError, ValueError) as e:
+        return create_error_response(ErrorCode.INVALID_BATCH, str(e))
+    return BatchObject(**batch)
+
+
+@app.get("/v1/batches")
+async def list_batches():
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    return BatchList(data=[BatchObject(**b) for b in batch_manager.list_batches()])
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        return BatchObject(**batch_manager.get_batch(batch_id))
+    except KeyError as e:
+        return create_error_response(ErrorCode.INVALID_BATCH, str(e))
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    error_check_ret = check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        return BatchObject(**batch_manager.cancel_batch(batch_id))
+    except KeyError as e:
+        return create_error_response(ErrorCode.INVALID_BATCH, str(e))
 
 
 if __name__ == "__main__":
@@ -706,6 +1326,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "--allowed-headers", type=json.loads, default=["*"], help="allowed headers"
     )
+    parser.add_argument(
+        "--vector-store-dir",
+        type=str,
+        default=None,
+        help="The directory of the vector collections served by /v1/search",
+    )
+    parser.add_argument(
+        "--batch-dir",
+        type=str,
+        default=None,
+        help="The directory of the uploaded files and jobs served by /v1/batches",
+    )
+    parser.add_argument(
+        "--cascade-config",
+        type=str,
+        default=None,
+        help="A JSON file of model cascades. See fastchat/serve/cascade.py",
+    )
     args = parser.parse_args()
 
     app.add_middleware(
@@ -716,6 +1354,20 @@ if __name__ == "__main__":
         allow_headers=args.allowed_headers,
     )
     app_settings.controller_address = args.controller_address
+    app_settings.vector_store_dir = args.vector_store_dir
+    if args.vector_store_dir:
+        vector_store = VectorStore(args.vector_store_dir)
+    app_settings.cascade_config = args.cascade_config
+    if args.cascade_config:
+        cascades = load_cascades(args.cascade_config)
+    app_settings.batch_dir = args.batch_dir
+    if args.batch_dir:
+        batch_manager = BatchJobManager(
+            args.batch_dir,
+            args.controller_address,
+            prepare_batch_request,
+            build_batch_response,
+        )
 
     logger.info(f"args: {args}")
 
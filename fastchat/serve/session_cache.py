@@ -0,0 +1,209 @@
+"""
+Per-session KV caches for multi-turn chats.
+
+After each turn, the worker keeps the KV cache of a session, keyed by the
+session_id of the request, so that the next turn only prefills the tokens
+after the longest common prefix with what the model has already seen, i.e.
+the new user message. Sessions live in three tiers: device memory, host memory
+and a local spill directory. When a tier is over its budget, its least
+recently used sessions are demoted to the next tier, or dropped from the last
+one. A session is promoted back to the device when its next turn starts.
+
+Only the contiguous Hugging Face cache of decoder-only models is supported.
+"""
+import collections
+import dataclasses
+import hashlib
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import torch
+
+GB = 1 << 30
+
+
+@dataclasses.dataclass
+class SessionEntry:
+    # The tokens the model has seen, including those evicted by a KV window.
+    token_ids: List[int]
+    # None while the entry is spilled to disk.
+    past_key_values: Optional[tuple]
+    devices: List[torch.device]
+    cache_len: int
+    num_bytes: int
+    # The attention sinks kept at the start of an evicted cache.
+    num_sinks: int = 0
+    tier: str = "device"
+    path: Optional[str] = None
+
+
+def common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return n
+
+
+class SessionCache:
+    def __init__(
+        self,
+        device_gb: float,
+        host_gb: float = 0,
+        spill_dir: Optional[str] = None,
+        disk_gb: Optional[float] = None,
+    ):
+        if spill_dir is None:
+            disk_budget = 0
+        elif disk_gb is None:
+            disk_budget = float("inf")
+        else:
+            disk_budget = disk_gb * GB
+        self.budgets = {
+            "device": device_gb * GB,
+            "host": host_gb * GB,
+            "disk": disk_budget,
+        }
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        # From the least to the most recently used.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "reused_tokens": 0,
+            "demotions": 0,
+            "promotions": 0,
+            "drops": 0,
+        }
+
+    def put(
+        self,
+        session_id: str,
+        token_ids: List[int],
+        past_key_values: tuple,
+        num_sinks: int = 0,
+    ):
+        """Keep the cache of a session after a turn. token_ids are the tokens
+        that were fed to the model."""
+        entry = SessionEntry(
+            token_ids=list(token_ids),
+            past_key_values=past_key_values,
+            devices=[key.device for key, _ in past_key_values],
+            cache_len=past_key_values[0][0].shape[2],
+            num_bytes=sum(
+                key.numel() * key.element_size() + value.numel() * value.element_size()
+                for key, value in past_key_values
+            ),
+            num_sinks=num_sinks,
+        )
+        with self.lock:
+            old = self.entries.pop(session_id, None)
+            if old is not None:
+                self.delete_file(old)
+            self.entries[session_id] = entry
+            self.enforce_budgets()
+
+    def take(self, session_id: str) -> Optional[SessionEntry]:
+        """Remove the entry of a session and return it on the device."""
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None and entry.tier != "device":
+                self.stats["promotions"] += 1
+        if entry is None:
+            return None
+        if entry.tier == "disk":
+            entry.past_key_values = torch.load(entry.path, map_location="cpu")
+            self.delete_file(entry)
+        if entry.tier != "device":
+            entry.past_key_values = tuple(
+                (key.to(device), value.to(device))
+                for (key, value), device in zip(entry.past_key_values, entry.devices)
+            )
+            entry.tier = "device"
+        return entry
+
+    def reuse(self, session_id: str, input_ids: List[int]) -> Tuple[tuple, int]:
+        """Return (past_key_values, number of reused tokens) for a new turn, or
+        (None, 0). At least one token of input_ids is left to prefill."""
+        entry = self.take(session_id)
+        if entry is None:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None, 0
+
+        n = min(common_prefix_len(entry.token_ids, input_ids), len(input_ids) - 1)
+        num_evicted = len(entry.token_ids) - entry.cache_len
+        if num_evicted and n < entry.num_sinks + num_evicted:
+            # The prompt differs within the tokens evicted from the cache.
+            n = 0
+        cache_len = n - num_evicted
+        if cache_len <= 0:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None, 0
+
+        past_key_values = entry.past_key_values
+        if cache_len < entry.cache_len:
+            past_key_values = tuple(
+                (
+                    key[:, :, :cache_len].contiguous(),
+                    value[:, :, :cache_len].contiguous(),
+                )
+                for key, value in past_key_values
+            )
+        with self.lock:
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += n
+        return past_key_values, n
+
+    def tier_bytes(self, tier: str) -> int:
+        return sum(e.num_bytes for e in self.entries.values() if e.tier == tier)
+
+    def enforce_budgets(self):
+        for tier, next_tier in (("device", "host"), ("host", "disk"), ("disk", None)):
+            used = self.tier_bytes(tier)
+            for session_id, entry in list(self.entries.items()):
+                if used <= self.budgets[tier]:
+                    break
+                if entry.tier != tier:
+                    continue
+                used -= entry.num_bytes
+                if next_tier is None or self.budgets[next_tier] == 0:
+                    del self.entries[session_id]
+                    self.delete_file(entry)
+                    self.stats["drops"] += 1
+                else:
+                    self.demote(session_id, entry)
+
+    def demote(self, session_id: str, entry: SessionEntry):
+        if entry.tier == "device":
+            entry.past_key_values = tuple(
+                (key.to("cpu"), value.to("cpu"))
+                for key, value in entry.past_key_values
+            )
+            entry.tier = "host"
+        else:
+            name = hashlib.sha1(session_id.encode()).hexdigest() + ".pt"
+            entry.path = os.path.join(self.spill_dir, name)
+            torch.save(entry.past_key_values, entry.path)
+            entry.past_key_values = None
+            entry.tier = "disk"
+        self.stats["demotions"] += 1
+
+    def delete_file(self, entry: SessionEntry):
+        if entry.path is not None and os.path.exists(entry.path):
+            os.remove(entry.path)
+        entry.path = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            for tier in self.budgets:
+                stats[f"{tier}_sessions"] = sum(
+                    e.tier == tier for e in self.entries.values()
+                )
+                stats[f"{tier}_bytes"] = self.tier_bytes(tier)
+        return stats
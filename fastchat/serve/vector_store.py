@@ -0,0 +1,462 @@
+"""
+Named vector collections for semantic search.
+
+Each collection lives in its own directory:
+- meta.json: the dimension, the quantization and the approximate index type.
+- vectors.bin: the L2-normalized vectors, float32 or int8 rows.
+- scales.bin: the float32 per-row scales of int8 vectors.
+- items.jsonl: the id and the metadata of every row.
+- ivf_centroids.npy / ivf_assign.bin or hnsw.bin: the optional approximate index.
+
+vectors.bin is append-only and read through a memory map, so collections
+much larger than RAM can be searched.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Rows scored per matrix product during an exact search.
+SEARCH_CHUNK_SIZE = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def merge_topk(indices, scores, new_indices, new_scores, k):
+    """Merge two [num_queries, *] candidate lists and keep the best k."""
+    if indices is not None:
+        new_indices = np.concatenate([indices, new_indices], axis=1)
+        new_scores = np.concatenate([scores, new_scores], axis=1)
+    k = min(k, new_scores.shape[1])
+    part = np.argpartition(-new_scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(new_scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return (
+        np.take_along_axis(np.take_along_axis(new_indices, part, axis=1), order, 1),
+        np.take_along_axis(part_scores, order, axis=1),
+    )
+
+
+class VectorCollection:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        with open(os.path.join(path, "meta.json")) as fin:
+            self.meta = json.load(fin)
+        self.dim = self.meta["dim"]
+        self.quantization = self.meta.get("quantization")
+
+        self.items = []
+        self._recover()
+
+        self.vectors = None
+        self.scales = None
+        self.ivf_centroids = None
+        self.ivf_assign = None
+        self.ivf_lists = None
+        self.hnsw = None
+        self._remap()
+        self._load_index()
+
+    @classmethod
+    def create(
+        cls,
+        path: str,
+        model: str,
+        dim: Optional[int] = None,
+        quantization: Optional[str] = None,
+    ):
+        """Create a collection. If dim is None, it is set by the first add."""
+        if quantization not in (None, "int8"):
+            raise ValueError(f"Invalid quantization: {quantization}")
+        os.makedirs(path)
+        with open(os.path.join(path, "meta.json"), "w") as fout:
+            json.dump(
+                {"dim": dim, "model": model, "quantization": quantization}, fout
+            )
+        return cls(path)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _recover(self):
+        """Read items.jsonl and cut all files to the rows that were completely
+        written, dropping the rest of an add interrupted by a crash."""
+        items_path = os.path.join(self.path, "items.jsonl")
+        valid_bytes = 0
+        if os.path.exists(items_path):
+            with open(items_path, "rb") as fin:
+                for line in fin:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self.items.append(json.loads(line))
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+            if valid_bytes != os.path.getsize(items_path):
+                os.truncate(items_path, valid_bytes)
+
+        files = []
+        if self.dim is not None:
+            row_bytes = self.dim * (1 if self.quantization == "int8" else 4)
+            files.append((os.path.join(self.path, "vectors.bin"), row_bytes))
+            if self.quantization == "int8":
+                files.append((os.path.join(self.path, "scales.bin"), 4))
+        num_rows = len(self.items)
+        for file_path, row_bytes in files:
+            size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            num_rows = min(num_rows, size // row_bytes)
+        if num_rows < len(self.items):
+            # Should not happen, the items are written last.
+            self.items = self.items[:num_rows]
+            with open(items_path, "w") as fout:
+                for item in self.items:
+                    fout.write(json.dumps(item, ensure_ascii=False) + "\n")
+        for file_path, row_bytes in files:
+            if os.path.exists(file_path):
+                if os.path.getsize(file_path) != num_rows * row_bytes:
+                    os.truncate(file_path, num_rows * row_bytes)
+
+    def _remap(self):
+        num_rows = len(self.items)
+        if num_rows == 0:
+            self.vectors = self.scales = None
+            return
+        dtype = np.int8 if self.quantization == "int8" else np.float32
+        self.vectors = np.memmap(
+            os.path.join(self.path, "vectors.bin"),
+            dtype=dtype,
+            mode="r",
+            shape=(num_rows, self.dim),
+        )
+        if self.quantization == "int8":
+            self.scales = np.memmap(
+                os.path.join(self.path, "scales.bin"),
+                dtype=np.float32,
+                mode="r",
+                shape=(num_rows,),
+            )
+
+    def _save_meta(self):
+        with open(os.path.join(self.path, "meta.json"), "w") as fout:
+            json.dump(self.meta, fout)
+
+    def add(
+        self,
+        vectors: np.ndarray,
+        ids: Optional[List[str]] = None,
+        metadata: Optional[List[Dict[str, Any]]] = None,
+    ) -> List[str]:
+        """Append vectors to the collection and return their ids."""
+        vectors = normalize(vectors)
+        with self.lock:
+            if self.dim is None and vectors.ndim == 2:
+                self.dim = self.meta["dim"] = vectors.shape[1]
+                self._save_meta()
+            if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Expected vectors of dimension {self.dim}, got {vectors.shape}"
+                )
+            start = len(self.items)
+            if ids is None:
+                ids = [str(start + i) for i in range(len(vectors))]
+            if metadata is None:
+                metadata = [None] * len(vectors)
+            if len(ids) != len(vectors) or len(metadata) != len(vectors):
+                raise ValueError("ids and metadata must match the number of vectors")
+
+            if self.quantization == "int8":
+                scales = np.abs(vectors).max(axis=1) / 127
+                scales = np.maximum(scales, 1e-12).astype(np.float32)
+                codes = np.round(vectors / scales[:, None]).astype(np.int8)
+                with open(os.path.join(self.path, "vectors.bin"), "ab") as fout:
+                    fout.write(codes.tobytes())
+                with open(os.path.join(self.path, "scales.bin"), "ab") as fout:
+                    fout.write(scales.tobytes())
+            else:
+                with open(os.path.join(self.path, "vectors.bin"), "ab") as fout:
+                    fout.write(vectors.tobytes())
+
+            new_items = [{"id": i, "metadata": m} for i, m in zip(ids, metadata)]
+            with open(os.path.join(self.path, "items.jsonl"), "a") as fout:
+                for item in new_items:
+                    fout.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self.items.extend(new_items)
+            self._remap()
+
+            # Keep the approximate index up to date.
+            if self.ivf_centroids is not None:
+                assign = self._ivf_assign(vectors)
+                with open(os.path.join(self.path, "ivf_assign.bin"), "ab") as fout:
+                    fout.write(assign.tobytes())
+                self.ivf_assign = np.concatenate([self.ivf_assign, assign])
+                self.ivf_lists = None
+            if self.hnsw is not None:
+                self.hnsw.resize_index(len(self.items))
+                self.hnsw.add_items(vectors, np.arange(start, len(self.items)))
+                self.hnsw.save_index(os.path.join(self.path, "hnsw.bin"))
+        return ids
+
+    def _rows(self, start: int, end: int) -> np.ndarray:
+        """Dequantized vectors of rows [start, end)."""
+        rows = np.asarray(self.vectors[start:end], dtype=np.float32)
+        if self.quantization == "int8":
+            rows = rows * self.scales[start:end, None]
+        return rows
+
+    def _gather(self, rows: np.ndarray) -> np.ndarray:
+        """Dequantized vectors of the given row numbers."""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.quantization == "int8":
+            vectors = vectors * self.scales[rows][:, None]
+        return vectors
+
+    def _score_rows(self, queries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Score the queries against the given row numbers."""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        scores = queries @ vectors.T
+        if self.quantization == "int8":
+            scores *= self.scales[rows][None, :]
+        return scores
+
+    def exact_search(self, queries: np.ndarray, top_k: int):
+        indices = scores = None
+        for start in range(0, len(self.items), SEARCH_CHUNK_SIZE):
+            end = min(start + SEARCH_CHUNK_SIZE, len(self.items))
+            chunk_scores = queries @ np.asarray(
+                self.vectors[start:end], dtype=np.float32
+            ).T
+            if self.quantization == "int8":
+                chunk_scores *= self.scales[start:end][None, :]
+            chunk_indices = np.broadcast_to(
+                np.arange(start, end), chunk_scores.shape
+            )
+            indices, scores = merge_topk(
+                indices, scores, chunk_indices, chunk_scores, top_k
+            )
+        return indices, scores
+
+    def build_index(self, index_type: str, **kwargs):
+        if index_type == "ivf":
+            self._build_ivf(**kwargs)
+        elif index_type == "hnsw":
+            self._build_hnsw(**kwargs)
+        else:
+            raise ValueError(f"Invalid index type: {index_type}")
+
+    def _kmeans(self, num_lists: int, num_iters: int, sample_size: int):
+        rng = np.random.default_rng(0)
+        num_rows = len(self.items)
+        sample = np.sort(
+            rng.choice(num_rows, min(num_rows, sample_size), replace=False)
+        )
+        data = normalize(self._gather(sample))
+        centroids = data[rng.choice(len(data), num_lists, replace=False)]
+        for _ in range(num_iters):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(num_lists):
+                members = data[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        return centroids
+
+    def _ivf_assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.ivf_centroids.T, axis=1).astype(np.int32)
+
+    def _build_ivf(self, num_lists: int = None, num_iters: int = 20):
+        num_rows = len(self.items)
+        if num_rows == 0:
+            raise ValueError("Cannot build an index over an empty collection")
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(num_rows)))
+        num_lists = min(num_lists, num_rows)
+        with self.lock:
+            self.ivf_centroids = self._kmeans(num_lists, num_iters, num_lists * 256)
+            assign = np.concatenate(
+                [
+                    self._ivf_assign(self._rows(start, start + SEARCH_CHUNK_SIZE))
+                    for start in range(0, num_rows, SEARCH_CHUNK_SIZE)
+                ]
+            )
+            np.save(os.path.join(self.path, "ivf_centroids.npy"), self.ivf_centroids)
+            with open(os.path.join(self.path, "ivf_assign.bin"), "wb") as fout:
+                fout.write(assign.tobytes())
+            self.ivf_assign = assign
+            self.ivf_lists = None
+            self.meta["index"] = "ivf"
+            self._save_meta()
+
+    def _build_hnsw(self, m: int = 16, ef_construction: int = 200):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("The HNSW index requires `pip install hnswlib`")
+
+        num_rows = len(self.items)
+        with self.lock:
+            index = hnswlib.Index(space="ip", dim=self.dim)
+            index.init_index(
+                max_elements=max(num_rows, 1), ef_construction=ef_construction, M=m
+            )
+            for start in range(0, num_rows, SEARCH_CHUNK_SIZE):
+                end = min(start + SEARCH_CHUNK_SIZE, num_rows)
+                index.add_items(self._rows(start, end), np.arange(start, end))
+            index.save_index(os.path.join(self.path, "hnsw.bin"))
+            self.hnsw = index
+            self.meta["index"] = "hnsw"
+            self._save_meta()
+
+    def _load_index(self):
+        index_type = self.meta.get("index")
+        if index_type == "ivf":
+            self.ivf_centroids = np.load(os.path.join(self.path, "ivf_centroids.npy"))
+            assign_path = os.path.join(self.path, "ivf_assign.bin")
+            self.ivf_assign = np.fromfile(assign_path, dtype=np.int32)
+            num_assigned = len(self.ivf_assign)
+            if num_assigned > len(self.items):
+                self.ivf_assign = self.ivf_assign[: len(self.items)]
+                os.truncate(assign_path, len(self.items) * 4)
+            elif num_assigned < len(self.items):
+                # Assign the rows added after the last write of the index.
+                assign = self._ivf_assign(self._rows(num_assigned, len(self.items)))
+                with open(assign_path, "ab") as fout:
+                    fout.write(assign.tobytes())
+                self.ivf_assign = np.concatenate([self.ivf_assign, assign])
+        elif index_type == "hnsw":
+            import hnswlib
+
+            self.hnsw = hnswlib.Index(space="ip", dim=self.dim)
+            self.hnsw.load_index(
+                os.path.join(self.path, "hnsw.bin"), max_elements=len(self.items)
+            )
+            num_indexed = self.hnsw.get_current_count()
+            if num_indexed < len(self.items):
+                self.hnsw.add_items(
+                    self._rows(num_indexed, len(self.items)),
+                    np.arange(num_indexed, len(self.items)),
+                )
+                self.hnsw.save_index(os.path.join(self.path, "hnsw.bin"))
+
+    def ivf_search(self, queries: np.ndarray, top_k: int, nprobe: int):
+        if self.ivf_lists is None:
+            # Rows grouped by inverted list, with the start offset of each list.
+            order = np.argsort(self.ivf_assign, kind="stable")
+            counts = np.bincount(self.ivf_assign, minlength=len(self.ivf_centroids))
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            self.ivf_lists = (order, offsets)
+        order, offsets = self.ivf_lists
+
+        nprobe = min(nprobe, len(self.ivf_centroids))
+        probes = np.argsort(-(queries @ self.ivf_centroids.T), axis=1)[:, :nprobe]
+        all_indices, all_scores = [], []
+        for q, lists in enumerate(probes):
+            rows = np.sort(
+                np.concatenate([order[offsets[c] : offsets[c + 1]] for c in lists])
+            )
+            if len(rows) == 0:
+                all_indices.append(np.full(top_k, -1))
+                all_scores.append(np.full(top_k, -np.inf, dtype=np.float32))
+                continue
+            scores = self._score_rows(queries[q : q + 1], rows)
+            indices, scores = merge_topk(None, None, rows[None, :], scores, top_k)
+            pad = top_k - indices.shape[1]
+            all_indices.append(np.pad(indices[0], (0, pad), constant_values=-1))
+            all_scores.append(np.pad(scores[0], (0, pad), constant_values=-np.inf))
+        return np.stack(all_indices), np.stack(all_scores)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int = 10,
+        exact: bool = False,
+        nprobe: int = 8,
+        ef: int = 64,
+    ) -> List[List[Dict[str, Any]]]:
+        """Return the top_k rows by cosine similarity for every query."""
+        queries = normalize(queries)
+        if len(self.items) == 0:
+            return [[] for _ in queries]
+        if queries.shape[1] != self.dim:
+            raise ValueError(
+                f"Expected queries of dimension {self.dim}, got {queries.shape[1]}"
+            )
+        top_k = min(top_k, len(self.items))
+
+        with self.lock:
+            if not exact and self.hnsw is not None:
+                self.hnsw.set_ef(max(ef, top_k))
+                indices, distances = self.hnsw.knn_query(queries, k=top_k)
+                scores = 1 - distances
+            elif not exact and self.ivf_centroids is not None:
+                indices, scores = self.ivf_search(queries, top_k, nprobe)
+            else:
+                indices, scores = self.exact_search(queries, top_k)
+
+        results = []
+        for row_indices, row_scores in zip(indices, scores):
+            results.append(
+                [
+                    {
+                        "id": self.items[i]["id"],
+                        "score": float(score),
+                        "metadata": self.items[i]["metadata"],
+                    }
+                    for i, score in zip(row_indices, row_scores)
+                    if i >= 0
+                ]
+            )
+        return results
+
+
+class VectorStore:
+    """A directory of named vector collections."""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.collections = {}
+        self.lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+        for name in sorted(os.listdir(root_dir)):
+            if os.path.exists(os.path.join(root_dir, name, "meta.json")):
+                self.collections[name] = VectorCollection(os.path.join(root_dir, name))
+
+    def list(self) -> List[str]:
+        return sorted(self.collections)
+
+    def get(self, name: str) -> VectorCollection:
+        if name not in self.collections:
+            raise KeyError(f"Collection {name} does not exist")
+        return self.collections[name]
+
+    def create(
+        self,
+        name: str,
+        model: str,
+        dim: Optional[int] = None,
+        quantization: Optional[str] = None,
+    ) -> VectorCollection:
+        if not re.fullmatch(r"[A-Za-z0-9_.-]+", name) or name.startswith("."):
+            raise ValueError(f"Invalid collection name: {name}")
+        with self.lock:
+            if name in self.collections:
+                raise ValueError(f"Collection {name} already exists")
+            self.collections[name] = VectorCollection.create(
+                os.path.join(self.root_dir, name), model, dim, quantization
+            )
+            return self.collections[name]
+
+    def delete(self, name: str):
+        with self.lock:
+            self.get(name)
+            del self.collections[name]
+            shutil.rmtree(os.path.join(self.root_dir, name))
@@ -0,0 +1,228 @@
+"""
+Distill a few-shot conversation template into a LoRA adapter.
+
+Step 1: answer an unlabeled corpus with the full few-shot template (the
+teacher) and save the answers as ShareGPT-style training data. The data is
+formatted with a short registered template (the student), e.g.
+"obuv_distilled", which has no examples at all.
+
+Step 2 (with --lora-output-dir): train a LoRA adapter on the data with the
+student template, by running fastchat/train/train_lora.py in a new process.
+--train-args are passed on to it.
+
+Step 3 (with --merged-model-path): merge the adapter into a model whose path
+contains the template name, so that the serving stack picks the short template
+automatically.
+
+Usage:
+python3 -m fastchat.train.distill_template --model-path /path/to/vicuna-13b \
+    --input offers.csv --sep ";" --column name \
+    --teacher-template obuv --student-template obuv_distilled \
+    --output data/obuv_distilled.json --num-samples 20000 \
+    --lora-output-dir checkpoints/obuv_distilled \
+    --merged-model-path /path/to/vicuna-13b-obuv_distilled
+
+The steps can also be run by hand, e.g. to train with deepspeed:
+deepspeed fastchat/train/train_lora.py --model_name_or_path /path/to/vicuna-13b \
+    --data_path data/obuv_distilled.json --conv_template obuv_distilled ...
+python3 -m fastchat.model.apply_lora --base-model-path /path/to/vicuna-13b \
+    --target-model-path /path/to/vicuna-13b-obuv_distilled --lora-path /path/to/lora
+"""
+import argparse
+import gc
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+import torch
+
+from fastchat.conversation import conv_templates, get_conv_template
+from fastchat.data.near_dedup import NearDuplicateIndex
+from fastchat.model.model_adapter import add_model_args, load_model
+from fastchat.serve.batch_infer import BatchGenerator, read_chunks
+
+
+def prompt_length(tokenizer, template_name: str, text: str) -> int:
+    conv = get_conv_template(template_name)
+    conv.append_message(conv.roles[0], text)
+    conv.append_message(conv.roles[1], None)
+    return len(tokenizer(conv.get_prompt()).input_ids)
+
+
+def read_corpus(args):
+    """Yield the distinct texts of the corpus, up to --num-samples."""
+    index = NearDuplicateIndex() if args.dedup else None
+    seen = set()
+    num_texts = 0
+    for df in read_chunks(args.input, args.chunk_size, args.sep):
+        for text in df[args.column].dropna().astype(str):
+            text = text.strip()
+            if not text or text in seen:
+                continue
+            seen.add(text)
+            if index is not None and index.assign(num_texts, text)[0] is not None:
+                continue
+            yield text
+            num_texts += 1
+            if args.num_samples and num_texts >= args.num_samples:
+                return
+
+
+def train_lora(args):
+    """Train a LoRA adapter on the distilled data in a new process."""
+    cmd = [
+        sys.executable,
+        "-m",
+        "fastchat.train.train_lora",
+        "--model_name_or_path",
+        args.model_path,
+        "--data_path",
+        args.output,
+        "--conv_template",
+        args.student_template,
+        "--output_dir",
+        args.lora_output_dir,
+        *shlex.split(args.train_args),
+    ]
+    print("Training the LoRA adapter: " + " ".join(map(shlex.quote, cmd)))
+    subprocess.run(cmd, check=True)
+
+
+def main(args):
+    if args.merged_model_path and not args.lora_output_dir:
+        raise ValueError("--merged-model-path needs --lora-output-dir")
+    if args.student_template not in conv_templates:
+        raise ValueError(f"Unknown student template: {args.student_template}")
+    if not args.student_template.endswith("_distilled"):
+        print(
+            "Warning: serving only selects the student template automatically "
+            "for model paths containing a template name ending with _distilled."
+        )
+
+    model, tokenizer = load_model(
+        args.model_path,
+        args.device,
+        args.num_gpus,
+        args.max_gpu_memory,
+        args.load_8bit,
+        args.cpu_offloading,
+        sdpa_attn=args.sdpa_attn,
+        cpu_dtype=args.cpu_dtype,
+    )
+    args.conv_template = args.teacher_template
+    teacher = BatchGenerator(model, tokenizer, args.device, args)
+
+    texts = list(read_corpus(args))
+    print(f"#texts: {len(texts)}")
+
+    data = []
+    num_dropped = 0
+    for start in range(0, len(texts), args.chunk_size):
+        chunk = texts[start : start + args.chunk_size]
+        outputs = teacher.generate(chunk)
+        for text, output in zip(chunk, outputs):
+            answer = output["text"].strip()
+            # Truncated or empty answers would teach the student to ramble.
+            if not answer or output["finish_reason"] == "length":
+                num_dropped += 1
+                continue
+            data.append(
+                {
+                    "id": f"{args.student_template}_{len(data)}",
+                    "conversations": [
+                        {"from": "human", "value": text},
+                        {"from": "gpt", "value": answer},
+                    ],
+                }
+            )
+        print(f"#done: {start + len(chunk)}, #kept: {len(data)}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as fout:
+        json.dump(data, fout, indent=2, ensure_ascii=False)
+    print(f"#kept: {len(data)}, #dropped: {num_dropped}, saved to {args.output}")
+
+    if texts:
+        sample = texts[:100]
+        teacher_len = sum(
+            prompt_length(tokenizer, args.teacher_template, t) for t in sample
+        )
+        student_len = sum(
+            prompt_length(tokenizer, args.student_template, t) for t in sample
+        )
+        print(
+            f"Mean prompt length: {teacher_len / len(sample):.0f} tokens with "
+            f"{args.teacher_template}, {student_len / len(sample):.0f} tokens with "
+            f"{args.student_template} ({teacher_len / student_len:.1f}x shorter)"
+        )
+
+    if args.lora_output_dir:
+        # Free the teacher, the training process loads the model again.
+        del teacher, model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        train_lora(args)
+    if args.merged_model_path:
+        from fastchat.model.apply_lora import apply_lora
+
+        if args.student_template not in args.merged_model_path:
+            print(
+                f"Warning: {args.merged_model_path} does not contain "
+                f"{args.student_template}, so serving will not select it."
+            )
+        apply_lora(args.model_path, args.merged_model_path, args.lora_output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument(
+        "--input", type=str, required=True, help="A CSV or Parquet file"
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="The ShareGPT-style JSON output"
+    )
+    parser.add_argument("--sep", type=str, default=",", help="The CSV separator")
+    parser.add_argument(
+        "--column", type=str, default="name", help="The input text column"
+    )
+    parser.add_argument("--teacher-template", type=str, required=True)
+    parser.add_argument("--student-template", type=str, required=True)
+    parser.add_argument("--num-samples", type=int, default=None)
+    parser.add_argument(
+        "--dedup", action="store_true", help="Skip near-duplicate inputs"
+    )
+    parser.add_argument("--temperature", type=float, default=0.01)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument(
+        "--lora-output-dir",
+        type=str,
+        default=None,
+        help="Train a LoRA adapter on the data and save it here",
+    )
+    parser.add_argument(
+        "--train-args",
+        type=str,
+        default="--num_train_epochs 3 --learning_rate 2e-4 "
+        "--per_device_train_batch_size 4 --model_max_length 512",
+        help="More arguments of fastchat/train/train_lora.py, in one string",
+    )
+    parser.add_argument(
+        "--merged-model-path",
+        type=str,
+        default=None,
+        help="Merge the trained adapter into the model and save it here",
+    )
+    args = parser.parse_args()
+
+    if args.gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    main(args)
@@ -43,6 +43,10 @@ class DataArguments:
         default=None, metadata={"help": "Path to the training data."}
     )
     lazy_preprocess: bool = False
+    conv_template: str = field(
+        default="vicuna",
+        metadata={"help": "A model name or template name to format the data with."},
+    )
 
 
 @dataclass
@@ -77,8 +81,9 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer, output_dir: st
 def preprocess(
     sources,
     tokenizer: transformers.PreTrainedTokenizer,
+    conv_template: str = "vicuna",
 ) -> Dict:
-    conv = get_conversation_template("vicuna")
+    conv = get_conversation_template(conv_template)
     roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
 
     # Apply prompt templates
@@ -154,12 +159,17 @@ def preprocess(
 class SupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
-    def __init__(self, raw_data, tokenizer: transformers.PreTrainedTokenizer):
+    def __init__(
+        self,
+        raw_data,
+        tokenizer: transformers.PreTrainedTokenizer,
+        conv_template: str = "vicuna",
+    ):
         super(SupervisedDataset, self).__init__()
 
         rank0_print("Formatting inputs...")
         sources = [example["conversations"] for example in raw_data]
-        data_dict = preprocess(sources, tokenizer)
+        data_dict = preprocess(sources, tokenizer, conv_template)
 
         self.input_ids = data_dict["input_ids"]
         self.labels = data_dict["labels"]
@@ -179,9 +189,15 @@ class SupervisedDataset(Dataset):
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
-    def __init__(self, raw_data, tokenizer: transformers.PreTrainedTokenizer):
+    def __init__(
+        self,
+        raw_data,
+        tokenizer: transformers.PreTrainedTokenizer,
+        conv_template: str = "vicuna",
+    ):
         super(LazySupervisedDataset, self).__init__()
         self.tokenizer = tokenizer
+        self.conv_template = conv_template
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
@@ -195,7 +211,9 @@ class LazySupervisedDataset(Dataset):
         if i in self.cached_data_dict:
             return self.cached_data_dict[i]
 
-        ret = preprocess([self.raw_data[i]["conversations"]], self.tokenizer)
+        ret = preprocess(
+            [self.raw_data[i]["conversations"]], self.tokenizer, self.conv_template
+        )
         ret = dict(
             input_ids=ret["input_ids"][0],
             labels=ret["labels"][0],
@@ -225,8 +243,12 @@ def make_supervised_data_module(
     eval_raw_data = [raw_data[i] for i in eval_indices]
     rank0_print(f"#train {len(train_raw_data)}, #eval {len(eval_raw_data)}")
 
-    train_dataset = dataset_cls(train_raw_data, tokenizer=tokenizer)
-    eval_dataset = dataset_cls(eval_raw_data, tokenizer=tokenizer)
+    train_dataset = dataset_cls(
+        train_raw_data, tokenizer=tokenizer, conv_template=data_args.conv_template
+    )
+    eval_dataset = dataset_cls(
+        eval_raw_data, tokenizer=tokenizer, conv_template=data_args.conv_template
+    )
     return dict(train_dataset=train_dataset, eval_dataset=eval_dataset)
 
 
@@ -136,6 +136,16 @@ def get_gpu_memory(max_gpus=None):
     return gpu_memory
 
 
+def cpu_supports_bf16():
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
 def violates_moderation(text):
     """
     Check whether the text violates OpenAI moderation API.
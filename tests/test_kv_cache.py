@@ -0,0 +1,118 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from fastchat.model.kv_cache import BlockAllocator, PagedKVCache
+
+NUM_HEADS = 2
+HEAD_DIM = 4
+BLOCK_SIZE = 4
+
+
+def make_cache(num_blocks=8, num_host_blocks=0, kv_dtype="auto"):
+    return PagedKVCache(
+        num_layers=1,
+        num_heads=NUM_HEADS,
+        head_dim=HEAD_DIM,
+        num_blocks=num_blocks,
+        num_host_blocks=num_host_blocks,
+        block_size=BLOCK_SIZE,
+        dtype=torch.float32,
+        devices=[torch.device("cpu")],
+        kv_dtype=kv_dtype,
+    )
+
+
+def write(cache, seq_ids, num_tokens, seed=0):
+    """Run one step that appends random keys and values and return them with
+    all the keys and values of the sequences."""
+    generator = torch.Generator().manual_seed(seed)
+    shape = (len(seq_ids), NUM_HEADS, num_tokens, HEAD_DIM)
+    keys = torch.randn(shape, generator=generator)
+    values = torch.randn(shape, generator=generator)
+    with cache.step(seq_ids, num_tokens):
+        all_keys, all_values, _ = cache.update(0, keys, values)
+    return keys, values, all_keys, all_values
+
+
+def test_allocator():
+    allocator = BlockAllocator(2)
+    a = allocator.allocate()
+    b = allocator.allocate()
+    assert {a, b} == {0, 1} and allocator.num_free == 0
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+    allocator.incref(a)
+    allocator.decref(a)
+    assert allocator.num_free == 0
+    allocator.decref(a)
+    assert allocator.num_free == 1
+    assert allocator.allocate() == a
+
+
+def test_step_returns_all_tokens():
+    cache = make_cache()
+    seq = cache.add_sequence()
+    keys1, values1, _, _ = write(cache, [seq], 6, seed=1)
+    keys2, values2, all_keys, all_values = write(cache, [seq], 1, seed=2)
+    assert torch.equal(all_keys, torch.cat([keys1, keys2], dim=2))
+    assert torch.equal(all_values, torch.cat([values1, values2], dim=2))
+    assert len(cache.block_tables[seq]) == 2
+    assert cache.allocator.num_free == 6
+
+
+def test_fork_copies_the_shared_tail_on_write():
+    cache = make_cache()
+    parent = cache.add_sequence()
+    keys, _, _, _ = write(cache, [parent], 6)
+    child = cache.fork(parent)
+    assert cache.block_tables[child] == cache.block_tables[parent]
+    assert all(cache.allocator.ref_counts[b] == 2 for b in cache.block_tables[child])
+
+    child_keys, _, all_child_keys, _ = write(cache, [child], 1, seed=3)
+    assert cache.stats["copy_on_writes"] == 1
+    # The full first block stays shared, the partial tail was copied.
+    assert cache.block_tables[child][0] == cache.block_tables[parent][0]
+    assert cache.block_tables[child][1] != cache.block_tables[parent][1]
+    assert torch.equal(all_child_keys, torch.cat([keys, child_keys], dim=2))
+
+    # The parent does not see the token of the child.
+    parent_keys, _, all_parent_keys, _ = write(cache, [parent], 1, seed=4)
+    assert torch.equal(all_parent_keys, torch.cat([keys, parent_keys], dim=2))
+
+    cache.free(child)
+    cache.free(parent)
+    assert cache.allocator.num_free == cache.allocator.num_blocks
+
+
+def test_swap_out_and_in():
+    cache = make_cache(num_blocks=3, num_host_blocks=4)
+    a = cache.add_sequence()
+    keys_a, _, _, _ = write(cache, [a], BLOCK_SIZE * 2)
+    b = cache.add_sequence()
+    write(cache, [b], BLOCK_SIZE * 2, seed=1)
+    assert a in cache.swapped and cache.stats["swap_outs"] == 1
+
+    new_keys, _, all_keys, _ = write(cache, [a], 1, seed=2)
+    assert a not in cache.swapped and b in cache.swapped
+    assert torch.equal(all_keys, torch.cat([keys_a, new_keys], dim=2))
+
+
+def test_running_sequences_are_not_swapped_out():
+    cache = make_cache(num_blocks=2, num_host_blocks=4)
+    a = cache.add_sequence()
+    b = cache.add_sequence()
+    with cache.step([a], BLOCK_SIZE * 2):
+        with pytest.raises(RuntimeError):
+            with cache.step([b], 1):
+                pass
+    assert a not in cache.swapped
+
+
+def test_int8_cache_is_close():
+    cache = make_cache(kv_dtype="int8")
+    seq = cache.add_sequence()
+    keys, values, all_keys, all_values = write(cache, [seq], 5)
+    assert torch.allclose(all_keys, keys, atol=0.05)
+    assert torch.allclose(all_values, values, atol=0.05)
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("pandas")
+
+from fastchat.data.near_dedup import (
+    NearDuplicateIndex,
+    cluster_texts,
+    normalize_text,
+    number_tokens,
+)
+
+
+def test_normalize_strips_codes():
+    assert normalize_text("934 CS1219PL Кеды Nike Air, белые!") == "кеды nike air белые"
+    assert "128gb" in normalize_text("Смартфон Apple iPhone 13 128GB")
+
+
+def test_number_tokens():
+    assert number_tokens("apple iphone 13 128gb") == ("128gb", "13")
+    assert number_tokens("кеды nike air") == ()
+
+
+def test_cluster_near_duplicates():
+    texts = [
+        "Кеды Nike Air Force 1 белые",
+        "934 CS1219PL Кеды Nike Air Force 1 белые",
+        "Кеды Nike Air Force 1 белые.",
+        "Пылесос Dyson V15 Detect",
+    ]
+    rep_ids, confidences = cluster_texts(texts)
+    assert rep_ids == [None, 0, 0, None]
+    assert confidences[0] == 1.0
+    assert 0 < confidences[1] < 1.0
+
+
+def test_different_numbers_never_match():
+    rep_ids, _ = cluster_texts(["Apple iPhone 13", "Apple iPhone 14"])
+    assert rep_ids == [None, None]
+    rep_ids, _ = cluster_texts(
+        ["Apple iPhone 13", "Apple iPhone 14"], match_numbers=False, threshold=0.5
+    )
+    assert rep_ids == [None, 0]
+
+
+def test_assign_adds_representatives():
+    index = NearDuplicateIndex()
+    assert index.assign("a", "Чехол для iPhone 13 прозрачный") == (None, 1.0)
+    assert index.assign("b", "Чехол для iPhone 13 прозрачный")[0] == "a"
+    assert index.assign("c", "Наушники Sony WH-1000XM4")[0] is None
+    assert len(index) == 2
+
+
+def test_invalid_bands():
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(num_perm=100, num_bands=16)
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from fastchat.serve.session_cache import GB, SessionCache
+
+# The bytes of one layer of keys and values for 5 tokens in make_cache.
+ENTRY_BYTES = 2 * 5 * 2 * 4
+
+
+def make_cache(num_tokens=5, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    shape = (1, 1, num_tokens, 2)
+    key = torch.randn(shape, generator=generator)
+    value = torch.randn(shape, generator=generator)
+    return ((key, value),)
+
+
+def test_reuse_the_common_prefix():
+    cache = SessionCache(device_gb=1)
+    past_key_values = make_cache()
+    cache.put("s", [1, 2, 3, 4, 5], past_key_values)
+
+    reused, n = cache.reuse("s", [1, 2, 3, 4, 5, 6, 7])
+    assert n == 5
+    assert torch.equal(reused[0][0], past_key_values[0][0])
+    # A session is taken out of the cache until its turn is put back.
+    assert cache.reuse("s", [1, 2, 3]) == (None, 0)
+
+    cache.put("s", [1, 2, 3, 4, 5], past_key_values)
+    reused, n = cache.reuse("s", [1, 2, 9, 9])
+    assert n == 2
+    assert torch.equal(reused[0][0], past_key_values[0][0][:, :, :2])
+
+    cache.put("s", [1, 2, 3, 4, 5], past_key_values)
+    # At least one token is left to prefill.
+    reused, n = cache.reuse("s", [1, 2, 3, 4, 5])
+    assert n == 4
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 3 and stats["misses"] == 1
+    assert stats["reused_tokens"] == 11
+
+
+def test_demote_and_promote(tmp_path):
+    cache = SessionCache(
+        device_gb=ENTRY_BYTES / GB,
+        host_gb=ENTRY_BYTES / GB,
+        spill_dir=str(tmp_path),
+    )
+    entries = {name: make_cache(seed=i) for i, name in enumerate("abc")}
+    for name, past_key_values in entries.items():
+        cache.put(name, [1, 2, 3, 4, 5], past_key_values)
+    assert [cache.entries[name].tier for name in "abc"] == ["disk", "host", "device"]
+    path = cache.entries["a"].path
+    assert os.path.exists(path)
+
+    entry = cache.take("a")
+    assert entry.tier == "device"
+    assert torch.equal(entry.past_key_values[0][1], entries["a"][0][1])
+    assert not os.path.exists(path)
+    entry = cache.take("b")
+    assert torch.equal(entry.past_key_values[0][0], entries["b"][0][0])
+
+    stats = cache.get_stats()
+    assert stats["promotions"] == 2
+    assert stats["demotions"] == 3
+    assert stats["device_sessions"] == 1 and stats["disk_sessions"] == 0
+
+
+def test_drop_without_a_next_tier():
+    cache = SessionCache(device_gb=ENTRY_BYTES / GB)
+    cache.put("a", [1, 2, 3, 4, 5], make_cache())
+    cache.put("b", [1, 2, 3, 4, 5], make_cache())
+    assert list(cache.entries) == ["b"]
+    assert cache.get_stats()["drops"] == 1
+
+
+def test_prompt_that_differs_in_the_evicted_tokens():
+    cache = SessionCache(device_gb=1)
+    # 8 tokens were seen, 3 were evicted after the first one (the sink).
+    cache.put("s", [1, 2, 3, 4, 5, 6, 7, 8], make_cache(), num_sinks=1)
+    assert cache.reuse("s", [1, 9, 3, 4, 5, 6, 7, 8, 10]) == (None, 0)
+
+    cache.put("s", [1, 2, 3, 4, 5, 6, 7, 8], make_cache(), num_sinks=1)
+    reused, n = cache.reuse("s", [1, 2, 3, 4, 5, 6, 7, 8, 10])
+    assert n == 8 and reused[0][0].shape[2] == 5
@@ -0,0 +1,95 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("accelerate")
+
+from fastchat.model.shared_weights import (
+    attach_shared_weights,
+    export_shared_weights,
+    load_shared_model,
+    map_safetensors,
+    save_safetensors,
+)
+
+
+def tiny_llama(dtype=torch.float32):
+    config = transformers.LlamaConfig(
+        vocab_size=32,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+    )
+    torch.manual_seed(0)
+    return transformers.LlamaForCausalLM(config).to(dtype).eval()
+
+
+def tiny_tokenizer():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    vocab = {"<unk>": 0, "hello": 1, "world": 2}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>"
+    )
+
+
+def test_safetensors_round_trip(tmp_path):
+    tensors = {
+        "bytes": torch.arange(3, dtype=torch.uint8),
+        "half": torch.randn(5, dtype=torch.float16),
+        "float": torch.randn(2, 3),
+        "long": torch.arange(4),
+    }
+    path = str(tmp_path / "t.safetensors")
+    save_safetensors(tensors, path, {"format": "pt"})
+    mapped, metadata = map_safetensors(path)
+    assert metadata == {"format": "pt"}
+    assert mapped.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        assert torch.equal(mapped[name], tensor)
+
+
+def test_export_and_attach(tmp_path):
+    model = tiny_llama()
+    path = str(tmp_path / "shared")
+    export_shared_weights(model, tiny_tokenizer(), path, "tiny-llama")
+
+    attached, tokenizer = attach_shared_weights(path)
+    assert type(attached) is type(model)
+    assert tokenizer("hello world").input_ids == [1, 2]
+    input_ids = torch.tensor([[1, 2, 3]])
+    with torch.inference_mode():
+        assert torch.allclose(
+            attached(input_ids).logits, model(input_ids).logits, atol=1e-6
+        )
+
+
+def test_load_exports_once_per_model_and_dtype(tmp_path):
+    model_path = str(tmp_path / "model")
+    tiny_llama().save_pretrained(model_path)
+    path = str(tmp_path / "shared")
+    loads = []
+
+    def load_fn(dtype):
+        def load():
+            loads.append(dtype)
+            return tiny_llama(dtype), tiny_tokenizer()
+
+        return load
+
+    model, _ = load_shared_model(
+        path, load_fn(torch.float32), model_path, torch.float32
+    )
+    assert model.dtype == torch.float32
+    load_shared_model(path, load_fn(torch.float32), model_path, torch.float32)
+    assert loads == [torch.float32]
+
+    with pytest.warns(UserWarning, match="torch_dtype"):
+        model, _ = load_shared_model(
+            path, load_fn(torch.bfloat16), model_path, torch.bfloat16
+        )
+    assert model.dtype == torch.bfloat16
+    assert loads == [torch.float32, torch.bfloat16]
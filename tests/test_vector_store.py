@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from fastchat.serve.vector_store import VectorCollection, VectorStore, normalize
+
+
+def random_vectors(num, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((num, dim)).astype(np.float32)
+
+
+def brute_force(vectors, queries, top_k):
+    scores = normalize(queries) @ normalize(vectors).T
+    return np.argsort(-scores, axis=1)[:, :top_k]
+
+
+def test_exact_search(tmp_path):
+    vectors = random_vectors(200)
+    queries = random_vectors(5, seed=1)
+    collection = VectorCollection.create(str(tmp_path / "c"), "model")
+    collection.add(vectors, metadata=[{"row": i} for i in range(len(vectors))])
+
+    results = collection.search(queries, top_k=3, exact=True)
+    expected = brute_force(vectors, queries, 3)
+    for hits, rows in zip(results, expected):
+        assert [hit["id"] for hit in hits] == [str(row) for row in rows]
+        assert [hit["metadata"]["row"] for hit in hits] == rows.tolist()
+        scores = [hit["score"] for hit in hits]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_int8_search(tmp_path):
+    vectors = random_vectors(100)
+    collection = VectorCollection.create(
+        str(tmp_path / "c"), "model", quantization="int8"
+    )
+    collection.add(vectors)
+    results = collection.search(vectors[:10], top_k=1)
+    assert [hits[0]["id"] for hits in results] == [str(i) for i in range(10)]
+    assert all(hits[0]["score"] == pytest.approx(1, abs=0.01) for hits in results)
+
+
+def test_ivf_search_with_all_lists_is_exact(tmp_path):
+    vectors = random_vectors(300)
+    queries = random_vectors(4, seed=1)
+    collection = VectorCollection.create(str(tmp_path / "c"), "model")
+    collection.add(vectors)
+    collection.build_index("ivf", num_lists=8)
+
+    exact = collection.search(queries, top_k=5, exact=True)
+    approx = collection.search(queries, top_k=5, nprobe=8)
+    assert [[h["id"] for h in hits] for hits in approx] == [
+        [h["id"] for h in hits] for hits in exact
+    ]
+
+    # Rows added after the index was built are assigned to it.
+    collection.add(queries, ids=["q0", "q1", "q2", "q3"])
+    results = collection.search(queries, top_k=1, nprobe=8)
+    assert [hits[0]["id"] for hits in results] == ["q0", "q1", "q2", "q3"]
+
+
+def test_recover_interrupted_add(tmp_path):
+    path = str(tmp_path / "c")
+    collection = VectorCollection.create(path, "model")
+    collection.add(random_vectors(10))
+    # A crash in the middle of writing the items of the next add.
+    with open(os.path.join(path, "vectors.bin"), "ab") as fout:
+        fout.write(random_vectors(2).tobytes())
+    with open(os.path.join(path, "items.jsonl"), "a") as fout:
+        fout.write('{"id": "10", "metadata"')
+
+    collection = VectorCollection(path)
+    assert len(collection) == 10
+    assert os.path.getsize(os.path.join(path, "vectors.bin")) == 10 * 16 * 4
+    collection.add(random_vectors(1, seed=2), ids=["new"])
+    assert VectorCollection(path).items[-1]["id"] == "new"
+
+
+def test_store_create_and_delete(tmp_path):
+    store = VectorStore(str(tmp_path))
+    store.create("offers", "model", dim=16)
+    with pytest.raises(ValueError):
+        store.create("offers", "model")
+    with pytest.raises(ValueError):
+        store.create("../escape", "model")
+    assert VectorStore(str(tmp_path)).list() == ["offers"]
+    store.delete("offers")
+    with pytest.raises(KeyError):
+        store.get("offers")
+    assert not os.path.exists(tmp_path / "offers")
@@ -5,6 +5,7 @@ import pandas as pd
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from fastchat.model import get_conversation_template
 from fastchat.conversation import *
+from fastchat.data.near_dedup import drop_near_duplicates
 
 def load_model(model_name, device, num_gpus, load_8bit=False):
     if device == "cuda":
@@ -77,8 +78,12 @@ def iterate_over_df(df, model, tokenizer, temperature, context):
     df['prompt'] = prompts_list
     return df
 
-def limit_balace_offers(df):
-    df = df.drop_duplicates(subset=['name'], keep="first", inplace=False)
+def limit_balace_offers(df, near_dedup=False):
+    if near_dedup:
+        # Also drop names that differ only in case, punctuation or SKU prefixes.
+        df = drop_near_duplicates(df, 'name')
+    else:
+        df = df.drop_duplicates(subset=['name'], keep="first", inplace=False)
     ans = [y for x, y in df.groupby('model_id')]
     for i in range(len(ans)):
         ans[i] = ans[i].sample(frac=1).sample(frac=1)[:9]